@@ -10,13 +10,17 @@ import argparse
 import re
 import configparser 
 import math
+import cluster_stats
+import job_failures
+import job_spool
+import resource_model
 import sbatch_header
 from cistrome_logger import cistrome_logger 
 
 
 def set_runtime(fastq_size):
     MAX_MINUTES = 60*23
-    size_Mb = (1.0*fastq_size)/(1024*2024)
+    size_Mb = (1.0*fastq_size)/(1024*1024)
     minutes = int(60 + 0.5*size_Mb)
     minutes = min(minutes,MAX_MINUTES)
     return minutes
@@ -25,12 +29,30 @@ def set_runtime(fastq_size):
 def set_mem(fastq_size):
     min_Mb = 10000  # for mapping to the human genome a minimum is needed for the mapping index
     max_Mb = 16000  # 
-    size_Mb = (1.0*fastq_size)/(1024*2024)
+    size_Mb = (1.0*fastq_size)/(1024*1024)
     mem = int(min_Mb + 0.1*size_Mb)
     mem = min(mem,max_Mb)
     return mem
 
 
+GB_PER_CPU      = 2    # fastq GB per core
+MAX_CPUS        = 16
+LARGE_SAMPLE_GB = 8    # samples from this size also take the idle cores of a node, up to MAX_CPUS
+
+
+def set_cpus(fastq_size, gb_per_cpu=GB_PER_CPU, max_cpus=MAX_CPUS, large_sample_gb=LARGE_SAMPLE_GB, idle_cpus=None):
+    """
+    Cores of a CHIPS job, one per gb_per_cpu GB of fastq.
+    args:
+       - idle_cpus: most idle cores on a node of the partition, if known
+    """
+    size_Gb = (1.0*fastq_size)/(1024**3)
+    cpus = min(1 + int(size_Gb/gb_per_cpu), max_cpus)
+    if idle_cpus is not None and size_Gb >= large_sample_gb:
+        cpus = max(cpus, min(idle_cpus, max_cpus))
+    return cpus
+
+
 class SystemConfig():
     def __init__(self,config_filename):
         self.config_filename = config_filename
@@ -44,7 +66,8 @@ class SystemConfig():
 
 class ChipsSetup():
 
-    def __init__(self, system_config_filename = None, species = None, sample_id = None, sample_type = None):
+    def __init__(self, system_config_filename = None, species = None, sample_id = None, sample_type = None, partition = None, mem_factor = 1.0, time_factor = 1.0):
+        self.configpath = system_config_filename
         self.sys_config = SystemConfig(system_config_filename).config
         tmp_logger = cistrome_logger('chips_pipeline',self.sys_config['paths']['log_file'])
         self.logger = tmp_logger.logger
@@ -53,13 +76,18 @@ class ChipsSetup():
         self.sbatch_filename = f'{self.sample_id}_chips.sbatch'
         self.jobname = f'{self.sample_id}_chips'
         self.sample_type = sample_type.lower() # h3k27ac, dnase, tf
+        self.partition = partition # None: chosen by the cluster configuration
+        # retries after running out of memory or time ask for more, see job_failures.py
+        self.mem_factor = mem_factor
+        self.time_factor = time_factor
+        self.cpus = None # set with the memory and time from the fastq files
  
     def set_paths(self):
         # sra_files
         # fastq_files
-        #     - sample1.fastq
-        #     - sample2_R1.fastq
-        #     - sample2_R2.fastq
+        #     - sample1.fastq[.gz]
+        #     - sample2_R1.fastq[.gz]
+        #     - sample2_R2.fastq[.gz]
         # root_folder
         #     - sbatch_folder
         #         - sample1_chips.sbatch
@@ -84,16 +112,19 @@ class ChipsSetup():
         self.chips_log_path = os.path.join( self.sample_path, f'chips_log_{self.sample_id}.txt' )
 
     def determine_and_set_sample_fastq_path_from_layout(self):
-        single_end_path = os.path.join( self.fastq_path, f'{self.sample_id}.fastq' )
-        paired_end_1_path = os.path.join( self.fastq_path, f'{self.sample_id}_R1.fastq' )
-        paired_end_2_path = os.path.join( self.fastq_path, f'{self.sample_id}_R2.fastq' )
-        if os.path.exists(single_end_path):
-            self.sample_fastq_path = [single_end_path]
-        elif os.path.exists(paired_end_1_path) and os.path.exists(paired_end_2_path):
-            self.sample_fastq_path = [paired_end_1_path,paired_end_2_path] 
-        else:
-            self.logger.error(f'fastq file not found {self.sample_id}')
-            raise FileNotFoundError(errno.ENOENT,os.strerror(errno.ENOENT),self.sample_id)
+        # fastq files are gzip compressed when downloaded with sra_download.py --gzip
+        for suffix in ['.fastq.gz','.fastq']:
+            single_end_path = os.path.join( self.fastq_path, f'{self.sample_id}{suffix}' )
+            paired_end_1_path = os.path.join( self.fastq_path, f'{self.sample_id}_R1{suffix}' )
+            paired_end_2_path = os.path.join( self.fastq_path, f'{self.sample_id}_R2{suffix}' )
+            if os.path.exists(single_end_path):
+                self.sample_fastq_path = [single_end_path]
+                return
+            elif os.path.exists(paired_end_1_path) and os.path.exists(paired_end_2_path):
+                self.sample_fastq_path = [paired_end_1_path,paired_end_2_path] 
+                return
+        self.logger.error(f'fastq file not found {self.sample_id}')
+        raise FileNotFoundError(errno.ENOENT,os.strerror(errno.ENOENT),self.sample_id)
 
 
     def make_missing_directories(self):
@@ -168,6 +199,7 @@ class ChipsSetup():
         chips_config["aligner"]      = "bwa"
         chips_config["cnv_analysis"] = False
         chips_config["cutoff"]       = 0
+        chips_config["threads"]      = self.cpus if self.cpus is not None else 1 # aligner threads
         chips_config["CistromeApi"]  = True
         chips_config["Cistrome_path"]= self.chips_cistrome_result_path
         chips_config["samples"]      = {}
@@ -196,12 +228,26 @@ class ChipsSetup():
 
     def set_resources_from_fastqfile_check(self):
         if isinstance( self.sample_fastq_path, list ):
-            fastq_size = os.path.getsize(self.sample_fastq_path[0])
+            fastq_paths = self.sample_fastq_path
         else:
-            fastq_size = os.path.getsize(self.sample_fastq_path)
-        self.time = set_runtime(fastq_size)
-        self.mem  = set_mem(fastq_size)
-        self.core = 1
+            fastq_paths = [self.sample_fastq_path]
+        fastq_size = resource_model.fastq_size(fastq_paths[0])
+        features = resource_model.sample_features(fastq_paths,self.species,self.sample_type)
+        chips_conf = self.sys_config['chips']
+        gb_per_cpu = float(chips_conf.get('gb_per_cpu',GB_PER_CPU))
+        max_cpus = int(chips_conf.get('max_cpus',MAX_CPUS))
+        large_sample_gb = float(chips_conf.get('large_sample_gb',LARGE_SAMPLE_GB))
+        idle_cpus = None
+        if features['fastq_bytes'] >= large_sample_gb*1024**3:
+            idle_cpus = cluster_stats.get_cluster_snapshot(self.configpath).get_max_idle_cpus(self.partition)
+        self.cpus = set_cpus(features['fastq_bytes'], gb_per_cpu=gb_per_cpu, max_cpus=max_cpus, large_sample_gb=large_sample_gb, idle_cpus=idle_cpus)
+        # requests learned from earlier jobs, see resource_model.py, the fixed formulas until there are enough
+        model = resource_model.get_resource_model(self.configpath)
+        model.record_features(self.sample_id,features)
+        mem,minutes = model.request(features,set_mem(fastq_size),set_runtime(fastq_size),cpus=self.cpus)
+        retry_policy = job_failures.RetryPolicy(self.sys_config)
+        self.time = retry_policy.scaled_time(minutes,self.time_factor)
+        self.mem  = retry_policy.scaled_mem(mem,self.mem_factor)
 
 
     def write_chips_command_sbatch(self):
@@ -211,29 +257,38 @@ class ChipsSetup():
         else:
             sample_fastq_path = self.sample_fastq_path
  
-        if os.path.exists(sample_fastq_path):
-            self.set_resources_from_fastqfile_check()
-        else:
+        if not os.path.exists(sample_fastq_path):
             self.logger.error(f'fastq file not found {sample_fastq_path}')
             sys.stderr.write("MISSING fastq FILES! -- %s"% sample_fastq_path)
+        elif self.cpus is None:
+            self.set_resources_from_fastqfile_check()
 
-        cmd = f'cd {self.sample_path}\n'
+        # the job reports its end to the scheduler through the spool directory
+        cmd  = job_spool.spool_trap_cmd( job_spool.get_spool_path(self.sys_config), 'chips', sample_id=self.sample_id )
+        cmd += f'cd {self.sample_path}\n'
         chips_snakemake_path = os.path.join( self.sys_config['chips']['chips_path'], 'chips.snakefile' )
         cmd += f'snakemake -s {chips_snakemake_path} --configfile {self.chips_yaml} --rerun-incomplete --unlock\n'
         cmd += 'sleep 5\n'
-        cmd += f'snakemake -s {chips_snakemake_path} -j {self.core} --configfile {self.chips_yaml} --rerun-incomplete\n'
+        cmd += f'snakemake -s {chips_snakemake_path} --cores {self.cpus} --configfile {self.chips_yaml} --rerun-incomplete\n'
 
-        header = sbatch_header.SbatchHeader( time=self.time, mem=self.mem, job_name=f'{self.jobname}', log_filename=self.chips_log_path )
+        header = sbatch_header.SbatchHeader( cpus=self.cpus, time=self.time, mem=self.mem, job_name=f'{self.jobname}', partition=self.partition, log_filename=self.chips_log_path )
         path = os.path.join(self.sbatch_path,self.sbatch_filename)
         sbatch_header.write_sbatch( cmd, sbatch_path=path, header=header.__str__() )
  
 
     def submit_sbatch(self):
+        """
+        returns:
+           - SLURM job id, or None if the submission failed
+        """
         sbatch_path = os.path.join(self.sbatch_path,self.sbatch_filename)
-        if os.path.exists(sbatch_path):
-            os.system(f'sbatch {sbatch_path}')
-        else:
+        if not os.path.exists(sbatch_path):
             self.logger.error(f'sbatch file not found {sbatch_path}')
+            return None
+        job_id = sbatch_header.submit_sbatch(sbatch_path)
+        if job_id is None:
+            self.logger.error(f'sbatch submission failed {sbatch_path}')
+        return job_id
 
 
     def cancel_sbatch(self):
@@ -241,6 +296,37 @@ class ChipsSetup():
         time.sleep(60)
 
 
+def setup_chips(configpath, sample_id, species, sampletype, submit=False, cancel=True, partition=None, mem_factor=1.0, time_factor=1.0):
+    """
+    Set up the run directory and config files of a sample and write the CHIPS sbatch file.
+    args:
+       - submit: submit the sbatch file
+       - cancel: cancel a job of the same name before submitting
+       - partition: SLURM partition, by default chosen by the cluster configuration
+       - mem_factor, time_factor: scale the memory and time requests, for retries
+    returns:
+       - SLURM job id if submitted, otherwise None
+    """
+    chips_obj = ChipsSetup( system_config_filename=configpath, species=species, sample_id=sample_id, sample_type=sampletype.lower(), partition=partition,
+        mem_factor=mem_factor, time_factor=time_factor )
+
+    chips_obj.set_paths()
+    chips_obj.determine_and_set_sample_fastq_path_from_layout()
+    chips_obj.make_missing_directories()
+    chips_obj.link_chips_files()
+    # the cores are written to the CHIPS config
+    chips_obj.set_resources_from_fastqfile_check()
+    chips_obj.write_chips_config_file()
+    chips_obj.write_chips_metadata_file()
+    chips_obj.write_chips_command_sbatch()
+
+    if submit == True:
+        if cancel == True:
+            chips_obj.cancel_sbatch()
+        return chips_obj.submit_sbatch()
+    return None
+
+
 def main():
 
     try:
@@ -254,20 +340,9 @@ def main():
 
         args = parser.parse_args()
 
-        chips_obj = ChipsSetup( system_config_filename=args.configpath, species=args.species, sample_id=args.gsmID, sample_type=args.sampletype.lower() )
-
-        chips_obj.set_paths()
-        chips_obj.determine_and_set_sample_fastq_path_from_layout()
-        chips_obj.make_missing_directories()
-        chips_obj.link_chips_files()
-        chips_obj.write_chips_config_file()
-        chips_obj.write_chips_metadata_file()
-        chips_obj.set_resources_from_fastqfile_check()
-        chips_obj.write_chips_command_sbatch()
-
-        if args.submit == True:
-            chips_obj.cancel_sbatch()
-            chips_obj.submit_sbatch()        
+        job_id = setup_chips( args.configpath, args.gsmID, args.species, args.sampletype, submit=args.submit )
+        if job_id is not None:
+            print(job_id)
 
     except KeyboardInterrupt:
         sys.stderr.write("User interrupted me!\n")
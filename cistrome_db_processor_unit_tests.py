@@ -1,4 +1,5 @@
 import unittest
+import unittest.mock
 import os, sys
 import urllib.request
 import unittest
@@ -7,7 +8,274 @@ import path_parser
 import filename_pattern_regex
 import requests_from_cistromeDB
 import scheduler
+import cluster_stats
+import scheduler_core
+import sample_queue_store
+import state_scanner
+import sbatch_header
+import sample_priority
+import scratch_admission
+import fairshare_throttle
+import fake_slurm
+import pipeline_simulator
+import stage_timeline
+import metrics_exporter
+import job_state_cache
+import job_spool
+import job_failures
+import resource_model
+import chips_job_submission
+import ncbi_metadata
+import fake_ncbi
+import configparser
+import gzip
 import json
+import subprocess
+import tempfile
+import threading
+import time
+
+GB = 1024**3
+
+
+FAKE_SRA_TOOLS = {
+    'vdb-config': 'exit 0\n',
+    # prefetch RUN: writes $FAKE_SRA_ROOT/sra/RUN.sra and records how many prefetches run at the same time
+    'prefetch': 'echo $1 >> $FAKE_SRA_ROOT/prefetched\nmkdir -p $FAKE_SRA_ROOT/sra $FAKE_SRA_ROOT/running\ntouch $FAKE_SRA_ROOT/running/$1\nsleep 0.5\n'
+        'ls $FAKE_SRA_ROOT/running | wc -l >> $FAKE_SRA_ROOT/concurrency\nrm $FAKE_SRA_ROOT/running/$1\n'
+        'head -c 1000 /dev/zero > $FAKE_SRA_ROOT/sra/$1.sra\n',
+    'vdb-validate': 'name=$(basename $1)\necho $name >> $FAKE_SRA_ROOT/validated\necho "\'$name\' metadata: md5 ok" >&2\necho "\'$name\' is consistent" >&2\n',
+    # fasterq-dump [options] PATH: runs named *BAD* lose spots, until $FAKE_SRA_ROOT/fixed exists;
+    # --split-spot writes the two reads of each spot to stdout, named .../1 and .../2
+    'fasterq-dump': 'split=0\noutdir=.\nwhile [ $# -gt 1 ]; do\n  case $1 in --split-files) split=1;; --split-spot) split=2;; --outdir) outdir=$2; shift;; '
+        '--threads|--temp|--seq-defline|--qual-defline) shift;; esac\n  shift\ndone\n'
+        'run=$(basename $1 .sra)\necho $run >> $FAKE_SRA_ROOT/converted\nwritten=10\ncase $run in *BAD*) [ -e $FAKE_SRA_ROOT/fixed ] || written=5;; esac\n'
+        'if [ $split = 1 ]; then echo "@$run" > $outdir/${run}_1.fastq; echo "@$run" > $outdir/${run}_2.fastq; reads=20; written=$((2*written)); '
+        'elif [ $split = 2 ]; then for spot in 1 2; do printf "@$run.$spot/1\\nA\\n+\\nI\\n@$run.$spot/2\\nC\\n+\\nI\\n"; done; reads=20; written=$((2*written)); '
+        'else echo "@$run"; reads=10; fi\n'
+        'echo "spots read      : 10" >&2\necho "reads read      : $reads" >&2\necho "reads written   : $written" >&2\n',
+}
+
+
+class TestSRADownloadPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp = self.tmp_dir.name
+        bin_path = os.path.join(tmp,'bin')
+        os.makedirs(bin_path)
+        for name,script in FAKE_SRA_TOOLS.items():
+            with open(os.path.join(bin_path,name),'w') as fp:
+                fp.write('#!/bin/sh\n' + script)
+            os.chmod(os.path.join(bin_path,name),0o755)
+        os.makedirs(os.path.join(tmp,'ncbi','fastq'))
+        self.configpath = os.path.join(tmp,'sra.conf')
+        with open(self.configpath,'w') as fp:
+            fp.write(f'[paths]\nsratool_default = /repository/user/main/public/root\nsratool_custom = {tmp}/ncbi\nlog_file = {tmp}/log.txt\n'
+                f'[sra_download]\nworkers = 4\nnode_slots = 3\nslot_dir = {tmp}/slots\ntemp_dir = {tmp}/tmp\ncompressor = gzip\n')
+        self.env = unittest.mock.patch.dict(os.environ, {'PATH':bin_path + os.pathsep + os.environ['PATH'], 'FAKE_SRA_ROOT':os.path.join(tmp,'ncbi')})
+        self.env.start()
+        self.sra_tool = sra.SRA_Tools(self.configpath)
+        self.sra_tool.set_logger('GSM0001')
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def test_runs_in_parallel(self):
+        runs = ['SRR1','SRR2','SRR3','SRR4']
+        self.assertTrue(self.sra_tool.extract_paired_end_fastq_from_sra('GSM0001',runs))
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        self.assertEqual(sorted(os.listdir(fastq_path)), ['GSM0001.sra_state.json','GSM0001_R1.fastq','GSM0001_R2.fastq'])
+        with open(os.path.join(fastq_path,'GSM0001_R1.fastq')) as fp:
+            self.assertEqual(fp.read(), ''.join(f'@{run}\n' for run in runs))
+        # the temporary files of the conversions are removed
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir.name,'tmp')), [])
+        with open(os.path.join(self.tmp_dir.name,'ncbi','concurrency')) as fp:
+            concurrency = [int(line) for line in fp]
+        # more than one prefetch at a time, never more than the node slots
+        self.assertTrue(1 < max(concurrency) <= 3)
+
+    def test_bad_run_fails_sample(self):
+        self.assertFalse(self.sra_tool.extract_single_end_fastq_from_sra('GSM0001',['SRR1','SRRBAD','SRR3']))
+        self.assertEqual(self.sra_tool.run_status['SRRBAD']['failed'], 'convert')
+        # the runs converted are kept for the next attempt, the failed run is removed
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        converted = [run for run in ['SRR1','SRR3'] if self.sra_tool.run_status[run]['ok']]
+        self.assertEqual(sorted(os.listdir(fastq_path)), ['GSM0001.sra_state.json'] + [f'{run}.fastq' for run in converted])
+        state = sra.DownloadState(sra.get_state_path(fastq_path,'GSM0001'))
+        self.assertEqual(state.fastq_files(), [os.path.join(fastq_path,f'{run}.fastq') for run in converted])
+        self.assertEqual(state.get_run('SRRBAD').get('converted'), None)
+
+    def read_log(self,name):
+        path = os.path.join(self.tmp_dir.name,'ncbi',name)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fp:
+            return sorted(fp.read().split())
+
+    def test_resume_sample(self):
+        self.assertFalse(self.sra_tool.extract_single_end_fastq_from_sra('GSM0001',['SRR1','SRRBAD','SRR3']))
+        converted = [run for run in ['SRR1','SRR3'] if self.sra_tool.run_status[run]['ok']]
+        validated = self.read_log('validated')
+        for name in ['prefetched','validated','converted']:
+            os.remove(os.path.join(self.tmp_dir.name,'ncbi',name))
+        open(os.path.join(self.tmp_dir.name,'ncbi','fixed'),'w').close()
+
+        # a new attempt only redoes the steps that did not finish
+        sra_tool = sra.SRA_Tools(self.configpath)
+        self.assertTrue(sra_tool.extract_single_end_fastq_from_sra('GSM0001',['SRR1','SRRBAD','SRR3']))
+        for run in converted:
+            self.assertEqual(sra_tool.run_status[run]['skipped'], ['prefetch','validate','convert'])
+        self.assertEqual(self.read_log('prefetched'), sorted(set(['SRR1','SRRBAD','SRR3']) - set(run[:-4] for run in validated)))
+        self.assertEqual(self.read_log('converted'), sorted(set(['SRR1','SRRBAD','SRR3']) - set(converted)))
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        with open(os.path.join(fastq_path,'GSM0001.fastq')) as fp:
+            self.assertEqual(sorted(fp.read().split()), ['@SRR1','@SRR3','@SRRBAD'])
+        sra_tool.write_fastq_checkfile('GSM0001')
+        self.assertEqual(sorted(os.listdir(fastq_path)), ['GSM0001.check','GSM0001.fastq'])
+
+    def test_compressed_fastq(self):
+        sra_tool = sra.SRA_Tools(self.configpath,compress=True)
+        self.assertTrue(sra_tool.extract_single_end_fastq_from_sra('GSM0001',['SRR1','SRR2']))
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        self.assertEqual(sorted(os.listdir(fastq_path)), ['GSM0001.fastq.gz','GSM0001.sra_state.json'])
+        with gzip.open(os.path.join(fastq_path,'GSM0001.fastq.gz'),'rt') as fp:
+            self.assertEqual(fp.read(), '@SRR1\n@SRR2\n')
+
+    def test_compressed_paired_fastq(self):
+        sra_tool = sra.SRA_Tools(self.configpath,compress=True)
+        self.assertTrue(sra_tool.extract_paired_end_fastq_from_sra('GSM0001',['SRR1','SRR2']))
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        self.assertEqual(sorted(os.listdir(fastq_path)), ['GSM0001.sra_state.json','GSM0001_R1.fastq.gz','GSM0001_R2.fastq.gz'])
+        # the mates are de-interleaved into their own files, nothing is staged in the temp dir
+        for mate,base in [(1,'A'),(2,'C')]:
+            with gzip.open(os.path.join(fastq_path,f'GSM0001_R{mate}.fastq.gz'),'rt') as fp:
+                self.assertEqual(fp.read(), ''.join(f'@{run}.{spot}/{mate}\n{base}\n+\nI\n' for run in ['SRR1','SRR2'] for spot in [1,2]))
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir.name,'tmp')), [])
+
+    def test_join_files(self):
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        parts = []
+        for i,size in enumerate([10,3000,200]):
+            parts += [os.path.join(fastq_path,f'SRR{i}.fastq')]
+            with open(parts[-1],'wb') as fp:
+                fp.write(bytes([65+i])*size)
+        order = sra.join_order(parts)
+        self.assertEqual(order, [1,2,0])
+        with unittest.mock.patch.object(sra,'COPY_CHUNK',128):
+            sra.join_files([parts[i] for i in order],os.path.join(fastq_path,'GSM0001.fastq'))
+        self.assertEqual(os.listdir(fastq_path), ['GSM0001.fastq'])
+        with open(os.path.join(fastq_path,'GSM0001.fastq'),'rb') as fp:
+            self.assertEqual(fp.read(), b'B'*3000 + b'C'*200 + b'A'*10)
+
+    def test_failed_download_spools_failure(self):
+        tmp = self.tmp_dir.name
+        runinfo = [{'Run':'SRRBAD','Experiment':'SRX1','SampleName':'GSM0001','LibraryName':'','LibraryLayout':'SINGLE','spots':'10','bases':'500','size_MB':'1'}]
+        fake = fake_ncbi.FakeEutils(runinfo).start()
+        try:
+            with open(self.configpath,'a') as fp:
+                fp.write(f'[ncbi]\neutils_url = {fake.url}\ncache_db = {tmp}/ncbi.sqlite\n')
+            spool_dir = os.path.join(tmp,'spool')
+            cmd = job_spool.spool_trap_cmd(spool_dir,'sra',sample_id='GSM0001') + f'{sys.executable} sra_download.py -c {self.configpath} -i GSM0001\n'
+            ret = subprocess.run(['bash','-c',cmd], env=dict(os.environ, SLURM_JOB_ID='100'), capture_output=True)
+        finally:
+            fake.stop()
+        self.assertEqual(ret.returncode, 1)
+        records = job_spool.JobSpool(spool_dir).collect()
+        self.assertEqual([(record['job_id'],record['sample_id'],record['exit_code']) for record in records], [('100','GSM0001',1)])
+
+    def test_resume_join(self):
+        fastq_path = os.path.join(self.tmp_dir.name,'ncbi','fastq')
+        parts = []
+        for i in range(3):
+            parts += [os.path.join(fastq_path,f'SRR{i}.fastq')]
+            with open(parts[-1],'wb') as fp:
+                fp.write(bytes([65+i])*100)
+        joined_filename = os.path.join(fastq_path,'GSM0001.fastq')
+        progress = []
+        def interrupt(joined,joined_size):
+            progress.append((joined,joined_size))
+            if joined == 2:
+                raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            sra.join_files(parts,joined_filename,on_progress=interrupt)
+        # the interrupted append of the last file left part of it behind
+        with open(joined_filename,'ab') as fp:
+            fp.write(b'C'*50)
+        sra.join_files(parts,joined_filename,joined=progress[-1][0],joined_size=progress[-1][1])
+        self.assertEqual(os.listdir(fastq_path), ['GSM0001.fastq'])
+        with open(joined_filename,'rb') as fp:
+            self.assertEqual(fp.read(), b'A'*100 + b'B'*100 + b'C'*100)
+
+    def test_spot_counts(self):
+        self.assertTrue(sra.spots_converted('Read 10 spots for SRR1.sra\nWritten 10 spots for SRR1.sra\n',whole_spots=True))
+        fasterq = 'spots read      : 1,000\nreads read      : 2,000\nreads written   : %s\n'
+        self.assertTrue(sra.spots_converted(fasterq % '2,000',whole_spots=False))
+        self.assertFalse(sra.spots_converted(fasterq % '1,999',whole_spots=False))
+        self.assertTrue(sra.spots_converted(fasterq % '1,000',whole_spots=True))
+        self.assertFalse(sra.spots_converted('',whole_spots=True))
+
+
+class TestNCBIMetadata(unittest.TestCase):
+
+    RUNINFO = [
+        {'Run':'SRR11','Experiment':'SRX1','SampleName':'GSM0001','LibraryName':'','LibraryLayout':'SINGLE','spots':'100','bases':'5000','size_MB':'1'},
+        {'Run':'SRR12','Experiment':'SRX1','SampleName':'GSM0001','LibraryName':'','LibraryLayout':'SINGLE','spots':'50','bases':'2500','size_MB':'1'},
+        # GEO names the library after the sample
+        {'Run':'SRR21','Experiment':'SRX2','SampleName':'SAMN002','LibraryName':'GSM0002: input','LibraryLayout':'PAIRED','spots':'10','bases':'1000','size_MB':'1'},
+        {'Run':'SRR31','Experiment':'SRX3','SampleName':'GSM0003','LibraryName':'','LibraryLayout':'SINGLE','spots':'10','bases':'500','size_MB':'1'},
+        {'Run':'SRR32','Experiment':'SRX4','SampleName':'GSM0003','LibraryName':'','LibraryLayout':'PAIRED','spots':'10','bases':'1000','size_MB':'1'},
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fake = fake_ncbi.FakeEutils(self.RUNINFO).start()
+        self.now = 1700000000.0
+        sys_config = {'ncbi':{'eutils_url':self.fake.url, 'batch_size':2, 'rate':20}}
+        self.metadata = ncbi_metadata.NCBIMetadata(os.path.join(self.tmp_dir.name,'ncbi.sqlite'),sys_config,clock=lambda: self.now)
+
+    def tearDown(self):
+        self.fake.stop()
+        self.tmp_dir.cleanup()
+
+    def test_batched_resolve(self):
+        resolved = self.metadata.resolve(['GSM0001','GSM0002','GSM0003','GSM0004','ENCSR000'])
+        self.assertEqual(sorted(resolved), ['GSM0001','GSM0002','GSM0003'])
+        self.assertEqual([run['run'] for run in resolved['GSM0001']['runs']], ['SRR11','SRR12'])
+        self.assertEqual((resolved['GSM0001']['layout'],resolved['GSM0001']['spots'],resolved['GSM0001']['bases']), ('SINGLE',150,7500))
+        self.assertEqual((resolved['GSM0002']['layout'],resolved['GSM0002']['experiments']), ('PAIRED',['SRX2']))
+        self.assertEqual(resolved['GSM0003']['layout'], 'OTHER')
+        # two batches of an esearch and an efetch, spaced by the rate limit
+        self.assertEqual([utility for _,utility,_ in self.fake.requests], ['esearch.fcgi','efetch.fcgi']*2)
+        times = [request_time for request_time,_,_ in self.fake.requests]
+        self.assertTrue(min(later - earlier for earlier,later in zip(times,times[1:])) >= 0.04)
+        # cached, a sample NCBI did not know is asked for again after not_found_retry
+        self.assertEqual(sorted(self.metadata.resolve(['GSM0001','GSM0004'])), ['GSM0001'])
+        self.assertEqual(len(self.fake.requests), 4)
+        self.now += ncbi_metadata.NOT_FOUND_RETRY
+        self.metadata.resolve(['GSM0001','GSM0004'])
+        self.assertEqual(len(self.fake.requests), 5)
+        self.assertEqual(self.fake.requests[-1][2]['term'], 'GSM0004[All Fields]')
+
+    def test_expected_size(self):
+        resolved = self.metadata.resolve(['GSM0001','GSM0002'])
+        # 2 bytes per base and 64 bytes of deflines and newlines per read, 2 reads per paired-end spot
+        self.assertEqual(resolved['GSM0001']['fastq_bytes'], 2*7500 + 150*64)
+        self.assertEqual(resolved['GSM0002']['fastq_bytes'], 2*1000 + 20*64)
+        self.assertEqual(resolved['GSM0001']['sra_bytes'], 2*1024**2)
+        # download requests grow with the expected size, in steps, fixed while it is not known
+        self.assertEqual(scheduler.sra_resources({},{}), (scheduler.SRA_TIME_MINUTES,scheduler.SRA_MEM))
+        self.assertEqual(scheduler.sra_resources({'EXPECTED_BYTES':2*GB},{}), (60,1500))
+        self.assertEqual(scheduler.sra_resources({'EXPECTED_BYTES':50*GB},{}), (720,2500))
+        self.assertEqual(scheduler.sra_resources({'EXPECTED_BYTES':2000*GB},{}), (2880,8000))
+
+    def test_retry_over_rate_limit(self):
+        self.fake.fail_first = 1
+        with unittest.mock.patch.object(ncbi_metadata,'RETRY_WAIT',0):
+            resolved = self.metadata.resolve(['GSM0002'])
+        self.assertEqual(list(resolved), ['GSM0002'])
+        self.assertEqual(len(self.fake.requests), 3)
 
 
 class TestRequests_from_cistromeDB(unittest.TestCase):
@@ -142,5 +410,638 @@ class TestProcessStatusFile(unittest.TestCase):
         self.assertTrue( process_status == process_status_ref )
 
 
+class TestClusterSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        configpath = './chips_test_dirs/cistrome_pipeline_test.conf'
+        self.snapshot = cluster_stats.ClusterSnapshot(configpath)
+        # pretend squeue was just polled so no cluster call is made
+        self.snapshot.queue_poll_time = time.time()
+
+    def test_record_submitted_job(self):
+        self.snapshot.record_submitted_job('GSM0001_sra')
+        self.snapshot.get_jobs_in_queue()
+        self.assertTrue(self.snapshot.is_job_name_in_queue('GSM0001_sra'))
+        self.assertEqual(self.snapshot.get_pending_job_count(), 1)
+        self.assertEqual(self.snapshot.get_running_job_count(), 0)
+
+    def test_shared_snapshot(self):
+        configpath = './chips_test_dirs/cistrome_pipeline_test.conf'
+        self.assertIs(cluster_stats.get_cluster_snapshot(configpath), cluster_stats.get_cluster_snapshot(configpath))
+
+
+class TestSbatchArray(unittest.TestCase):
+
+    def test_array_task_cmd(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir,'sra.manifest')
+            sbatch_header.write_manifest(['GSM0001','GSM0002'], manifest_path)
+            task_cmd = sbatch_header.array_task_cmd('echo $SAMPLE_ID', manifest_path, task_jobname_suffix='sra')
+            # run task 1 without slurm, scontrol failing is tolerated
+            env = dict(os.environ, SLURM_ARRAY_TASK_ID='1', SLURM_ARRAY_JOB_ID='100', PATH='/usr/bin:/bin')
+            ret = subprocess.run(['bash','-c',task_cmd], env=env, capture_output=True)
+            self.assertEqual(str(ret.stdout,'utf-8').strip(), 'GSM0002')
+
+    def test_array_task_spools_completion_record(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir,'sra.manifest')
+            spool_dir = os.path.join(tmp_dir,'spool')
+            sbatch_header.write_manifest(['GSM0001','GSM0002'], manifest_path)
+            task_cmd = sbatch_header.array_task_cmd('exit 3', manifest_path, task_jobname_suffix='sra', spool_dir=spool_dir)
+            env = dict(os.environ, SLURM_ARRAY_TASK_ID='1', SLURM_ARRAY_JOB_ID='100', PATH='/usr/bin:/bin')
+            ret = subprocess.run(['bash','-c',task_cmd], env=env, capture_output=True)
+            self.assertEqual(ret.returncode, 3)
+            spool = job_spool.JobSpool(spool_dir)
+            records = spool.collect()
+            self.assertEqual(len(records), 1)
+            self.assertEqual((records[0]['job_id'],records[0]['sample_id'],records[0]['job_type'],records[0]['exit_code']), ('100_1','GSM0002','sra',3))
+            # records are kept until they are acknowledged, then consumed once
+            self.assertEqual(len(spool.collect()), 1)
+            spool.acknowledge()
+            self.assertEqual(os.listdir(spool_dir), [])
+            self.assertEqual(spool.collect(), [])
+
+    def test_spool_watcher_keeps_records_on_failure(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spool = job_spool.JobSpool(tmp_dir)
+            with open(os.path.join(tmp_dir,'100_1.json'),'w') as fp:
+                json.dump({'job_id':'100_1', 'sample_id':'GSM0001', 'job_type':'sra', 'exit_code':0, 'end_time':1},fp)
+            batches = []
+            def on_records(records):
+                batches.append([record['job_id'] for record in records])
+                if len(batches) == 1:
+                    raise RuntimeError('callback failed')
+                watcher.stopped.set()
+            watcher = job_spool.JobSpoolWatcher(spool,on_records,scan_interval=0.01)
+            watcher.run()
+            # the batch of the failed callback is passed again, and removed after it was processed
+            self.assertEqual(batches, [['100_1'],['100_1']])
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_size_classes_get_distinct_manifests(self):
+        class Submitter():
+            def __init__(self):
+                self.arrays = []
+            def submit_array(self,cmd,sbatch_path,**sbatch_options):
+                self.arrays += [(sbatch_path,sbatch_options['manifest_path'])]
+                return str(100 + len(self.arrays))
+        class Recorder():
+            def __init__(self):
+                self.jobs = []
+            def set_sample_info(self,sample_id,info_key,info_val):
+                self.jobs += [(sample_id,info_val)]
+            def record_submitted_job(self,*args,**kwargs):
+                pass
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sys_config = configparser.ConfigParser()
+            sys_config.read_dict({'paths':{'data_collection_sbatch':tmp_dir, 'sra':tmp_dir}, 'process_server':{'partition':'serial_requeue'}})
+            submitter,sample_queue = Submitter(),Recorder()
+            with unittest.mock.patch.multiple(scheduler.Config, sys_config=sys_config, submitter=submitter,
+                    retry_policy=job_failures.RetryPolicy(sys_config), job_spool=job_spool.JobSpool(os.path.join(tmp_dir,'spool'))):
+                # a small and a large sample need arrays of different sizes, submitted within the same second
+                batch = {'GSM_SMALL':{'EXPECTED_BYTES':1024**3}, 'GSM_LARGE':{'EXPECTED_BYTES':200*1024**3}}
+                submitted = scheduler.submit_sra_batches(sample_queue, sample_queue, batch, 'echo $SAMPLE_ID', {})
+            self.assertEqual(sorted(submitted), ['GSM_LARGE','GSM_SMALL'])
+            self.assertEqual(len(submitter.arrays), 2)
+            manifests = [manifest_path for sbatch_path,manifest_path in submitter.arrays]
+            self.assertEqual(len(set(manifests)), 2)
+            self.assertEqual(len(set(sbatch_path for sbatch_path,manifest_path in submitter.arrays)), 2)
+            samples = []
+            for manifest_path in manifests:
+                with open(manifest_path) as fp:
+                    samples += [fp.read().split()]
+            self.assertEqual(samples, [['GSM_SMALL'],['GSM_LARGE']])
+            # the job id of each task is recorded under the sample of its manifest
+            self.assertEqual(sample_queue.jobs, [('GSM_SMALL',{'101_0':'PENDING'}),('GSM_LARGE',{'102_0':'PENDING'})])
+
+    def test_array_header(self):
+        with unittest.mock.patch('sbatch_header.get_domain_name', return_value='rc.fas.harvard.edu'):
+            header = sbatch_header.SbatchHeader(job_name='sra_array', array_size=5, array_limit=2)
+        self.assertIn('#SBATCH --array=0-4%2', header.sbatch_configuration_for_odyssey())
+
+    def test_submit_sbatch_returns_job_id(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # sbatch stand-in that answers like sbatch --parsable on a federated cluster
+            sbatch_path = os.path.join(tmp_dir,'sbatch')
+            with open(sbatch_path,'w') as fp:
+                fp.write('#!/bin/sh\necho "4242;cluster"\n')
+            os.chmod(sbatch_path,0o755)
+            job_path = os.path.join(tmp_dir,'job.sbatch')
+            sbatch_header.write_sbatch('echo test\n', sbatch_path=job_path)
+            with unittest.mock.patch.dict(os.environ, {'PATH':tmp_dir + os.pathsep + os.environ['PATH']}):
+                self.assertEqual(sbatch_header.submit_sbatch(job_path), '4242')
+
+
+class TestSamplePriority(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sys_config = configparser.ConfigParser()
+        sys_config.read_dict({'paths':{'fastq':self.tmp_dir.name}, 'priority':{'sampletype_weights':'tf:1.0,atac:0.5'}})
+        self.priority = sample_priority.SamplePriority(sys_config, clock=lambda: 100*3600)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_rank(self):
+        samples = [
+            ('GSM_RETRIED', {'CistromeID':'1', 'sampletype':'tf', 'REQUESTED_AT':100*3600, 'SRA':{'1':'FAILED','2':'FAILED'}, 'RESTARTS':1}),
+            ('GSM_NEW',     {'CistromeID':'2', 'sampletype':'tf', 'REQUESTED_AT':100*3600}),
+            ('GSM_OLD',     {'CistromeID':'3', 'sampletype':'tf', 'REQUESTED_AT':52*3600}),
+            ('GSM_ATAC',    {'CistromeID':'4', 'sampletype':'atac', 'REQUESTED_AT':100*3600}),
+        ]
+        ranked = [sample_id for sample_id,sample in self.priority.rank(samples)]
+        self.assertEqual(ranked, ['GSM_OLD','GSM_NEW','GSM_ATAC','GSM_RETRIED'])
+
+    def test_retries_count_classified_failures(self):
+        # out of memory counts as a failure, preemptions and node failures do not
+        sample = {'SRA':{'1':'OUT_OF_MEMORY','2':'PREEMPTED'}, 'CHIPS':{'3':'TIMEOUT','4':'NODE_FAIL','5':'COMPLETED'}}
+        self.assertEqual(sample_priority.retries_policy(self.priority,'GSM0001',sample), 0.5**2)
+
+    def test_size(self):
+        with open(os.path.join(self.tmp_dir.name,'GSM_BIG.fastq'),'wb') as fp:
+            fp.truncate(6*1024**3)
+        samples = [('GSM_BIG',{}), ('GSM_SMALL',{'EXPECTED_BYTES':1024**3})]
+        ranked = [sample_id for sample_id,sample in self.priority.rank(samples)]
+        self.assertEqual(ranked, ['GSM_SMALL','GSM_BIG'])
+
+
+class TestScratchAdmission(unittest.TestCase):
+
+    class Scratch():
+        def get_scratch_use(self):
+            return {'used':50*GB, 'quota':100*GB, 'limit':110*GB}
+
+    class Queue():
+        def get_samples_in_stages(self,stages):
+            return {'GSM_DOWNLOADING':{'STAGE':'SRA_SUBMITTED','EXPECTED_BYTES':4*GB}, 
+                    'GSM_RUNNING':{'STAGE':'CHIPS_SUBMITTED','EXPECTED_BYTES':10*GB},
+                    'GSM_WAITING':{'STAGE':'FASTQ_READY','EXPECTED_BYTES':10*GB}}
+
+    def test_admission(self):
+        sys_config = configparser.ConfigParser()
+        sys_config.read_dict({'paths':{'fastq':'.'}, 'process_server':{'min_disk_space_avail':0,'sra_size_fraction':0.5,'chips_output_fraction':1}})
+        admission = scratch_admission.ScratchAdmission(sys_config, self.Scratch(), lambda: set())
+        admission.start_pass(self.Queue())
+        # 50 GB free, 4*2.5 GB reserved by the download, 10 GB by each CHIPS output
+        self.assertAlmostEqual(admission.free, 20*GB)
+        self.assertAlmostEqual(admission.chips_free, 40*GB)
+        self.assertTrue(admission.admit_download('GSM_NEW', {'EXPECTED_BYTES':4*GB}))
+        self.assertFalse(admission.admit_download('GSM_BIG', {'EXPECTED_BYTES':5*GB}))
+        self.assertTrue(admission.admit_chips('GSM_WAITING', {'STAGE':'FASTQ_READY','EXPECTED_BYTES':10*GB}))
+        # the SRA size from the run info replaces sra_size_fraction
+        self.assertAlmostEqual(admission.download_footprint('GSM_SRA', {'EXPECTED_BYTES':4*GB,'EXPECTED_SRA_BYTES':1*GB}), 5*GB)
+
+
+class TestFairShareThrottle(unittest.TestCase):
+
+    class FairShare():
+        def __init__(self,info):
+            self.info = info
+        def get_fairshare(self):
+            return self.info
+
+    def throttle(self,info):
+        sys_config = configparser.ConfigParser()
+        sys_config.read_dict({'process_server':{'max_jobs_pending':40,'max_jobs_running':200,'partition':'serial_requeue','partition_recovered':'shared'}})
+        return fairshare_throttle.FairShareThrottle(sys_config,self.FairShare(info))
+
+    def test_recovered(self):
+        throttle = self.throttle({'FairShare':'0.8','NormShares':'0.01','EffectvUsage':'0.005'})
+        self.assertEqual(throttle.max_jobs_pending(), 80)
+        self.assertEqual(throttle.partition(), 'shared')
+
+    def test_depleted(self):
+        throttle = self.throttle({'FairShare':'0.05','NormShares':'0.01','EffectvUsage':'0.02'})
+        self.assertEqual(throttle.max_jobs_running(), 50)
+        self.assertEqual(throttle.partition(), 'serial_requeue')
+
+    def test_unknown(self):
+        throttle = self.throttle({})
+        self.assertEqual(throttle.max_jobs_pending(), 40)
+
+    def test_default_max_jobs_running(self):
+        sys_config = configparser.ConfigParser()
+        sys_config.read_dict({'process_server':{'max_jobs_pending':40,'partition':'serial_requeue'}})
+        throttle = fairshare_throttle.FairShareThrottle(sys_config,self.FairShare({}))
+        self.assertEqual(throttle.max_jobs_running(), fairshare_throttle.MAX_JOBS_RUNNING)
+
+
+class TestFakeSlurm(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp = self.tmp_dir.name
+        with open(os.path.join(tmp,'fake_slurm.json'),'w') as fp:
+            json.dump({'rules':[{'match':'_chips$','duration':[0,0]}, {'match':'_sra$','duration':[3600,3600]}]},fp)
+        fake_slurm.install(os.path.join(tmp,'bin'),os.path.join(tmp,'home'),os.path.join(tmp,'fake_slurm.json'))
+        self.configpath = os.path.join(tmp,'cluster.conf')
+        with open(self.configpath,'w') as fp:
+            fp.write(f'[process_server]\ncluster_account = lab\ncluster_scratch = {tmp}\npartition = serial_requeue\n')
+        self.env = unittest.mock.patch.dict(os.environ, {'PATH':os.path.join(tmp,'bin') + os.pathsep + os.environ['PATH'],
+            'FAKE_SLURM_HOME':os.path.join(tmp,'home'), 'CISTROME_CLUSTER':'rc.fas.harvard.edu'})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def submit(self,job_name):
+        sbatch_path = os.path.join(self.tmp_dir.name,f'{job_name}.sbatch')
+        return sbatch_header.create_sbatch('true\n', sbatch_path, time=60, mem=2000, job_name=job_name,
+            partition='serial_requeue', log_filename=os.path.join(self.tmp_dir.name,f'{job_name}.log'), submit=True)
+
+    def test_queue_and_accounting(self):
+        chips_job_id = self.submit('GSM0001_chips')
+        sra_job_id = self.submit('GSM0002_sra')
+        status = cluster_stats.ClusterStats(self.configpath)
+        status.get_jobs_in_queue()
+        # the chips job finished as soon as it started, the sra job runs for an hour
+        self.assertFalse(status.is_job_id_in_queue(chips_job_id))
+        self.assertTrue(status.is_job_name_in_queue('GSM0002_sra'))
+        self.assertEqual(status.get_running_job_count(), 1)
+        status.get_account_info()
+        states = dict(zip(status.account_info['job_id'],status.account_info['status']))
+        self.assertEqual(states[chips_job_id], 'COMPLETED')
+        self.assertEqual(states[sra_job_id], 'RUNNING')
+        self.assertEqual(status.get_scratch_use()['quota'], 10*1024**4)
+
+    def test_idle_cpus(self):
+        self.submit('GSM0002_sra')
+        status = cluster_stats.ClusterStats(self.configpath)
+        self.assertEqual(status.get_max_idle_cpus(), 47)
+
+    def test_job_state_cache(self):
+        chips_job_id = self.submit('GSM0001_chips')
+        sra_job_id = self.submit('GSM0002_sra')
+        self.submit('unrelated')
+        clock = pipeline_simulator.VirtualClock(time.time())
+        cache = job_state_cache.JobStateCache(os.path.join(self.tmp_dir.name,'queue.sqlite'), cluster_stats.ClusterStats(self.configpath), clock=clock)
+        changed = {job['job_id']:job for job in cache.poll()}
+        self.assertEqual(set(changed), {chips_job_id,sra_job_id})
+        self.assertEqual((changed[chips_job_id]['sample_id'],changed[chips_job_id]['job_type'],changed[chips_job_id]['state']), ('GSM0001','chips','COMPLETED'))
+        self.assertEqual(changed[sra_job_id]['state'], 'RUNNING')
+        # the next poll starts at the previous one and only reports changes
+        clock.now += 60
+        self.assertEqual(cache.poll(), [])
+        self.assertEqual(cache.last_poll(), clock.now)
+        self.assertEqual([job['job_id'] for job in cache.get_jobs(sample_id='GSM0001')], [chips_job_id])
+
+    def test_failed_sacct_keeps_last_poll(self):
+        self.submit('GSM0001_chips')
+        clock = pipeline_simulator.VirtualClock(time.time())
+        status = cluster_stats.ClusterStats(self.configpath)
+        cache = job_state_cache.JobStateCache(os.path.join(self.tmp_dir.name,'queue.sqlite'), status, clock=clock)
+        self.assertEqual(len(cache.poll()), 1)
+        first_poll = cache.last_poll()
+        # sacct fails for an hour, e.g. slurmdbd is down
+        broken_bin = os.path.join(self.tmp_dir.name,'broken_bin')
+        os.makedirs(broken_bin)
+        with open(os.path.join(broken_bin,'sacct'),'w') as fp:
+            fp.write('#!/bin/sh\necho "sacct: error: Problem talking to the database" >&2\nexit 1\n')
+        os.chmod(os.path.join(broken_bin,'sacct'),0o755)
+        with unittest.mock.patch.dict(os.environ, {'PATH':broken_bin + os.pathsep + os.environ['PATH']}):
+            self.assertIsNone(status.get_account_records(clock.now))
+            clock.now += 3600
+            self.assertEqual(cache.poll(), [])
+        self.assertEqual(cache.last_poll(), first_poll)
+        # the next poll reaches back to the last one that succeeded
+        clock.now += 60
+        with unittest.mock.patch.object(status,'get_account_records',wraps=status.get_account_records) as get_account_records:
+            cache.poll()
+        self.assertEqual(get_account_records.call_args[0][0], first_poll - job_state_cache.POLL_OVERLAP)
+        self.assertEqual(cache.last_poll(), clock.now)
+
+    def test_job_steps_merged(self):
+        records = [{'JobID':'101_3','JobName':'GSM0001_chips_check','State':'CANCELLED by 1234','ExitCode':'0:15','MaxRSS':'','Elapsed':'1-00:00:10','Start':'2024-01-01T00:00:00','End':'Unknown',
+                'ReqMem':'4000M','Timelimit':'UNLIMITED','AllocCPUS':'4'},
+            {'JobID':'101_3.batch','JobName':'batch','State':'CANCELLED','ExitCode':'0:15','MaxRSS':'2048K','Elapsed':'00:00:10','Start':'','End':''},
+            {'JobID':'101_3.extern','JobName':'extern','State':'COMPLETED','ExitCode':'0:0','MaxRSS':'1024K','Elapsed':'00:00:10','Start':'','End':''}]
+        job = job_state_cache.jobs_from_records(records)['101_3']
+        self.assertEqual((job['sample_id'],job['job_type'],job['state']), ('GSM0001','chips_check','CANCELLED'))
+        self.assertEqual(job['max_rss'], 2048*1024)
+        self.assertEqual(job['elapsed'], 86410)
+        self.assertIsNone(job['end_time'])
+        self.assertEqual(job['req_mem'], 4000*1024**2)
+        self.assertIsNone(job['timelimit'])
+        self.assertEqual(job['cpus'], 4)
+
+
+class TestPipelineSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_all_samples_complete(self):
+        model = pipeline_simulator.read_model()
+        model['rules'] = [{'match':'','duration':[600,600]}]
+        simulator = pipeline_simulator.PipelineSimulator('config/rc-fas-harvard.conf', self.tmp_dir.name, model, n_samples=20)
+        report = simulator.run(3)
+        simulator.log.close()
+        self.assertEqual(report['samples_completed'], 20)
+        self.assertEqual(report['stages'], {'FINISHED':20})
+        # downloads are submitted as job arrays, CHIPS runs one job per sample
+        self.assertEqual(report['jobs_submitted']['sra'], 20)
+        self.assertLess(report['sbatch_calls']['sra'], 20)
+        self.assertEqual(report['sbatch_calls']['chips'], 20)
+        self.assertGreater(report['peak_scratch_bytes'], 0)
+        self.assertLessEqual(report['completion_hours']['p50'], report['completion_hours']['p90'])
+        self.assertEqual(report['stage_hours']['total']['n'], 20)
+        self.assertEqual(report['stage_hours']['chips run']['n'], 20)
+
+
+class TestStageTimeline(unittest.TestCase):
+
+    def test_stage_events_in_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = sample_queue_store.SampleQueueStore(os.path.join(tmp,'queue.sqlite'),clock=lambda: 500.0)
+            store.add_samples({'GSM0001':{'REQUESTED_AT':100.0}})
+            store.add_samples({'GSM0001':{'REQUESTED_AT':200.0}})
+            store.modify_sample('GSM0001',lambda sample: [('SRA_SUBMITTED',None)])
+            self.assertEqual(store.read_events(), [('GSM0001','REQUESTED',100.0),('GSM0001','SRA_SUBMITTED',500.0)])
+            self.assertEqual(store.read_events(since=600.0), [])
+
+    def test_latencies_after_restart(self):
+        hour = 3600
+        events = [('GSM0001','REQUESTED',0), ('GSM0001','SRA_SUBMITTED',1*hour), ('GSM0001','REQUESTED',5*hour),
+            ('GSM0001','SRA_SUBMITTED',8*hour), ('GSM0001','FINISHED',10*hour)]
+        latencies = stage_timeline.stage_latencies(events)
+        # each download wait is measured on its own attempt, the total from the first request
+        self.assertEqual(latencies['download wait']['n'], 2)
+        self.assertEqual(latencies['download wait']['p99'], 3)
+        self.assertEqual(latencies['total']['p50'], 10)
+        self.assertEqual(stage_timeline.throughput(events,bin_seconds=24*hour), [(0,{'REQUESTED':2,'FINISHED':1})])
+
+
+class TestMetricsExporter(unittest.TestCase):
+
+    def test_render_and_textfile(self):
+        metrics = metrics_exporter.Metrics()
+        metrics.set('cistrome_queue_samples',3,stage='FASTQ_READY')
+        metrics.inc('cistrome_jobs_submitted_total',job_type='sra')
+        metrics.inc('cistrome_jobs_submitted_total',job_type='sra')
+        metrics.observe('cistrome_cluster_command_seconds',0.5,command='squeue')
+        metrics.observe('cistrome_cluster_command_seconds',1.5,command='squeue')
+        text = metrics.render()
+        self.assertIn('# TYPE cistrome_jobs_submitted_total counter', text)
+        self.assertIn('cistrome_jobs_submitted_total{job_type="sra"} 2', text)
+        self.assertIn('cistrome_queue_samples{stage="FASTQ_READY"} 3', text)
+        self.assertIn('cistrome_cluster_command_seconds_sum{command="squeue"} 2', text)
+        self.assertIn('cistrome_cluster_command_seconds_count{command="squeue"} 2', text)
+        self.assertEqual(text.count('# TYPE cistrome_cluster_command_seconds summary'), 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp,'metrics','scheduler.prom')
+            metrics.write_textfile(path)
+            with open(path) as fp:
+                self.assertEqual(fp.read(), text)
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['scheduler.prom'])
+
+    def test_job_type_from_name(self):
+        self.assertEqual(scheduler.job_type_from_name('GSM0001_chips_check'), 'chips_check')
+        self.assertEqual(scheduler.job_type_from_name('GSM0001_chips'), 'chips')
+        self.assertEqual(scheduler.job_type_from_name('data_rsync_array_20240101120000'), 'data_rsync')
+        self.assertEqual(scheduler.job_type_from_name('interactive'), 'other')
+
+
+class TestJobFailures(unittest.TestCase):
+
+    def test_preemption_not_counted(self):
+        jobs = {'1':'PREEMPTED', '2':'NODE_FAIL', '3':'OUT_OF_MEMORY', '4':'FAILED', '5':'CANCELLED by 1234', '6':'COMPLETED'}
+        self.assertEqual(job_failures.classify('CANCELLED by 1234'), None)
+        self.assertEqual(job_failures.count_failures(jobs), 2)
+        self.assertEqual(job_failures.count_attempts(jobs), 4)
+        with tempfile.TemporaryDirectory() as tmp:
+            store = sample_queue_store.SampleQueueStore(os.path.join(tmp,'queue.sqlite'))
+            store.add_samples({'GSM0001':{'CHIPS':{'1':'PREEMPTED','2':'PREEMPTED','3':'TIMEOUT'}}})
+            self.assertEqual(store.select_ids('chips_fails >= ?',(2,)), [])
+            self.assertEqual(store.select_ids('chips_fails >= ?',(1,)), ['GSM0001'])
+
+    def test_escalation(self):
+        policy = job_failures.RetryPolicy({'process_server':{'retry_mem_factor':'2', 'retry_max_mem':'30000'}})
+        mem_factor,time_factor = policy.escalation({'1':'OUT_OF_MEMORY', '2':'OUT_OF_MEMORY', '3':'TIMEOUT', '4':'PREEMPTED'})
+        self.assertEqual((mem_factor,time_factor), (4.0,1.5))
+        self.assertEqual(policy.scaled_mem(16000,mem_factor), 30000)
+        self.assertEqual(policy.scaled_mem(40000,mem_factor), 40000)
+        self.assertEqual(policy.scaled_time(300,time_factor), 450)
+        self.assertEqual(policy.escalation(None), (1.0,1.0))
+
+
+class TestResourceModel(unittest.TestCase):
+
+    def test_estimate_reads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp,'GSM0001.fastq')
+            with open(path,'w') as fp:
+                for i in range(3000):
+                    fp.write(f'@read{i:04d}\nACGTACGTAC\n+\nIIIIIIIIII\n')
+            self.assertEqual(resource_model.estimate_reads(path), 3000)
+            features = resource_model.sample_features([path,path],'hg38','TF')
+            self.assertEqual((features['layout'],features['sample_type'],features['reads']), ('paired','tf',3000))
+            # compressed fastq, of two gzip members as after joining the runs of a sample
+            gz_path = os.path.join(tmp,'GSM0001.fastq.gz')
+            with open(path,'rb') as fp, open(gz_path,'wb') as out:
+                data = fp.read()
+                out.write(gzip.compress(data[:3200]) + gzip.compress(data[3200:]))
+            reads,size = resource_model.estimate_fastq(gz_path)
+            self.assertAlmostEqual(reads, 3000, delta=300)
+            self.assertAlmostEqual(size, len(data), delta=0.1*len(data))
+
+    def test_cpus_scaled_requests(self):
+        self.assertEqual(chips_job_submission.set_cpus(1*1024**3), 1)
+        self.assertEqual(chips_job_submission.set_cpus(5*1024**3, idle_cpus=32), 3)
+        # large samples take the idle cores of a node
+        self.assertEqual(chips_job_submission.set_cpus(10*1024**3, idle_cpus=12), 12)
+        self.assertEqual(chips_job_submission.set_cpus(10*1024**3, idle_cpus=2), 6)
+        self.assertEqual(chips_job_submission.set_cpus(100*1024**3, idle_cpus=64), 16)
+        with tempfile.TemporaryDirectory() as tmp:
+            model = resource_model.ResourceModel(os.path.join(tmp,'queue.sqlite'),{})
+            features = {'fastq_bytes':4*1024**3, 'reads':16e6, 'layout':'single', 'species':'hg38', 'sample_type':'tf'}
+            self.assertEqual(model.request(features,10000,600), (10000,600))
+            self.assertEqual(model.request(features,10000,600,cpus=4), (13000,285))
+
+    def test_fitted_requests(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp,'queue.sqlite')
+            cache = job_state_cache.JobStateCache(db_path,None)
+            model = resource_model.ResourceModel(db_path,{'resources':{'min_jobs':'10','mem_headroom':'0','max_mem':'100000'}})
+            conn = cache.connection()
+            for i in range(40):
+                gb = 1 + i % 8
+                features = {'fastq_bytes':gb*1024**3, 'reads':gb*4e6, 'layout':'single', 'species':'hg38', 'sample_type':'tf'}
+                model.record_features(f'GSM{i:04d}',features)
+                # peak memory 6 GB plus 1 GB per fastq GB, within 5%
+                max_rss = (6 + gb)*1024**3*(1 + 0.05*((i*7) % 3 - 1))
+                conn.execute('INSERT INTO jobs (job_id,sample_id,job_type,state,max_rss,elapsed,req_mem,timelimit) VALUES (?,?,?,?,?,?,?,?)',
+                    (str(i),f'GSM{i:04d}','chips','COMPLETED',max_rss,3600*gb,16000*1024**2,86400))
+            features = {'fastq_bytes':4*1024**3, 'reads':16e6, 'layout':'single', 'species':'hg38', 'sample_type':'tf'}
+            mem,minutes = model.request(features,10000,60)
+            self.assertTrue(10*1024*0.95 <= mem <= 10*1024*1.1)
+            self.assertTrue(4*60 <= minutes <= 4*60*1.3)
+            report = model.efficiency()
+            self.assertEqual(report['memory_jobs'], 40)
+            self.assertTrue(report['model_requested_gb_hours'] < report['requested_gb_hours'])
+            self.assertTrue(report['model_memory_exceeded'] <= 0.1)
+
+
+class TestSampleQueueStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = sample_queue_store.SampleQueueStore(os.path.join(self.tmp_dir.name,'queue.sqlite'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_import_json(self):
+        n_samples = self.store.import_json('./chips_test_dirs/test_sample_queue.json')
+        self.assertEqual(n_samples, 2)
+        self.assertEqual(self.store.get_sample('TEST0000000001')['SRA'], {'12344':'RUNNING'})
+
+    def test_add_samples_keeps_local_parameters(self):
+        self.store.add_samples({'GSM0001':{'species':'hg38','RESTARTS':1}})
+        added = self.store.add_samples({'GSM0001':{'species':'mm10'},'GSM0002':{'species':'mm10'}})
+        self.assertEqual(added, 1)
+        self.assertEqual(self.store.get_sample('GSM0001'), {'species':'hg38','RESTARTS':1})
+
+    def test_concurrent_modify_sample(self):
+        self.store.add_samples({'GSM0001':{'CHIPS':{}}})
+
+        def add_jobs(first):
+            for job_id in range(first,first+50):
+                self.store.modify_sample('GSM0001', lambda sample: sample['CHIPS'].update({str(job_id):'FAILED'}))
+
+        threads = [threading.Thread(target=add_jobs,args=(i*50,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.store.get_sample('GSM0001')['CHIPS']), 200)
+
+    def test_stage_and_fail_indexes(self):
+        self.store.add_samples({'GSM0001':{}, 'GSM0002':{'STAGE':'FINISHED'}, 'GSM0003':{'STAGE':'FASTQ_READY'}})
+        self.store.modify_sample('GSM0001', lambda sample: sample.update({'CHIPS':{'1':'FAILED','2':'FAILED','3':'COMPLETED'}}))
+        self.assertEqual(self.store.select_ids('stage IN (?,?)',('REQUESTED','FASTQ_READY')), ['GSM0001','GSM0003'])
+        self.assertEqual(self.store.select_ids('chips_fails >= ?',(2,)), ['GSM0001'])
+        self.assertEqual(self.store.count_by('stage'), {'REQUESTED':1,'FINISHED':1,'FASTQ_READY':1})
+
+    def test_sample_queue_updates_samples_not_read(self):
+        configpath = os.path.join(self.tmp_dir.name,'queue.conf')
+        with open(configpath,'w') as fp:
+            fp.write(f'[process_server]\nlocal_queue_file = {self.tmp_dir.name}/queue.json\nlocal_queue_db = {self.tmp_dir.name}/shared.sqlite\n')
+        sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
+        sample_queue.store.add_samples({'GSM0001':{}, 'GSM0002':{}})
+        sample_queue.read_local_queue(sample_ids=['GSM0001'])
+        # GSM0002 is not in the local copy of this process, the update still reaches the store
+        sample_queue.set_sample_info(sample_id='GSM0002',info_key='sra',info_val={'1':'FAILED'})
+        self.assertEqual(sample_queue.store.get_sample('GSM0002')['SRA'], {'1':'FAILED'})
+        sample_queue.set_sample_info(sample_id='GSM0001',info_key='sra',info_val={'2':'COMPLETED'})
+        self.assertEqual(sample_queue.get_local_queue()['GSM0001']['SRA'], {'2':'COMPLETED'})
+
+    def test_reset_sample_stage(self):
+        configpath = os.path.join(self.tmp_dir.name,'queue.conf')
+        with open(configpath,'w') as fp:
+            fp.write(f'[process_server]\nlocal_queue_file = {self.tmp_dir.name}/queue.json\nlocal_queue_db = {self.tmp_dir.name}/stages.sqlite\n')
+        sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
+        sample_queue.store.add_samples({'GSM0001':{'STAGE':'REQUESTED', 'STAGE_TIMES':{'REQUESTED':1.0,'SRA_SUBMITTED':2.0}}})
+        sample_queue.read_local_queue()
+        sample_queue.store.clock = lambda: 10.0
+        # a restart to the stage the sample is in still starts its stage times over
+        sample_queue.set_sample_stage(sample_id='GSM0001',stage='REQUESTED',reset=True)
+        self.assertEqual(sample_queue.get_local_queue()['GSM0001']['STAGE_TIMES'], {'REQUESTED':10.0})
+        self.assertIn(('GSM0001','REQUESTED',10.0), sample_queue.store.read_events())
+
+
+class TestStateScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fastq_path = os.path.join(self.tmp_dir.name,'fastq')
+        self.runs_path = os.path.join(self.tmp_dir.name,'runs')
+        os.makedirs(self.fastq_path)
+        os.makedirs(os.path.join(self.runs_path,'GSM0001','analysis','logs'))
+        open(os.path.join(self.fastq_path,'GSM0001.check'),'w').close()
+        open(os.path.join(self.runs_path,'GSM0001','analysis','logs','empty_file_list.txt'),'w').close()
+        self.scanner = state_scanner.StateScanner(self.fastq_path, self.runs_path, scan_interval=3600)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_markers(self):
+        self.assertTrue(self.scanner.has_marker('GSM0001','fastq_check'))
+        self.assertTrue(self.scanner.has_marker('GSM0001','chips_complete'))
+        self.assertFalse(self.scanner.has_marker('GSM0001','transfer_complete'))
+        self.assertFalse(self.scanner.has_marker('GSM0002','fastq_check'))
+
+    def test_invalidate(self):
+        self.assertFalse(self.scanner.has_marker('GSM0001','transfer_complete'))
+        open(os.path.join(self.runs_path,'GSM0001','GSM0001_rsync_ok.txt'),'w').close()
+        # the scan is reused within the scan interval
+        self.assertFalse(self.scanner.has_marker('GSM0001','transfer_complete'))
+        self.scanner.invalidate('GSM0001')
+        self.assertTrue(self.scanner.has_marker('GSM0001','transfer_complete'))
+
+
+class TestSchedulerCore(unittest.TestCase):
+
+    def test_downstream_stage_runs_on_ready_samples(self):
+        core = scheduler_core.SchedulerCore(max_workers=2, poll_interval=0.05)
+        calls = []
+        finished = threading.Event()
+        fastq_ready = set()
+
+        def download(samples):
+            calls.append(('download',samples))
+            fastq_ready.add('GSM0001')
+            return ['GSM0001']
+
+        def chips(samples):
+            calls.append(('chips',samples))
+            if samples is not None:
+                finished.set()
+            return []
+
+        # full passes are far apart, so chips can only see the sample through its ready queue
+        core.add_stage(scheduler_core.Stage('download', download, 3600, downstream=['chips'], done_check=lambda sample_id: sample_id in fastq_ready))
+        core.add_stage(scheduler_core.Stage('chips', chips, 3600, first_run=time.time()+3600))
+        thread = threading.Thread(target=core.run)
+        thread.start()
+        finished.wait(timeout=5)
+        core.stop()
+        thread.join(timeout=5)
+        self.assertIn(('chips',{'GSM0001'}), calls)
+
+    def test_failed_job_leaves_in_flight(self):
+        core = scheduler_core.SchedulerCore(max_workers=1, poll_interval=3600)
+        fastq_ready = set()
+        calls = []
+        def download(samples):
+            calls.append(samples)
+            return samples or []
+        def chips(samples):
+            return []
+        core.add_stage(scheduler_core.Stage('download', download, 3600, first_run=time.time()+3600, downstream=['chips'],
+            done_check=lambda sample_id: sample_id in fastq_ready))
+        core.add_stage(scheduler_core.Stage('chips', chips, 3600))
+        core.run_stage('download',{'GSM0001','GSM0002'})
+        self.assertEqual(core.in_flight['download'], {'GSM0001','GSM0002'})
+        # the job of GSM0001 failed, the job of GSM0002 finished
+        fastq_ready.add('GSM0002')
+        core.jobs_ended('download',['GSM0001','GSM0002'])
+        self.assertEqual(core.in_flight['download'], set())
+        self.assertEqual(core.ready['chips'], {'GSM0002'})
+        # the failed sample is submitted again
+        core.notify('download',['GSM0001'])
+        for stage_name,samples in core.due_stages(time.time()):
+            if stage_name == 'download':
+                core.run_stage(stage_name,samples)
+        self.assertEqual(calls[-1], {'GSM0001'})
+        self.assertEqual(core.in_flight['download'], {'GSM0001'})
+        core.release(['GSM0001'])
+        self.assertEqual(core.in_flight['download'], set())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,17 @@ import configparser
 import subprocess
 import re
 import math
+import time
+
+import metrics_exporter
+from threading import Lock
+
+DEFAULT_POLL_INTERVAL = 120 # seconds between squeue/sacct polls of the cluster snapshot
+DEFAULT_SCRATCH_POLL_INTERVAL = 600 # seconds between lfs quota calls of the cluster snapshot
+DEFAULT_FAIRSHARE_POLL_INTERVAL = 900 # seconds between sshare calls of the cluster snapshot
+
+# fields of the sacct records read by the job state cache
+SACCT_FIELDS = ['JobID','JobName','Partition','State','ExitCode','MaxRSS','Elapsed','Start','End','ReqMem','Timelimit','AllocCPUS']
 
 
 def read_config(configpath):
@@ -12,6 +23,40 @@ def read_config(configpath):
     return(config)
 
 
+def parse_sacct_time(val):
+    """
+    sacct timestamp, e.g. 2021-03-01T12:30:00, to epoch seconds, None for Unknown or None.
+    """
+    try:
+        return time.mktime(time.strptime(val,'%Y-%m-%dT%H:%M:%S'))
+    except (TypeError,ValueError):
+        return None
+
+
+def parse_sacct_elapsed(val):
+    """
+    sacct elapsed time, e.g. 1-02:03:04, 02:03:04 or 03:04.5, to seconds, None if it can not be parsed.
+    """
+    try:
+        days,hms = val.split('-') if '-' in val else (0,val)
+        seconds = 0.0
+        for part in hms.split(':'):
+            seconds = 60*seconds + float(part)
+        return int(days)*86400 + seconds
+    except (AttributeError,ValueError):
+        return None
+
+
+def run_command(cmd,command_name):
+    """
+    Run a cluster command, the call latency is recorded in the scheduler metrics.
+    """
+    start = time.time()
+    ret = subprocess.run(cmd,shell=True,capture_output=True)
+    metrics_exporter.get_metrics().observe('cistrome_cluster_command_seconds',time.time()-start,command=command_name)
+    return ret
+
+
 def replace_multiplier(string):
     multiplier = {'':1,'K':2**10,'M':2**20,'G':2**30,'T':2**40,'P':2**50}
     rep_escaped = map(re.escape, multiplier.keys())
@@ -20,7 +65,7 @@ def replace_multiplier(string):
     pattern = re.compile(format_str, re_mode)
     match = pattern.match(string)
     if match != None and match.lastindex == 2:
-        val = float(match.group(1)) * multiplier[match.group(2)]
+        val = float(match.group(1)) * multiplier[match.group(2).upper()]
     elif match != None and match.lastindex == 1:
         val = float(match.group(1))
     else:
@@ -36,8 +81,13 @@ class ClusterStats():
         self.cluster_account   = config['process_server']['cluster_account']
         self.cluster_scratch   = config['process_server']['cluster_scratch']
         self.cluster_partition = config['process_server']['partition']
+        # jobs in these partitions count towards the pending and running limits
+        self.cluster_partitions = set([self.cluster_partition])
+        for key in ['partition_recovered','partition_depleted']:
+            if key in config['process_server']:
+                self.cluster_partitions.add(config['process_server'][key])
         self.jobs_in_queue = {'partition':[],'status':[],'name':[],'time':[],'memory':[]} 
-        self.account_info  = {'partition':[],'status':[],'name':[],'exit_code':[]} 
+        self.account_info  = {'partition':[],'status':[],'name':[],'job_id':[],'exit_code':[],'start':[]} 
 
 
     def __str__(self):
@@ -63,7 +113,7 @@ class ClusterStats():
         print(self.cluster_scratch)
         cmd = f'lfs quota -hg {self.cluster_account} {self.cluster_scratch}'
         print(cmd)
-        ret = subprocess.run(cmd,shell=True,capture_output=True)
+        ret = run_command(cmd,'lfs')
         print(ret)
         try:
             rstring = str(ret.stdout, 'utf-8')
@@ -82,22 +132,49 @@ class ClusterStats():
 
 
     def get_fairshare(self):
-        cmd = f'sshare --account={self.cluster_account}'
-        ret = subprocess.run(cmd,shell=True,capture_output=True)
+        """
+        FairShare of the account, e.g. {'Account':.., 'NormShares':'0.01', 'EffectvUsage':'0.02', 'FairShare':'0.3'}.
+        """
+        # parsable output, the User column of the account line is empty
+        cmd = f'sshare --account={self.cluster_account} --parsable2 --format=Account,User,RawShares,NormShares,RawUsage,EffectvUsage,FairShare'
+        ret = run_command(cmd,'sshare')
         rstring = str(ret.stdout, 'utf-8')
         print(rstring)
         rlist = rstring.splitlines()
+        fairshare_info = {}
         if len(rlist) > 1:
-            keys = rlist[0].strip().split()
-            key_lookup = {key:i for i,key in enumerate(keys)}
-            info = rlist[-1].strip().split()
-            fairshare_info = {key: info[i] for key,i in key_lookup.items() }
-        else:
-            fairshare_info = {}
+            keys = rlist[0].strip().split('|')
+            for line in rlist[1:]:
+                info = line.strip().split('|')
+                if len(info) != len(keys):
+                    continue
+                fairshare_info = dict(zip(keys,info))
+                # the account line, not a user line
+                if fairshare_info.get('User','') == '':
+                    break
         print(fairshare_info)
         return fairshare_info
  
 
+    def get_max_idle_cpus(self,partition=None):
+        """
+        Most idle cores on one node of a partition, None if sinfo fails.
+        """
+        if partition is None:
+            partition = self.cluster_partition
+        # per node: allocated/idle/other/total cores
+        cmd = f'sinfo --partition {partition} --Node --noheader --format="%n|%C"'
+        ret = run_command(cmd,'sinfo')
+        idle_cpus = []
+        for line in str(ret.stdout,'utf-8').splitlines():
+            vals = line.strip().split('|')
+            try:
+                idle_cpus += [int(vals[1].split('/')[1])]
+            except (IndexError,ValueError):
+                pass
+        return max(idle_cpus) if len(idle_cpus) > 0 else None
+
+
     def get_jobs_in_queue(self):
         # codes = {'CD':'COMPLETED','CG':'COMPLETING','F':'FAILED','PD':'PENDING','PR':'PREEMPTED','R':'RUNNING','S':'SUSPENDED','ST':'STOPPED'}	
 
@@ -107,10 +184,12 @@ class ClusterStats():
         self.jobs_in_queue['time']      = []
         self.jobs_in_queue['memory']    = []
         self.jobs_in_queue['nodelist']  = []
+        self.jobs_in_queue['job_id']    = []
 
-        #NAME,PARTITION,USER,STATE,TIME,MIN_MEMORY
-        cmd = f'squeue --account {self.cluster_account} --format="%j,%P,%u,%T,%M,%m,%N"'
-        ret = subprocess.run(cmd,shell=True,capture_output=True)
+        #NAME,PARTITION,USER,STATE,TIME,MIN_MEMORY,NODELIST,JOBID
+        # -r lists every job array task on its own line
+        cmd = f'squeue -r --account {self.cluster_account} --format="%j,%P,%u,%T,%M,%m,%N,%i"'
+        ret = run_command(cmd,'squeue')
         rstring = str(ret.stdout, 'utf-8')
         rlist = rstring.splitlines()
 
@@ -127,6 +206,7 @@ class ClusterStats():
                 job_nodelist  = job_info[key_lookup['NODELIST']]
                 job_memory    = job_info[key_lookup['MIN_MEMORY']]
                 job_memory  = replace_multiplier(job_memory)
+                job_id        = job_info[key_lookup['JOBID']]
  
                 self.jobs_in_queue['partition'] += [job_partition]
                 self.jobs_in_queue['nodelist']  += [job_nodelist]
@@ -134,6 +214,7 @@ class ClusterStats():
                 self.jobs_in_queue['status']    += [job_status]
                 self.jobs_in_queue['time']      += [job_time]
                 self.jobs_in_queue['memory']    += [job_memory]
+                self.jobs_in_queue['job_id']    += [job_id]
 
 
     def get_account_info(self):
@@ -143,9 +224,10 @@ class ClusterStats():
         self.account_info['job_id']    = []
         self.account_info['status']    = []
         self.account_info['exit_code'] = []
+        self.account_info['start']     = []
 
-        cmd = f'sacct --account {self.cluster_account} --format="Partition%30,State%30,JobID%30,JobName%30,ExitCode%10,State%10"'
-        ret = subprocess.run(cmd,shell=True,capture_output=True)
+        cmd = f'sacct --account {self.cluster_account} --format="Partition%30,State%30,JobID%30,JobName%30,ExitCode%10,Start%20,State%10"'
+        ret = run_command(cmd,'sacct')
         rstring = str(ret.stdout, 'utf-8')
         rlist = rstring.splitlines()
 
@@ -161,24 +243,48 @@ class ClusterStats():
                     job_name      = job_info[key_lookup['JobName']]
                     job_id        = job_info[key_lookup['JobID']]
                     job_exit_code = job_info[key_lookup['ExitCode']]
+                    job_start     = job_info[key_lookup['Start']]
                     self.account_info['partition'] += [job_partition]
                     self.account_info['name']      += [job_name]
                     self.account_info['job_id']    += [job_id]
                     self.account_info['status']    += [job_status]
                     self.account_info['exit_code'] += [job_exit_code]
+                    self.account_info['start']     += [job_start]
                 except:
                     pass 
 
 
+    def get_account_records(self,starttime):
+        """
+        sacct records of the jobs and job steps of the account since starttime.
+        args:
+           - starttime: epoch seconds, jobs that ended before are left out
+        returns:
+           - list of {field: value} for the SACCT_FIELDS, None if sacct failed
+        """
+        starttime = time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(starttime))
+        cmd = f'sacct --account {self.cluster_account} --starttime {starttime} --parsable2 --noheader --format={",".join(SACCT_FIELDS)}'
+        ret = run_command(cmd,'sacct')
+        if ret.returncode != 0:
+            print('sacct failed:',str(ret.stderr,'utf-8').strip())
+            return None
+        records = []
+        for line in str(ret.stdout,'utf-8').splitlines():
+            vals = line.split('|')
+            if len(vals) == len(SACCT_FIELDS):
+                records += [dict(zip(SACCT_FIELDS,vals))]
+        return records
+
+
     def get_pending_job_count(self):
-        partition = self.cluster_partition
-        job_index_in_partition = [i for i,elem in enumerate(self.jobs_in_queue['partition']) if elem == partition]
+        partitions = self.cluster_partitions
+        job_index_in_partition = [i for i,elem in enumerate(self.jobs_in_queue['partition']) if elem in partitions]
         return len([i for i in job_index_in_partition if self.jobs_in_queue['status'][i] in ['PD','PENDING']])
 
 
     def get_running_job_count(self):
-        partition = self.cluster_partition
-        job_index_in_partition = [i for i,elem in enumerate(self.jobs_in_queue['partition']) if elem == partition]
+        partitions = self.cluster_partitions
+        job_index_in_partition = [i for i,elem in enumerate(self.jobs_in_queue['partition']) if elem in partitions]
         return len([i for i in job_index_in_partition if self.jobs_in_queue['status'][i] in ['R','RUNNING']])
 
 
@@ -186,11 +292,166 @@ class ClusterStats():
         return (job_name in self.jobs_in_queue['name'])
 
 
+    def is_job_id_in_queue(self,job_id):
+        return (job_id in self.jobs_in_queue.get('job_id',[]))
+
+
     def list_job_names_in_queue(self):
         return self.jobs_in_queue['name']
 
 
 
+class ClusterSnapshot(ClusterStats):
+    """
+    Process-wide cached view of the SLURM queue and accounting history.
+    squeue and sacct are polled at most once per *poll_interval* seconds 
+    and all scheduler stages are served from memory in between.
+    Jobs submitted by the scheduler are recorded locally so that throttling 
+    stays correct between polls.
+    """
+
+    def __init__(self,configpath):
+        super().__init__(configpath)
+        config = read_config(configpath)
+        self.poll_interval = float(config['process_server'].get('cluster_poll_interval',DEFAULT_POLL_INTERVAL))
+        self.scratch_poll_interval = float(config['process_server'].get('scratch_poll_interval',DEFAULT_SCRATCH_POLL_INTERVAL))
+        self.lock = Lock()
+        self.queue_poll_time   = None
+        self.account_poll_time = None
+        self.scratch_poll_time = None
+        self.scratch_use = {}
+        self.fairshare_poll_interval = float(config['process_server'].get('fairshare_poll_interval',DEFAULT_FAIRSHARE_POLL_INTERVAL))
+        self.fairshare_poll_time = None
+        self.fairshare_info = {}
+        self.idle_cpus = {}  # partition: (poll time, most idle cores on a node)
+        self.jobs_in_queue['nodelist'] = []
+        self.jobs_in_queue['job_id']   = []
+
+
+    def is_stale(self,poll_time,poll_interval=None):
+        if poll_interval is None:
+            poll_interval = self.poll_interval
+        return (poll_time is None) or (time.time() - poll_time >= poll_interval)
+
+
+    def get_jobs_in_queue(self,force=False):
+        with self.lock:
+            if force or self.is_stale(self.queue_poll_time):
+                super().get_jobs_in_queue()
+                self.queue_poll_time = time.time()
+
+
+    def get_account_info(self,force=False):
+        with self.lock:
+            if force or self.is_stale(self.account_poll_time):
+                super().get_account_info()
+                self.account_poll_time = time.time()
+
+
+    def get_scratch_use(self,force=False):
+        """
+        lfs quota of the account on scratch, e.g. {'used':.., 'quota':.., 'limit':..} in bytes.
+        A failed lfs call is retried on the next call.
+        """
+        with self.lock:
+            if force or self.is_stale(self.scratch_poll_time,self.scratch_poll_interval):
+                self.scratch_use = super().get_scratch_use()
+                self.scratch_poll_time = time.time() if len(self.scratch_use) > 0 else None
+            return dict(self.scratch_use)
+
+
+    def get_fairshare(self,force=False):
+        with self.lock:
+            if force or self.is_stale(self.fairshare_poll_time,self.fairshare_poll_interval):
+                self.fairshare_info = super().get_fairshare()
+                self.fairshare_poll_time = time.time() if len(self.fairshare_info) > 0 else None
+            return dict(self.fairshare_info)
+
+
+    def get_max_idle_cpus(self,partition=None,force=False):
+        if partition is None:
+            partition = self.cluster_partition
+        with self.lock:
+            poll_time,idle_cpus = self.idle_cpus.get(partition,(None,None))
+            if force or self.is_stale(poll_time):
+                idle_cpus = super().get_max_idle_cpus(partition)
+                self.idle_cpus[partition] = (time.time() if idle_cpus is not None else None, idle_cpus)
+            return idle_cpus
+
+
+    def record_submitted_job(self,job_name,job_id='',partition=None,memory=math.nan):
+        """
+        Add a newly submitted job to the cached queue as pending. 
+        The entry is replaced by the real state on the next poll.
+        """
+        if partition is None:
+            partition = self.cluster_partition
+        with self.lock:
+            self.jobs_in_queue['partition'] += [partition]
+            self.jobs_in_queue['nodelist']  += ['']
+            self.jobs_in_queue['name']      += [job_name]
+            self.jobs_in_queue['status']    += ['PENDING']
+            self.jobs_in_queue['time']      += ['0:00']
+            self.jobs_in_queue['memory']    += [memory]
+            self.jobs_in_queue['job_id']    += [job_id]
+
+
+    def get_pending_job_count(self):
+        with self.lock:
+            return super().get_pending_job_count()
+
+
+    def get_running_job_count(self):
+        with self.lock:
+            return super().get_running_job_count()
+
+
+    def is_job_name_in_queue(self,job_name):
+        with self.lock:
+            return super().is_job_name_in_queue(job_name)
+
+
+    def is_job_id_in_queue(self,job_id):
+        with self.lock:
+            return super().is_job_id_in_queue(job_id)
+
+
+    def list_job_names_in_queue(self):
+        with self.lock:
+            return list(super().list_job_names_in_queue())
+
+
+    def copy_jobs_in_queue(self):
+        with self.lock:
+            return {key:list(val) for key,val in self.jobs_in_queue.items()}
+
+
+    def copy_account_info(self):
+        with self.lock:
+            return {key:list(val) for key,val in self.account_info.items()}
+
+
+_snapshots = {}
+_snapshots_lock = Lock()
+
+def get_cluster_snapshot(configpath):
+    """
+    Return the shared ClusterSnapshot for this config, creating it on first use.
+    """
+    with _snapshots_lock:
+        if configpath not in _snapshots:
+            _snapshots[configpath] = ClusterSnapshot(configpath)
+        return _snapshots[configpath]
+
+
+def set_cluster_snapshot(configpath,snapshot):
+    """
+    Use another snapshot for this config, e.g. a simulated cluster.
+    """
+    with _snapshots_lock:
+        _snapshots[configpath] = snapshot
+
+
 def main(configpath):
     cluster_stats = ClusterStats(configpath)
     scratch_use = cluster_stats.get_scratch_use()
@@ -204,6 +465,7 @@ def main(configpath):
     print(f'account info: {cluster_stats.account_info}\n')
     print(cluster_stats)
     cluster_stats.get_fairshare()
+    print(f'most idle cores on a node: {cluster_stats.get_max_idle_cpus()}\n')
  
 
 if __name__ == '__main__':
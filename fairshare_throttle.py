@@ -0,0 +1,120 @@
+"""
+FairShare-driven throttling of job submission.
+The number of jobs the scheduler keeps pending and running, and the partition it
+submits to, follow the FairShare factor of the account (sshare, cached by the cluster
+snapshot): while the share has recovered the pipeline pushes harder, as it gets
+depleted it backs off towards the cheap scavenger partition and a fraction of the caps.
+
+The caps max_jobs_pending and max_jobs_running (default 250) in [process_server] are the values at
+a scale of 1, settings (defaults below):
+    fairshare_depleted  = 0.1    FairShare at or below which the minimum scale is used
+    fairshare_recovered = 0.5    FairShare at or above which the maximum scale is used
+    fairshare_min_scale = 0.25
+    fairshare_max_scale = 2.0
+    partition_recovered = shared           partition for CHIPS jobs when the share has recovered
+    partition_depleted  = serial_requeue   partition otherwise
+The short download and transfer arrays stay on [process_server] partition.
+"""
+
+import argparse
+import configparser
+
+import cluster_stats
+
+FAIRSHARE_DEPLETED  = 0.1
+FAIRSHARE_RECOVERED = 0.5
+MIN_SCALE = 0.25
+MAX_SCALE = 2.0
+MAX_JOBS_RUNNING = 250
+
+
+def to_float(val):
+    try:
+        return float(val)
+    except (TypeError,ValueError):
+        return None
+
+
+class FairShareThrottle():
+
+    def __init__(self,sys_config,cluster_status):
+        """
+        args:
+           - sys_config: pipeline config, settings are read from [process_server]
+           - cluster_status: ClusterSnapshot, provides the cached sshare output
+        """
+        conf = sys_config['process_server']
+        self.cluster_status = cluster_status
+        self.max_jobs_pending_base = int(conf['max_jobs_pending'])
+        self.max_jobs_running_base = int(conf.get('max_jobs_running',MAX_JOBS_RUNNING))
+        self.depleted  = float(conf.get('fairshare_depleted',FAIRSHARE_DEPLETED))
+        self.recovered = float(conf.get('fairshare_recovered',FAIRSHARE_RECOVERED))
+        self.min_scale = float(conf.get('fairshare_min_scale',MIN_SCALE))
+        self.max_scale = float(conf.get('fairshare_max_scale',MAX_SCALE))
+        self.partition_recovered = conf.get('partition_recovered',conf['partition'])
+        self.partition_depleted  = conf.get('partition_depleted',conf['partition'])
+
+
+    def fairshare(self):
+        """
+        (FairShare factor, normalized shares, effective usage) of the account, None where unknown.
+        """
+        info = self.cluster_status.get_fairshare()
+        return to_float(info.get('FairShare')), to_float(info.get('NormShares')), to_float(info.get('EffectvUsage'))
+
+
+    def scale(self):
+        """
+        Factor applied to the job caps, 1 when FairShare is unknown.
+        """
+        fairshare,norm_shares,effective_usage = self.fairshare()
+        if fairshare is None:
+            return 1.0
+        if fairshare <= self.depleted:
+            scale = self.min_scale
+        elif fairshare >= self.recovered:
+            scale = self.max_scale
+        else:
+            scale = self.min_scale + (self.max_scale - self.min_scale)*(fairshare - self.depleted)/(self.recovered - self.depleted)
+        # using more than our share right now drains FairShare further: back off in proportion
+        if norm_shares is not None and effective_usage is not None and effective_usage > norm_shares > 0:
+            scale = max(self.min_scale, scale*norm_shares/effective_usage)
+        return scale
+
+
+    def max_jobs_pending(self):
+        return max(1,int(round(self.max_jobs_pending_base*self.scale())))
+
+
+    def max_jobs_running(self):
+        return max(1,int(round(self.max_jobs_running_base*self.scale())))
+
+
+    def partition(self):
+        """
+        Partition for the long CHIPS jobs: the recovered partition only while FairShare is above the recovered level.
+        """
+        fairshare,norm_shares,effective_usage = self.fairshare()
+        if fairshare is not None and fairshare >= self.recovered:
+            return self.partition_recovered
+        return self.partition_depleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Show the job limits and partition set by the current FairShare""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    args = parser.parse_args()
+
+    sys_config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    sys_config.optionxform=str
+    sys_config.read(args.configpath)
+    throttle = FairShareThrottle(sys_config,cluster_stats.get_cluster_snapshot(args.configpath))
+    fairshare,norm_shares,effective_usage = throttle.fairshare()
+    print(f'FairShare: {fairshare} NormShares: {norm_shares} EffectvUsage: {effective_usage}')
+    print(f'scale: {throttle.scale():.2f}')
+    print(f'max_jobs_pending: {throttle.max_jobs_pending()} max_jobs_running: {throttle.max_jobs_running()}')
+    print(f'partition: {throttle.partition()}')
+
+
+if __name__ == '__main__':
+    main()
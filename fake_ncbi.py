@@ -0,0 +1,122 @@
+"""
+Local stand-in for the NCBI E-utilities used by ncbi_metadata.py, for testing off the network.
+Serves esearch.fcgi (db=sra, on the history server) and efetch.fcgi (rettype=runinfo) from a
+runinfo table; a search finds the experiments whose sample or library name is a GSM of the term.
+Requests are logged with their time, so tests can check batching and the rate limit.
+
+Run by hand:
+    python fake_ncbi.py --runinfo runinfo.csv --port 8080
+and set [ncbi] eutils_url = http://localhost:8080
+"""
+
+import argparse
+import csv
+import http.server
+import io
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+RUNINFO_COLUMNS = ['Run','Experiment','SampleName','LibraryName','LibraryLayout','spots','bases','size_MB']
+
+
+class FakeEutils():
+
+    def __init__(self,rows,port=0,fail_first=0):
+        """
+        args:
+           - rows: runinfo rows, {column: value}
+           - port: port on localhost, 0 for any free port
+           - fail_first: answer the first requests with HTTP 429, as NCBI does over the rate limit
+        """
+        self.rows = rows
+        self.fail_first = fail_first
+        self.requests = []  # (time, utility, params)
+        self.history = {}   # query_key: experiments
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                self.answer(url.path,urllib.parse.parse_qs(url.query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length',0))).decode('utf-8')
+                self.answer(urllib.parse.urlparse(self.path).path,urllib.parse.parse_qs(body))
+
+            def answer(self,path,query):
+                status,content_type,body = fake.handle(path.rsplit('/',1)[-1],{key:vals[0] for key,vals in query.items()})
+                self.send_response(status)
+                self.send_header('Content-Type',content_type)
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1',port),Handler)
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+
+    def handle(self,utility,params):
+        with self.lock:
+            self.requests += [(time.monotonic(),utility,params)]
+            if len(self.requests) <= self.fail_first:
+                return 429,'text/plain',b'API rate limit exceeded'
+            if utility == 'esearch.fcgi':
+                gsm_ids = set(re.findall(r'GSM[0-9]+',params.get('term','')))
+                experiments = []
+                for row in self.rows:
+                    names = [re.match(r'GSM[0-9]+',row.get(key) or '') for key in ['SampleName','LibraryName']]
+                    if any(match and match.group() in gsm_ids for match in names) and row['Experiment'] not in experiments:
+                        experiments += [row['Experiment']]
+                query_key = str(len(self.history) + 1)
+                self.history[query_key] = experiments
+                result = {'esearchresult':{'count':str(len(experiments)), 'retmax':'0', 'retstart':'0',
+                    'querykey':query_key, 'webenv':'FAKE_WEBENV'}}
+                return 200,'application/json',json.dumps(result).encode('utf-8')
+            if utility == 'efetch.fcgi' and params.get('rettype') == 'runinfo':
+                experiments = self.history.get(params.get('query_key'),[])
+                start = int(params.get('retstart',0))
+                page = experiments[start:start + int(params.get('retmax',len(experiments)))]
+                out = io.StringIO()
+                writer = csv.DictWriter(out,fieldnames=RUNINFO_COLUMNS,extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows([row for row in self.rows if row['Experiment'] in page])
+                return 200,'text/plain',out.getvalue().encode('utf-8')
+            return 400,'text/plain',b'unknown request'
+
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Serve a runinfo table as the NCBI E-utilities""")
+    parser.add_argument( '--runinfo', dest='runinfo', type=str, required=True, help='runinfo table, csv')
+    parser.add_argument( '--port', dest='port', type=int, default=8080, help='port on localhost')
+    args = parser.parse_args()
+
+    with open(args.runinfo,'r') as fp:
+        rows = list(csv.DictReader(fp))
+    fake = FakeEutils(rows,port=args.port)
+    print(f'serving {len(rows)} runs on {fake.url}')
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,744 @@
+"""
+Local stand-in for SLURM and Lustre commands, for load testing the scheduler off the cluster.
+The pipeline code calls sbatch, squeue, sacct, scancel, scontrol, sshare, sinfo and lfs through PATH;
+this script installs shims for those commands that answer in the formats ClusterStats parses.
+
+Jobs are kept in a JSON state file (locked with fcntl, so concurrent calls are safe) and the
+state is moved forward on every call: pending jobs start when a slot is free, running jobs end
+after their duration. Jobs are either simulated, ending in COMPLETED, FAILED, OUT_OF_MEMORY,
+PREEMPTED or TIMEOUT with configured probabilities, or run for real with bash.
+
+Install and use:
+    python fake_slurm.py install --bin /tmp/fake_slurm/bin --home /tmp/fake_slurm [--config fake_slurm.json]
+    export PATH=/tmp/fake_slurm/bin:$PATH
+    export CISTROME_CLUSTER=rc.fas.harvard.edu   # sbatch header configuration to use off the cluster
+
+Config (JSON, all optional):
+    {"max_running": 100, "node_cpus": 48, "pending_seconds": 5, "time_scale": 60, "seed": 0,
+     "scratch_path": "/tmp/scratch", "scratch_quota": "10T",
+     "fairshare": {"norm_shares": 0.01, "half_life": 86400, "cluster_cpu_seconds": 1e7},
+     "rules": [{"match": "_sra$", "mode": "simulate", "duration": [600, 3600],
+                "p_fail": 0.02, "p_oom": 0.01, "p_preempt": 0.05, "rss_fraction": 0.6}]}
+Durations are in simulated seconds, time_scale simulated seconds pass per real second.
+The first rule whose regular expression matches the job name applies.
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import math
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+
+HOME_ENV = 'FAKE_SLURM_HOME'
+USER = os.environ.get('USER','pipeline')
+NODE = 'fake01'
+COMMANDS = ['sbatch','squeue','sacct','scancel','scontrol','sshare','sinfo','lfs']
+
+DEFAULT_CONFIG = {
+    'max_running': 100,
+    'node_cpus': 48,     # cores of the node reported by sinfo
+    'pending_seconds': 0,
+    'time_scale': 1,
+    'seed': 0,
+    'scratch_path': None,
+    'scratch_quota': '10T',
+    'fairshare': {'norm_shares': 0.01, 'half_life': 7*86400, 'cluster_cpu_seconds': 1e9},
+    'rules': [],
+}
+DEFAULT_RULE = {'mode':'simulate', 'duration':[60,60], 'p_fail':0.0, 'p_oom':0.0, 'p_preempt':0.0, 'rss_fraction':0.5}
+
+ACTIVE_STATES = ['PENDING','RUNNING']
+
+# squeue --format codes
+SQUEUE_FIELDS = {'i':'JOBID','j':'NAME','P':'PARTITION','u':'USER','T':'STATE','t':'ST','M':'TIME',
+    'm':'MIN_MEMORY','N':'NODELIST','C':'CPUS','l':'TIME_LIMIT','a':'ACCOUNT','A':'JOBID','K':'ARRAY_TASK_ID'}
+
+
+# ===============================================================================================
+# state
+# ===============================================================================================
+
+def home_path():
+    return os.environ.get(HOME_ENV,os.path.join(os.path.expanduser('~'),'.fake_slurm'))
+
+
+def read_config():
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    config_path = os.path.join(home_path(),'config.json')
+    if os.path.exists(config_path):
+        with open(config_path) as fp:
+            config.update(json.load(fp))
+    return config
+
+
+@contextlib.contextmanager
+def locked_state():
+    """
+    Read, advance and write back the state under an exclusive lock.
+    """
+    home = home_path()
+    os.makedirs(home,exist_ok=True)
+    state_path = os.path.join(home,'state.json')
+    with open(os.path.join(home,'state.lock'),'a') as lock_fp:
+        fcntl.flock(lock_fp,fcntl.LOCK_EX)
+        if os.path.exists(state_path):
+            with open(state_path) as fp:
+                state = json.load(fp)
+        else:
+            state = {'next_job_id':1000, 'jobs':{}, 'usage':0.0, 'usage_time':None}
+        config = read_config()
+        advance(state,config,time.time())
+        yield state,config
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path,'w') as fp:
+            json.dump(state,fp)
+        os.replace(tmp_path,state_path)
+
+
+def job_sort_key(job):
+    return (int(job['array_job_id'] or job['job_id']), job['array_task_id'] if job['array_task_id'] is not None else -1)
+
+
+def sorted_jobs(state):
+    return sorted(state['jobs'].values(),key=job_sort_key)
+
+
+def find_rule(config,name):
+    for rule in config['rules']:
+        if re.search(rule.get('match',''),name):
+            merged = dict(DEFAULT_RULE)
+            merged.update(rule)
+            return merged
+    return dict(DEFAULT_RULE)
+
+
+# ===============================================================================================
+# simulation
+# ===============================================================================================
+
+def draw_outcome(job,config,name,scale=1.0):
+    """
+    Decide at start time how a simulated job ends, in simulated seconds after the start.
+    The drawn duration is multiplied by scale, e.g. relative size of the sample.
+    """
+    rule = find_rule(config,name)
+    rng = random.Random(f"{config['seed']}-{job['job_id']}")
+    low,high = rule['duration']
+    duration = rng.uniform(low,high)*scale
+    time_limit = job['time_limit']*60
+    draw = rng.random()
+    if draw < rule['p_preempt']:
+        outcome,end = 'PREEMPTED', rng.uniform(0,duration)
+    elif draw < rule['p_preempt'] + rule['p_oom']:
+        outcome,end = 'OUT_OF_MEMORY', rng.uniform(0,duration)
+    elif draw < rule['p_preempt'] + rule['p_oom'] + rule['p_fail']:
+        outcome,end = 'FAILED', rng.uniform(0,duration)
+    elif duration > time_limit:
+        outcome,end = 'TIMEOUT', time_limit
+    else:
+        outcome,end = 'COMPLETED', duration
+    rss_fraction = 1.0 if outcome == 'OUT_OF_MEMORY' else rule['rss_fraction']
+    job['mode'] = rule['mode']
+    job['outcome'] = outcome
+    job['duration'] = end
+    job['max_rss_mb'] = job['mem_mb']*rss_fraction
+
+
+def exit_code_of(outcome):
+    return {'COMPLETED':'0:0','FAILED':'1:0','OUT_OF_MEMORY':'0:125','TIMEOUT':'0:15','PREEMPTED':'0:15','CANCELLED':'0:15'}.get(outcome,'0:0')
+
+
+def finish_job(job,state_name,end_time,exit_code=None):
+    job['state'] = state_name
+    job['end_time'] = end_time
+    job['exit_code'] = exit_code if exit_code is not None else exit_code_of(state_name)
+
+
+def log_path_of(job):
+    log = job['log'] or f"slurm-{job['job_id']}.out"
+    log = log.replace('%A',str(job['array_job_id'] or job['job_id'])).replace('%a',str(job['array_task_id']))
+    return log.replace('%j',str(job['job_id'])).replace('%x',job['name'])
+
+
+def simulated_task_name(job):
+    """
+    Job array tasks written by sbatch_header.array_task_cmd rename themselves to {SAMPLE_ID}_{suffix}
+    when they start; simulated tasks do the same without running the script.
+    """
+    try:
+        with open(job['script']) as fp:
+            script = fp.read()
+    except FileNotFoundError:
+        return job['name']
+    manifest_match = re.search(r'SAMPLE_ID=\$\(sed -n "\S+" (\S+)\)',script)
+    suffix_match = re.search(r'JobName=\$\{SAMPLE_ID\}_(\S+)',script)
+    if manifest_match is None or suffix_match is None:
+        return job['name']
+    try:
+        with open(manifest_match.group(1)) as fp:
+            sample_ids = [line.strip() for line in fp if line.strip() != '']
+        return f"{sample_ids[job['array_task_id']]}_{suffix_match.group(1)}"
+    except (FileNotFoundError,IndexError):
+        return job['name']
+
+
+def start_job(job,config,now):
+    job['state'] = 'RUNNING'
+    job['start_time'] = now
+    name = simulated_task_name(job) if job['array_job_id'] is not None else job['name']
+    draw_outcome(job,config,name)
+    if job['mode'] != 'run':
+        job['name'] = name
+        return
+    env = dict(os.environ, SLURM_JOB_ID=str(job['job_id']), SLURM_JOB_NAME=job['name'], SLURM_CPUS_PER_TASK=str(job['cpus']))
+    if job['array_job_id'] is not None:
+        env.update(SLURM_ARRAY_JOB_ID=str(job['array_job_id']), SLURM_ARRAY_TASK_ID=str(job['array_task_id']))
+    exit_path = os.path.join(home_path(),f"{job['job_id']}.exit")
+    log_path = log_path_of(job)
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)),exist_ok=True)
+    with open(log_path,'a') as log_fp:
+        process = subprocess.Popen(['bash','-c',f'bash {job["script"]}; echo $? > {exit_path}'], env=env,
+            stdout=log_fp, stderr=subprocess.STDOUT, start_new_session=True, cwd=job['cwd'])
+    job['pid'] = process.pid
+
+
+def kill_job(job):
+    if job.get('pid'):
+        try:
+            os.killpg(job['pid'],signal.SIGTERM)
+        except (ProcessLookupError,PermissionError):
+            pass
+
+
+def advance_running(job,config,now):
+    time_scale = float(config['time_scale'])
+    elapsed = (now - job['start_time'])*time_scale
+    if job['mode'] == 'run':
+        exit_path = os.path.join(home_path(),f"{job['job_id']}.exit")
+        if os.path.exists(exit_path):
+            with open(exit_path) as fp:
+                code = fp.read().strip() or '1'
+            os.remove(exit_path)
+            end_state = 'COMPLETED' if code == '0' else 'FAILED'
+            finish_job(job,end_state,now,exit_code=f'{code}:0')
+        elif elapsed > job['time_limit']*60:
+            kill_job(job)
+            finish_job(job,'TIMEOUT',now)
+    elif elapsed >= job['duration']:
+        finish_job(job,job['outcome'],job['start_time'] + job['duration']/time_scale)
+
+
+def update_usage(state,config,now):
+    """
+    Decayed CPU usage of the account, for sshare.
+    """
+    fairshare = config['fairshare']
+    if state['usage_time'] is not None:
+        dt = (now - state['usage_time'])*float(config['time_scale'])
+        running_cpus = sum([job['cpus'] for job in state['jobs'].values() if job['state'] == 'RUNNING'])
+        state['usage'] = state['usage']*0.5**(dt/fairshare['half_life']) + running_cpus*dt
+    state['usage_time'] = now
+
+
+def advance(state,config,now):
+    update_usage(state,config,now)
+    jobs = sorted_jobs(state)
+    for job in jobs:
+        if job['state'] == 'RUNNING':
+            advance_running(job,config,now)
+
+    running = len([job for job in jobs if job['state'] == 'RUNNING'])
+    running_tasks = {}
+    for job in jobs:
+        if job['state'] == 'RUNNING' and job['array_job_id'] is not None:
+            running_tasks[job['array_job_id']] = running_tasks.get(job['array_job_id'],0) + 1
+
+    pending_seconds = float(config['pending_seconds'])/float(config['time_scale'])
+    for job in jobs:
+        if running >= int(config['max_running']):
+            break
+        if job['state'] != 'PENDING' or now - job['submit_time'] < pending_seconds:
+            continue
+        array_job_id = job['array_job_id']
+        if array_job_id is not None and job['array_limit'] and running_tasks.get(array_job_id,0) >= job['array_limit']:
+            continue
+        start_job(job,config,now)
+        running += 1
+        if array_job_id is not None:
+            running_tasks[array_job_id] = running_tasks.get(array_job_id,0) + 1
+
+
+# ===============================================================================================
+# formats
+# ===============================================================================================
+
+def parse_time_limit(val):
+    """
+    SLURM time: minutes, MM:SS, HH:MM:SS, D-HH, D-HH:MM or D-HH:MM:SS -> minutes
+    """
+    days = 0
+    if '-' in val:
+        days,val = val.split('-',1)
+        parts = [int(elem) for elem in val.split(':')] + [0,0]
+        return int(days)*24*60 + parts[0]*60 + parts[1] + parts[2]/60
+    parts = [int(elem) for elem in val.split(':')]
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) == 2:
+        return parts[0] + parts[1]/60
+    return parts[0]*60 + parts[1] + parts[2]/60
+
+
+def parse_mem(val):
+    """
+    SLURM memory, e.g. 2000, 2000MB, 2G -> Mb
+    """
+    match = re.match(r'([\d.]+)\s*([KMGT]?)B?',val,re.IGNORECASE)
+    multiplier = {'':1,'K':1/1024,'M':1,'G':1024,'T':1024**2}
+    return float(match.group(1))*multiplier[match.group(2).upper()]
+
+
+def format_elapsed(seconds):
+    seconds = int(max(0,seconds))
+    days,seconds = divmod(seconds,86400)
+    hours,seconds = divmod(seconds,3600)
+    minutes,seconds = divmod(seconds,60)
+    if days > 0:
+        return '%d-%02d:%02d:%02d' % (days,hours,minutes,seconds)
+    return '%02d:%02d:%02d' % (hours,minutes,seconds)
+
+
+def format_squeue_time(seconds):
+    seconds = int(max(0,seconds))
+    days,seconds = divmod(seconds,86400)
+    hours,seconds = divmod(seconds,3600)
+    minutes,seconds = divmod(seconds,60)
+    if days > 0:
+        return '%d-%02d:%02d:%02d' % (days,hours,minutes,seconds)
+    if hours > 0:
+        return '%d:%02d:%02d' % (hours,minutes,seconds)
+    return '%d:%02d' % (minutes,seconds)
+
+
+def format_timestamp(epoch):
+    if epoch is None:
+        return 'Unknown'
+    return datetime.datetime.fromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def parse_timestamp(val):
+    for time_format in ['%Y-%m-%dT%H:%M:%S','%Y-%m-%dT%H:%M','%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(val,time_format).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'invalid time {val}')
+
+
+def format_size(num_bytes):
+    for unit in ['k','M','G','T','P']:
+        num_bytes /= 1024
+        if num_bytes < 1024 or unit == 'P':
+            return '%.4g%s' % (num_bytes,unit)
+
+
+def display_job_id(job):
+    return job['job_id']
+
+
+def elapsed_seconds(job,config,now):
+    if job['start_time'] is None:
+        return 0
+    end = job['end_time'] if job['end_time'] is not None else now
+    return (end - job['start_time'])*float(config['time_scale'])
+
+
+# ===============================================================================================
+# commands
+# ===============================================================================================
+
+def read_sbatch_options(script_path):
+    """
+    #SBATCH lines of a script as (option, value) pairs.
+    """
+    options = []
+    with open(script_path) as fp:
+        for line in fp:
+            if not line.startswith('#SBATCH'):
+                continue
+            option = line[len('#SBATCH'):].strip()
+            if '=' in option.split()[0]:
+                key,val = option.split('=',1)
+            elif ' ' in option:
+                key,val = option.split(None,1)
+            else:
+                key,val = option,''
+            options += [(key.strip(),val.strip())]
+    return options
+
+
+def sbatch(args):
+    parser = argparse.ArgumentParser(prog='sbatch')
+    parser.add_argument('--parsable',action='store_true')
+    parser.add_argument('script')
+    args = parser.parse_args(args)
+    if not os.path.exists(args.script):
+        sys.stderr.write(f'sbatch: error: Unable to open file {args.script}\n')
+        return 1
+
+    settings = {'name':os.path.basename(args.script),'partition':'serial_requeue','time_limit':60,'mem_mb':1000,'cpus':1,'log':'','array':None}
+    for key,val in read_sbatch_options(args.script):
+        if key in ['--job-name','-J']:
+            settings['name'] = val
+        elif key in ['--partition','-p']:
+            settings['partition'] = val
+        elif key in ['--time','-t']:
+            settings['time_limit'] = parse_time_limit(val)
+        elif key == '--mem':
+            settings['mem_mb'] = parse_mem(val)
+        elif key in ['-n','--ntasks','-c','--cpus-per-task']:
+            settings['cpus'] = max(settings['cpus'],int(val))
+        elif key in ['-o','--output']:
+            settings['log'] = val
+        elif key in ['--array','-a']:
+            settings['array'] = val
+
+    with locked_state() as (state,config):
+        job_id = state['next_job_id']
+        state['next_job_id'] += 1
+        now = time.time()
+        base = {'name':settings['name'], 'partition':settings['partition'], 'user':USER, 'state':'PENDING',
+            'submit_time':now, 'start_time':None, 'end_time':None, 'time_limit':settings['time_limit'],
+            'mem_mb':settings['mem_mb'], 'cpus':settings['cpus'], 'script':os.path.abspath(args.script), 'log':settings['log'],
+            'cwd':os.getcwd(), 'exit_code':'0:0', 'array_job_id':None, 'array_task_id':None, 'array_limit':None}
+        if settings['array'] is None:
+            state['jobs'][str(job_id)] = dict(base, job_id=str(job_id))
+        else:
+            match = re.match(r'(\d+)-(\d+)(?:%(\d+))?',settings['array'])
+            first,last,limit = int(match.group(1)),int(match.group(2)),match.group(3)
+            for task in range(first,last+1):
+                task_id = f'{job_id}_{task}'
+                state['jobs'][task_id] = dict(base, job_id=task_id, array_job_id=str(job_id), array_task_id=task,
+                    array_limit=int(limit) if limit else None)
+
+    if args.parsable:
+        print(job_id)
+    else:
+        print(f'Submitted batch job {job_id}')
+    return 0
+
+
+def squeue_header(format_str):
+    return re.sub(r'%\.?\d*([a-zA-Z])', lambda match: SQUEUE_FIELDS.get(match.group(1),match.group(1).upper()), format_str)
+
+
+def squeue_row(format_str,job,config,now):
+    values = {'i':display_job_id(job), 'j':job['name'], 'P':job['partition'], 'u':job['user'], 'T':job['state'],
+        't':{'PENDING':'PD','RUNNING':'R'}.get(job['state'],job['state']),
+        'M':format_squeue_time(elapsed_seconds(job,config,now)), 'm':'%dM' % job['mem_mb'],
+        'N':NODE if job['state'] == 'RUNNING' else '', 'C':str(job['cpus']), 'l':format_squeue_time(job['time_limit']*60),
+        'a':USER, 'A':job['array_job_id'] or job['job_id'], 'K':str(job['array_task_id']) if job['array_task_id'] is not None else 'N/A'}
+    return re.sub(r'%\.?\d*([a-zA-Z])', lambda match: values.get(match.group(1),''), format_str)
+
+
+def collapse_pending_tasks(jobs):
+    """
+    Without -r squeue shows the pending tasks of an array as one line, e.g. 1000_[2-5].
+    """
+    collapsed = []
+    pending_arrays = {}
+    for job in jobs:
+        if job['state'] == 'PENDING' and job['array_job_id'] is not None:
+            if job['array_job_id'] not in pending_arrays:
+                pending_arrays[job['array_job_id']] = dict(job, tasks=[])
+                collapsed += [pending_arrays[job['array_job_id']]]
+            pending_arrays[job['array_job_id']]['tasks'] += [job['array_task_id']]
+        else:
+            collapsed += [job]
+    for job in pending_arrays.values():
+        tasks = job['tasks']
+        job['job_id'] = f"{job['array_job_id']}_[{tasks[0]}-{tasks[-1]}]" if len(tasks) > 1 else f"{job['array_job_id']}_{tasks[0]}"
+    return collapsed
+
+
+def squeue(args):
+    parser = argparse.ArgumentParser(prog='squeue',add_help=False)
+    parser.add_argument('-r','--array',dest='array',action='store_true')
+    parser.add_argument('-A','--account',dest='account',default=None)
+    parser.add_argument('-u','--user',dest='user',default=None)
+    parser.add_argument('-o','--format',dest='format',default='%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R')
+    parser.add_argument('-h','--noheader',dest='noheader',action='store_true')
+    args = parser.parse_args(args)
+
+    with locked_state() as (state,config):
+        now = time.time()
+        jobs = [job for job in sorted_jobs(state) if job['state'] in ACTIVE_STATES]
+        if not args.array:
+            jobs = collapse_pending_tasks(jobs)
+        lines = [] if args.noheader else [squeue_header(args.format)]
+        lines += [squeue_row(args.format,job,config,now) for job in jobs]
+    print('\n'.join(lines))
+    return 0
+
+
+def sacct_values(job,config,now,step=None):
+    elapsed = elapsed_seconds(job,config,now)
+    values = {'JobID':display_job_id(job), 'JobName':job['name'], 'Partition':job['partition'], 'Account':USER, 'User':job['user'],
+        'State':job['state'], 'ExitCode':job['exit_code'], 'Elapsed':format_elapsed(elapsed), 'ElapsedRaw':str(int(elapsed)),
+        'Timelimit':format_elapsed(job['time_limit']*60), 'ReqMem':'%dM' % job['mem_mb'], 'MaxRSS':'',
+        'AllocCPUS':str(job['cpus']), 'ReqCPUS':str(job['cpus']), 'NodeList':NODE if job['start_time'] else 'None assigned',
+        'Submit':format_timestamp(job['submit_time']), 'Start':format_timestamp(job['start_time']), 'End':format_timestamp(job['end_time']),
+        'TotalCPU':format_elapsed(elapsed*job['cpus']*0.9), 'CPUTimeRAW':str(int(elapsed*job['cpus']))}
+    if job['state'] == 'CANCELLED':
+        values['State'] = f'CANCELLED by {os.getuid()}'
+    if step is not None:
+        values['JobID'] = f"{values['JobID']}.{step}"
+        values['JobName'] = step
+        values['Partition'] = ''
+        values['User'] = ''
+        values['ReqMem'] = ''
+        values['Timelimit'] = ''
+        if step == 'batch':
+            values['MaxRSS'] = '%dK' % (job.get('max_rss_mb',0)*1024)
+            if job['state'] in ['OUT_OF_MEMORY','TIMEOUT','PREEMPTED','CANCELLED']:
+                values['State'] = 'CANCELLED' if job['state'] != 'OUT_OF_MEMORY' else 'OUT_OF_MEMORY'
+        else:
+            values['State'] = 'COMPLETED' if job['state'] != 'RUNNING' else 'RUNNING'
+            values['ExitCode'] = '0:0'
+    return values
+
+
+def sacct(args):
+    parser = argparse.ArgumentParser(prog='sacct')
+    parser.add_argument('-A','--account',dest='account',default=None)
+    parser.add_argument('-o','--format',dest='format',default='JobID,JobName,Partition,Account,AllocCPUS,State,ExitCode')
+    parser.add_argument('-j','--jobs',dest='jobs',default=None)
+    parser.add_argument('-S','--starttime',dest='starttime',default=None)
+    parser.add_argument('-E','--endtime',dest='endtime',default=None)
+    parser.add_argument('-X','--allocations',dest='allocations',action='store_true')
+    parser.add_argument('-P','--parsable2',dest='parsable2',action='store_true')
+    parser.add_argument('-p','--parsable',dest='parsable',action='store_true')
+    parser.add_argument('-n','--noheader',dest='noheader',action='store_true')
+    parser.add_argument('-s','--state',dest='state',default=None)
+    args = parser.parse_args(args)
+
+    fields = []
+    for field in args.format.split(','):
+        name,width = (field.split('%') + [''])[:2]
+        fields += [(name, int(width) if width else 20)]
+
+    with locked_state() as (state,config):
+        now = time.time()
+        # by default sacct reports jobs since midnight
+        starttime = parse_timestamp(args.starttime) if args.starttime else datetime.datetime.combine(datetime.date.today(),datetime.time()).timestamp()
+        endtime = parse_timestamp(args.endtime) if args.endtime else math.inf
+        selected_ids = set(args.jobs.split(',')) if args.jobs else None
+        selected_states = set(args.state.upper().split(',')) if args.state else None
+        rows = []
+        for job in sorted_jobs(state):
+            if selected_ids is not None and job['job_id'] not in selected_ids and job['array_job_id'] not in selected_ids:
+                continue
+            if selected_states is not None and job['state'] not in selected_states:
+                continue
+            # jobs that were eligible during the window
+            if (job['end_time'] is not None and job['end_time'] < starttime) or job['submit_time'] > endtime:
+                continue
+            rows += [sacct_values(job,config,now)]
+            if not args.allocations and job['start_time'] is not None:
+                rows += [sacct_values(job,config,now,step='batch'), sacct_values(job,config,now,step='extern')]
+
+    names = [name for name,width in fields]
+    if args.parsable2 or args.parsable:
+        end = '|' if args.parsable else ''
+        lines = [] if args.noheader else ['|'.join(names) + end]
+        lines += ['|'.join([row.get(name,'') for name in names]) + end for row in rows]
+    else:
+        def fixed(val,width):
+            val = val if len(val) <= width else val[:width-1] + '+'
+            return val.rjust(width)
+        lines = []
+        if not args.noheader:
+            lines += [' '.join([fixed(name,width) for name,width in fields])]
+            lines += [' '.join(['-'*width for name,width in fields])]
+        lines += [' '.join([fixed(row.get(name,''),width) for name,width in fields]) for row in rows]
+    print('\n'.join(lines))
+    return 0
+
+
+def scancel(args):
+    parser = argparse.ArgumentParser(prog='scancel')
+    parser.add_argument('-n','--name',dest='name',default=None)
+    parser.add_argument('job_ids',nargs='*')
+    args = parser.parse_args(args)
+    with locked_state() as (state,config):
+        now = time.time()
+        for job in state['jobs'].values():
+            if job['state'] not in ACTIVE_STATES:
+                continue
+            selected = (args.name is not None and job['name'] == args.name)
+            selected = selected or job['job_id'] in args.job_ids or job['array_job_id'] in args.job_ids
+            if selected:
+                kill_job(job)
+                finish_job(job,'CANCELLED',now)
+    return 0
+
+
+def scontrol(args):
+    """
+    Supports: scontrol update JobId=ID JobName=NAME
+    """
+    if len(args) == 0 or args[0] != 'update':
+        sys.stderr.write('scontrol: only "update JobId=.. JobName=.." is supported\n')
+        return 1
+    settings = dict([arg.split('=',1) for arg in args[1:] if '=' in arg])
+    with locked_state() as (state,config):
+        job = state['jobs'].get(settings.get('JobId',''))
+        if job is None:
+            sys.stderr.write('slurm_update error: Invalid job id specified\n')
+            return 1
+        if 'JobName' in settings:
+            job['name'] = settings['JobName']
+    return 0
+
+
+def sshare(args):
+    parser = argparse.ArgumentParser(prog='sshare')
+    parser.add_argument('-A','--account',dest='account',default=USER)
+    parser.add_argument('-o','--format',dest='format',default='Account,User,RawShares,NormShares,RawUsage,EffectvUsage,FairShare')
+    parser.add_argument('-P','--parsable2',dest='parsable2',action='store_true')
+    parser.add_argument('-n','--noheader',dest='noheader',action='store_true')
+    args = parser.parse_args(args)
+    with locked_state() as (state,config):
+        fairshare = config['fairshare']
+        norm_shares = float(fairshare['norm_shares'])
+        effective_usage = state['usage']/float(fairshare['cluster_cpu_seconds'])
+        factor = 2**(-effective_usage/norm_shares)
+        raw_usage = int(state['usage'])
+    account_line = {'Account':args.account, 'User':'', 'RawShares':'1', 'NormShares':'%.6f' % norm_shares, 'RawUsage':str(raw_usage),
+        'EffectvUsage':'%.6f' % effective_usage, 'FairShare':'%.6f' % factor}
+    user_line = dict(account_line, User=USER, RawShares='parent')
+    names = args.format.split(',')
+    rows = [account_line,user_line]
+    if args.parsable2:
+        lines = [] if args.noheader else ['|'.join(names)]
+        lines += ['|'.join([row.get(name,'') for name in names]) for row in rows]
+    else:
+        lines = [] if args.noheader else [' '.join([name.rjust(12) for name in names]), ' '.join(['-'*12 for name in names])]
+        lines += [' '.join([row.get(name,'').rjust(12) for name in names]) for row in rows]
+    print('\n'.join(lines))
+    return 0
+
+
+def sinfo(args):
+    """
+    One node of node_cpus cores in every partition, its cores allocated to the running jobs.
+    """
+    parser = argparse.ArgumentParser(prog='sinfo',add_help=False)
+    parser.add_argument('-p','--partition',dest='partition',default='serial_requeue')
+    parser.add_argument('-N','--Node',dest='node',action='store_true')
+    parser.add_argument('-o','--format',dest='format',default='%P %C')
+    parser.add_argument('-h','--noheader',dest='noheader',action='store_true')
+    args = parser.parse_args(args)
+    with locked_state() as (state,config):
+        total = int(config['node_cpus'])
+        allocated = min(total,sum([job['cpus'] for job in state['jobs'].values() if job['state'] == 'RUNNING']))
+    values = {'n':NODE, 'N':NODE, 'P':args.partition, 'c':str(total), 'C':f'{allocated}/{total-allocated}/0/{total}', 'a':'up'}
+    lines = [] if args.noheader else [re.sub(r'%\.?\d*([a-zA-Z])', lambda match: {'n':'NODELIST','N':'NODELIST','P':'PARTITION',
+        'c':'CPUS','C':'CPUS(A/I/O/T)','a':'AVAIL'}.get(match.group(1),match.group(1).upper()), args.format)]
+    lines += [re.sub(r'%\.?\d*([a-zA-Z])', lambda match: values.get(match.group(1),''), args.format)]
+    print('\n'.join(lines))
+    return 0
+
+
+def directory_size(path):
+    size = 0
+    for root,dirs,files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root,name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def lfs(args):
+    """
+    Supports: lfs quota -hg GROUP PATH
+    """
+    if len(args) < 3 or args[0] != 'quota':
+        sys.stderr.write('lfs: only "quota -hg GROUP PATH" is supported\n')
+        return 1
+    group,path = args[-2],args[-1]
+    config = read_config()
+    scratch_path = config['scratch_path'] or path
+    used = directory_size(scratch_path) if os.path.exists(scratch_path) else 0
+    quota = parse_mem(config['scratch_quota'])*1024**2
+    print(f'Disk quotas for grp {group} (gid {os.getgid()}):')
+    print('     Filesystem    used   quota   limit   grace   files   quota   limit   grace')
+    print(f'{path}')
+    print(f'                {format_size(used)}  {format_size(quota)}  {format_size(quota)}       -       0       0       0       -')
+    return 0
+
+
+# ===============================================================================================
+# install
+# ===============================================================================================
+
+def install(bin_path,home,config_path=None):
+    """
+    Write shims for the SLURM and lfs commands to bin_path.
+    """
+    os.makedirs(bin_path,exist_ok=True)
+    os.makedirs(home,exist_ok=True)
+    script = os.path.abspath(__file__)
+    for command in COMMANDS:
+        shim_path = os.path.join(bin_path,command)
+        with open(shim_path,'w') as fp:
+            fp.write(f'#!/bin/sh\nexport {HOME_ENV}="${{{HOME_ENV}:-{os.path.abspath(home)}}}"\nexec {sys.executable} {script} {command} "$@"\n')
+        os.chmod(shim_path,0o755)
+    if config_path is not None:
+        with open(config_path) as fp:
+            config = json.load(fp)
+        with open(os.path.join(home,'config.json'),'w') as fp:
+            json.dump(config,fp,indent=2)
+
+
+COMMAND_FUNCTIONS = {'sbatch':sbatch,'squeue':squeue,'sacct':sacct,'scancel':scancel,'scontrol':scontrol,'sshare':sshare,'sinfo':sinfo,'lfs':lfs}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMAND_FUNCTIONS:
+        sys.exit(COMMAND_FUNCTIONS[sys.argv[1]](sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description="""Local stand-in for SLURM and lfs commands""")
+    subparsers = parser.add_subparsers(dest='action')
+    install_parser = subparsers.add_parser('install', help='write command shims')
+    install_parser.add_argument('--bin', dest='bin_path', type=str, required=True, help='directory for the command shims, put it first in PATH')
+    install_parser.add_argument('--home', dest='home', type=str, required=True, help='directory for the job state')
+    install_parser.add_argument('--config', dest='config_path', type=str, default=None, help='JSON config file')
+    subparsers.add_parser('status', help='print job counts by state')
+    args = parser.parse_args()
+
+    if args.action == 'install':
+        install(args.bin_path,args.home,args.config_path)
+        print(f'export PATH={os.path.abspath(args.bin_path)}:$PATH')
+    elif args.action == 'status':
+        with locked_state() as (state,config):
+            counts = {}
+            for job in state['jobs'].values():
+                counts[job['state']] = counts.get(job['state'],0) + 1
+        print(counts)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
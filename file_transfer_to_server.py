@@ -260,18 +260,40 @@ def transfer_to_server(sample_id,attempts=5):
     return status
 
 
-def write_transfer_ok_file(sample_id, backup=False):
+def transfer_size(sample_id):
+    """
+    Bytes of the result files sent by transfer_to_server.
+    """
+    result_path = os.path.join( Config.data_collection_runs, sample_id, Config.cistrome_result )
+    size = 0
+    for path in [f'{sample_id}.md5', f'{sample_id}_status.json']:
+        if os.path.isfile(os.path.join(result_path,path)):
+            size += os.path.getsize(os.path.join(result_path,path))
+    for dirpath,dirnames,filenames in os.walk(os.path.join(result_path,sample_id)):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath,filename))
+            except OSError:
+                pass
+    return size
+
+
+def write_transfer_ok_file(sample_id, backup=False, stats=None):
     """
     The existence of these files indicates the file transfer is complete.
     args:
        backup: indictates if the transfer was a backup. 
+       stats: transfer statistics written to the file, e.g. {'server':.., 'bytes':.., 'seconds':..}, 
+           read by the scheduler for its transfer metrics.
     """
     sample_path = os.path.join( Config.data_collection_runs, sample_id )
     if backup:
         transfer_ok = os.path.join( sample_path,f'{sample_id}_backup_ok.txt' )
     else:
         transfer_ok = os.path.join( sample_path,f'{sample_id}_rsync_ok.txt' )
-    subprocess.call(f'touch {transfer_ok}',shell=True)
+    with open(transfer_ok,'w') as fp:
+        if stats is not None:
+            json.dump(stats,fp)
  
 
 def main():
@@ -286,9 +308,11 @@ def main():
         args = parser.parse_args()
         Config.read_config(args.config,args.server)
 
+        start = time.time()
         transfer_succeeded = transfer_to_server(args.samplename,attempts=args.attempts)
         if transfer_succeeded:
-            write_transfer_ok_file(args.samplename,server=args.server, backup=args.backup)
+            stats = {'server':args.server, 'bytes':transfer_size(args.samplename), 'seconds':time.time()-start}
+            write_transfer_ok_file(args.samplename, backup=args.backup, stats=stats)
  
     except KeyboardInterrupt:
         sys.stderr.write("User interrupted me!\n")
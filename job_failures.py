@@ -0,0 +1,112 @@
+"""
+Classification of failed SRA and CHIPS jobs, and the resources of their retries.
+A job that did not complete is classified from its sacct state:
+    OUT_OF_MEMORY  killed for exceeding its memory request, retried with more memory
+    TIMEOUT        reached its time limit, retried with more time
+    PREEMPTED      preempted on a requeue partition, retried with the same request
+    NODE_FAIL      lost with its node, retried with the same request
+    ERROR          any other failure, e.g. a broken download or a CHIPS error
+Preemptions and node failures say nothing about the sample, so they do not count towards
+max_fails and do not lead to a restart from scratch or an error status.
+Each earlier out of memory (timeout) multiplies the memory (time) of the next attempt by
+retry_mem_factor (retry_time_factor), up to retry_max_mem MB (retry_max_minutes), [process_server].
+"""
+
+OUT_OF_MEMORY = 'OUT_OF_MEMORY'
+TIMEOUT       = 'TIMEOUT'
+PREEMPTED     = 'PREEMPTED'
+NODE_FAIL     = 'NODE_FAIL'
+ERROR         = 'ERROR'
+
+# sacct state: failure class
+STATE_CLASSES = {
+    'OUT_OF_MEMORY': OUT_OF_MEMORY,
+    'TIMEOUT':       TIMEOUT,
+    'DEADLINE':      TIMEOUT,
+    'PREEMPTED':     PREEMPTED,
+    'NODE_FAIL':     NODE_FAIL,
+    'BOOT_FAIL':     NODE_FAIL,
+    'FAILED':        ERROR,
+}
+
+# failures that count towards max_fails
+COUNTED_CLASSES = [OUT_OF_MEMORY, TIMEOUT, ERROR]
+
+DEFAULT_MEM_FACTOR  = 1.5
+DEFAULT_TIME_FACTOR = 1.5
+DEFAULT_MAX_MEM     = 64000   # MB
+DEFAULT_MAX_MINUTES = 3*24*60
+
+
+def classify(state):
+    """
+    Failure class of a job state, None for a job that did not fail, e.g. COMPLETED, RUNNING or CANCELLED.
+    """
+    if not isinstance(state,str) or state == '':
+        return None
+    # e.g. CANCELLED by 1234
+    return STATE_CLASSES.get(state.split()[0])
+
+
+def counts_as_failure(state):
+    return classify(state) in COUNTED_CLASSES
+
+
+def count_failures(jobs):
+    """
+    Failures counting towards max_fails among the jobs of a sample, {job_id: state}.
+    """
+    if not isinstance(jobs,dict):
+        return 0
+    return len([state for state in jobs.values() if counts_as_failure(state)])
+
+
+def count_attempts(jobs):
+    """
+    Jobs of a sample, {job_id: state}, that were not preempted or lost with their node.
+    """
+    if not isinstance(jobs,dict):
+        return 0
+    return len([state for state in jobs.values() if classify(state) not in [PREEMPTED,NODE_FAIL]])
+
+
+class RetryPolicy():
+
+    def __init__(self,sys_config):
+        """
+        args:
+           - sys_config: pipeline config, settings are read from [process_server]
+        """
+        conf = sys_config['process_server']
+        self.mem_factor  = float(conf.get('retry_mem_factor',DEFAULT_MEM_FACTOR))
+        self.time_factor = float(conf.get('retry_time_factor',DEFAULT_TIME_FACTOR))
+        self.max_mem     = float(conf.get('retry_max_mem',DEFAULT_MAX_MEM))
+        self.max_minutes = float(conf.get('retry_max_minutes',DEFAULT_MAX_MINUTES))
+
+
+    def escalation(self,jobs):
+        """
+        Factors for the memory and time of the next attempt of a sample.
+        args:
+           - jobs: earlier jobs of one type of the sample, {job_id: state}
+        returns:
+           - (memory factor, time factor)
+        """
+        if not isinstance(jobs,dict):
+            return 1.0,1.0
+        classes = [classify(state) for state in jobs.values()]
+        return self.mem_factor**classes.count(OUT_OF_MEMORY), self.time_factor**classes.count(TIMEOUT)
+
+
+    def scaled_mem(self,mem,factor):
+        """
+        Memory request in MB times factor, not above retry_max_mem unless the request already is.
+        """
+        return int(min(mem*factor,max(mem,self.max_mem)))
+
+
+    def scaled_time(self,minutes,factor):
+        """
+        Time request in minutes times factor, not above retry_max_minutes unless the request already is.
+        """
+        return int(min(minutes*factor,max(minutes,self.max_minutes)))
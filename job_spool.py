@@ -0,0 +1,246 @@
+"""
+Completion records of the pipeline jobs, written by the jobs themselves to a spool directory.
+The sbatch scripts install an EXIT trap (spool_trap_cmd) that writes one JSON file per job when
+the script ends, whether it succeeds, fails, is killed for memory or is cancelled at its time limit:
+    {"job_id": "123_4", "sample_id": "GSM1234567", "job_type": "sra", "exit_code": 0,
+     "runtime": 612, "max_rss": 2147483648, "end_time": 1700000000}
+max_rss is the peak memory of the job cgroup in bytes, null where the cgroup is not readable.
+The scheduler consumes the spool incrementally, a record file is only removed once the scheduler processed it: the directory is watched with inotify where
+available, and otherwise, or in addition on network file systems that do not report changes
+made on other nodes, its mtime is checked every scan interval and it is only listed when it changed.
+
+The spool directory is [paths] job_spool, by default {data_collection_root}/job_spool.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import threading
+import time
+import traceback
+
+DEFAULT_SCAN_INTERVAL = 5 # seconds between checks of the spool directory
+
+RECORD_SUFFIX = '.json'
+
+# inotify events of a record file moved into the directory
+IN_MOVED_TO    = 0x00000080
+IN_CLOSE_WRITE = 0x00000008
+IN_NONBLOCK    = 0x00000800
+
+
+def get_spool_path(sys_config):
+    paths = sys_config['paths']
+    if 'job_spool' in paths:
+        return paths['job_spool']
+    return os.path.join(paths['data_collection_root'],'job_spool')
+
+
+def spool_trap_cmd(spool_dir,job_type,sample_id='${SAMPLE_ID}'):
+    """
+    Bash lines that make an sbatch script write its completion record when it exits.
+    The record is written to a temporary name and renamed, so the scheduler never reads a partial record.
+    args:
+       - spool_dir: spool directory
+       - job_type: e.g. sra, chips
+       - sample_id: sample id or shell expression, by default $SAMPLE_ID of an array task
+    """
+    lines = [
+        'cistrome_peak_rss() {',
+        '    local id controllers path',
+        '    while IFS=: read -r id controllers path; do',
+        '        if [ "$controllers" = "memory" ] && [ -r "/sys/fs/cgroup/memory$path/memory.max_usage_in_bytes" ]; then',
+        '            cat "/sys/fs/cgroup/memory$path/memory.max_usage_in_bytes"; return',
+        '        elif [ "$id" = "0" ] && [ -r "/sys/fs/cgroup$path/memory.peak" ]; then',
+        '            cat "/sys/fs/cgroup$path/memory.peak"; return',
+        '        fi',
+        '    done < /proc/self/cgroup 2>/dev/null',
+        '    echo null',
+        '}',
+        'cistrome_spool_record() {',
+        '    local exit_code=$?',
+        '    local job_id=${SLURM_ARRAY_JOB_ID:+${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}}',
+        '    job_id=${job_id:-${SLURM_JOB_ID}}',
+        f'    mkdir -p {spool_dir}',
+        f'    local record={spool_dir}/${{job_id}}',
+        '    printf \'{"job_id": "%s", "sample_id": "%s", "job_type": "%s", "exit_code": %d, "runtime": %d, "max_rss": %s, "end_time": %d}\\n\' \\',
+        f'        "$job_id" "{sample_id}" "{job_type}" "$exit_code" "$SECONDS" "$(cistrome_peak_rss)" "$(date +%s)" > "$record.tmp" \\',
+        f'        && mv "$record.tmp" "$record{RECORD_SUFFIX}"',
+        '}',
+        'trap cistrome_spool_record EXIT',
+        # SLURM signals the time limit and cancellations with SIGTERM, exit so that the trap runs
+        "trap 'exit 143' TERM",
+        '',
+    ]
+    return '\n'.join(lines)
+
+
+def read_record(path):
+    """
+    A completion record, None if it can not be read.
+    """
+    try:
+        with open(path,'r') as fp:
+            record = json.load(fp)
+        return record if isinstance(record,dict) and 'job_id' in record else None
+    except (OSError,ValueError):
+        return None
+
+
+def remove_record(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Inotify():
+    """
+    Minimal inotify watch of one directory through libc, None from create() where inotify is not available.
+    """
+
+    def __init__(self,libc,fd):
+        self.libc = libc
+        self.fd = fd
+
+    @classmethod
+    def create(cls,path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd,os.fsencode(path),IN_MOVED_TO|IN_CLOSE_WRITE) < 0:
+                os.close(fd)
+                return None
+            return cls(libc,fd)
+        except (OSError,AttributeError,TypeError):
+            return None
+
+
+    def wait(self,timeout):
+        """
+        Wait up to timeout seconds for a change, returns True if there was one.
+        """
+        readable,_,_ = select.select([self.fd],[],[],timeout)
+        if len(readable) == 0:
+            return False
+        try:
+            while len(os.read(self.fd,4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JobSpool():
+
+    def __init__(self,spool_dir):
+        self.spool_dir = spool_dir
+        self.mtime = None
+        self.listed_at = None
+        self.collected = [] # record files returned by collect and not yet removed by acknowledge
+        os.makedirs(spool_dir,exist_ok=True)
+
+
+    def changed(self):
+        """
+        True if the spool directory may have changed since it was last listed.
+        """
+        try:
+            mtime = os.stat(self.spool_dir).st_mtime
+        except FileNotFoundError:
+            return False
+        # records collected but not acknowledged are collected again
+        if len(self.collected) > 0:
+            return True
+        # a listing taken in the same second as the last change may have missed a record
+        return self.mtime is None or mtime != self.mtime or self.listed_at - mtime <= 2
+
+
+    def collect(self):
+        """
+        Read the completion records in the spool. The record files are kept until acknowledge is called, 
+        so records that could not be processed are collected again.
+        returns:
+           - list of records, ordered by end time
+        """
+        if not self.changed():
+            return []
+        self.mtime = os.stat(self.spool_dir).st_mtime
+        self.listed_at = time.time()
+        records = []
+        self.collected = []
+        with os.scandir(self.spool_dir) as entries:
+            paths = [entry.path for entry in entries if entry.name.endswith(RECORD_SUFFIX)]
+        for path in paths:
+            record = read_record(path)
+            if record is not None:
+                records += [record]
+                self.collected += [path]
+            else:
+                remove_record(path)
+        return sorted(records,key=lambda record: record.get('end_time') or 0)
+
+
+    def acknowledge(self):
+        """
+        Remove the record files of the last collect, once their records were processed.
+        """
+        for path in self.collected:
+            remove_record(path)
+        self.collected = []
+
+
+class JobSpoolWatcher():
+    """
+    Background thread passing new completion records to a callback.
+    """
+
+    def __init__(self,spool,on_records,scan_interval=DEFAULT_SCAN_INTERVAL):
+        """
+        args:
+           - spool: JobSpool
+           - on_records: function(records) called with each batch of new records, 
+             if it raises the batch is passed again at the next check
+           - scan_interval: longest time between checks of the directory
+        """
+        self.spool = spool
+        self.on_records = on_records
+        self.scan_interval = scan_interval
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        inotify = Inotify.create(self.spool.spool_dir)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    records = self.spool.collect()
+                    if len(records) > 0:
+                        self.on_records(records)
+                    self.spool.acknowledge()
+                except Exception:
+                    print('job spool failed')
+                    traceback.print_exc()
+                if inotify is not None:
+                    inotify.wait(self.scan_interval)
+                else:
+                    self.stopped.wait(self.scan_interval)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+    def start(self):
+        threading.Thread(target=self.run,daemon=True).start()
+
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,229 @@
+"""
+Persistent cache of the states of the pipeline jobs on the cluster.
+Each poll asks sacct only for jobs since the previous poll (--starttime, with a small overlap
+for records sacct writes late) in --parsable2 format and merges them into the jobs table of
+the sample queue database:
+    job_id -> sample_id, job_type, state, exit_code, max_rss (bytes), elapsed (seconds), start_time, end_time,
+              req_mem (bytes), timelimit (seconds), cpus
+Job steps only carry the peak memory, it is added to the job they belong to, and a FAILED job
+with a step killed for memory is recorded as OUT_OF_MEMORY.
+The scheduler updates the sample queue from the jobs whose state changed, in one pass.
+A poll where sacct fails is not recorded, the next poll reaches back to the last one that succeeded.
+
+To print the cached jobs of a sample:
+    python job_state_cache.py -c config/rc-fas-harvard.conf -i GSM1234567
+"""
+
+import argparse
+import configparser
+import math
+import re
+import sqlite3
+import threading
+import time
+
+import cluster_stats
+import sample_queue_store
+
+DEFAULT_LOOKBACK = 86400 # seconds of history read on the first poll
+POLL_OVERLAP = 300       # seconds each poll reaches back before the previous one
+
+# pipeline jobs are named {sample id}_{job type}
+JOB_NAME_PATTERN = re.compile(r'([a-zA-Z0-9]+)_(sra|chips_check|chips)\Z')
+
+COLUMNS = ['job_id','sample_id','job_type','state','exit_code','max_rss','elapsed','start_time','end_time','req_mem','timelimit','cpus']
+
+# columns added after the jobs table was first created
+ADDED_COLUMNS = {'req_mem':'REAL', 'timelimit':'REAL', 'cpus':'INTEGER'}
+
+
+def parse_max_rss(val):
+    """
+    sacct MaxRSS or ReqMem, e.g. 1234K or 16000M, to bytes, None when empty.
+    """
+    size = cluster_stats.replace_multiplier(val) if val else math.nan
+    return None if math.isnan(size) else size
+
+
+def jobs_from_records(records):
+    """
+    Merge sacct records of jobs and their steps into pipeline jobs.
+    returns:
+       - {job_id: {column: value}}, jobs that are not pipeline jobs are left out
+    """
+    jobs = {}
+    step_rss = {}
+    step_oom = set()
+    for record in records:
+        job_id,dot,step = record['JobID'].partition('.')
+        if dot:
+            max_rss = parse_max_rss(record['MaxRSS'])
+            if max_rss is not None:
+                step_rss[job_id] = max(max_rss,step_rss.get(job_id,0))
+            if record['State'] == 'OUT_OF_MEMORY':
+                step_oom.add(job_id)
+            continue
+        match = JOB_NAME_PATTERN.match(record['JobName'])
+        if match is None:
+            continue
+        jobs[job_id] = {'job_id':job_id, 'sample_id':match.group(1), 'job_type':match.group(2),
+            # e.g. CANCELLED by 1234
+            'state':record['State'].split()[0] if record['State'] else '',
+            'exit_code':record['ExitCode'], 'max_rss':parse_max_rss(record['MaxRSS']),
+            'elapsed':cluster_stats.parse_sacct_elapsed(record['Elapsed']),
+            'start_time':cluster_stats.parse_sacct_time(record['Start']), 'end_time':cluster_stats.parse_sacct_time(record['End']),
+            # None for UNLIMITED
+            'req_mem':parse_max_rss(record['ReqMem']), 'timelimit':cluster_stats.parse_sacct_elapsed(record['Timelimit']),
+            'cpus':int(record['AllocCPUS']) if record['AllocCPUS'].isdigit() else None}
+    for job_id,max_rss in step_rss.items():
+        if job_id in jobs:
+            jobs[job_id]['max_rss'] = max(max_rss,jobs[job_id]['max_rss'] or 0)
+    # a batch script that goes on after a step was killed for memory ends as FAILED
+    for job_id in step_oom:
+        if job_id in jobs and jobs[job_id]['state'] == 'FAILED':
+            jobs[job_id]['state'] = 'OUT_OF_MEMORY'
+    return jobs
+
+
+class JobStateCache():
+
+    def __init__(self,db_path,cluster_status,clock=time.time,lookback=DEFAULT_LOOKBACK):
+        """
+        args:
+           - db_path: SQLite database, the sample queue database
+           - cluster_status: provides get_account_records, e.g. the cluster snapshot
+           - clock: time source, epoch seconds
+           - lookback: seconds of history read on the first poll
+        """
+        self.db_path = db_path
+        self.cluster_status = cluster_status
+        self.clock = clock
+        self.lookback = lookback
+        self.poll_lock = threading.Lock()
+        self.local = threading.local()
+        self.create_tables()
+
+
+    def connection(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=sample_queue_store.TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+
+    def create_tables(self):
+        conn = self.connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            job_id     TEXT PRIMARY KEY,
+            sample_id  TEXT NOT NULL,
+            job_type   TEXT NOT NULL,
+            state      TEXT,
+            exit_code  TEXT,
+            max_rss    REAL,
+            elapsed    REAL,
+            start_time REAL,
+            end_time   REAL,
+            req_mem    REAL,
+            timelimit  REAL,
+            cpus       INTEGER)""")
+        existing = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+        for column,column_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_sample_id ON jobs (sample_id)')
+        conn.execute('CREATE TABLE IF NOT EXISTS job_polls (name TEXT PRIMARY KEY, time REAL NOT NULL)')
+
+
+    def last_poll(self):
+        row = self.connection().execute("SELECT time FROM job_polls WHERE name='sacct'").fetchone()
+        return None if row is None else row[0]
+
+
+    def poll(self):
+        """
+        Read the jobs since the last poll from sacct into the cache.
+        When sacct fails the time of the last poll is kept, so the next poll covers the outage.
+        returns:
+           - list of jobs, as {column: value}, that are new or changed state or start time
+        """
+        with self.poll_lock:
+            # the poll covers the jobs up to the start of the sacct call
+            now = self.clock()
+            last_poll = self.last_poll()
+            starttime = now - self.lookback if last_poll is None else last_poll - POLL_OVERLAP
+            records = self.cluster_status.get_account_records(starttime)
+            if records is None:
+                return []
+            jobs = jobs_from_records(records)
+
+            conn = self.connection()
+            changed = []
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for job_id,job in jobs.items():
+                    row = conn.execute('SELECT state, start_time FROM jobs WHERE job_id=?',(job_id,)).fetchone()
+                    if row is None or row != (job['state'],job['start_time']):
+                        changed += [job]
+                    conn.execute(f'INSERT INTO jobs ({",".join(COLUMNS)}) VALUES ({",".join("?"*len(COLUMNS))}) '
+                        f'ON CONFLICT(job_id) DO UPDATE SET {",".join(f"{column}=excluded.{column}" for column in COLUMNS[1:])}',
+                        [job[column] for column in COLUMNS])
+                conn.execute("INSERT OR REPLACE INTO job_polls (name, time) VALUES ('sacct', ?)",(now,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            return changed
+
+
+    def get_jobs(self,sample_id=None,job_type=None):
+        """
+        Cached jobs, optionally of one sample and/or job type, in the order they were first seen.
+        """
+        where,params = [],[]
+        if sample_id is not None:
+            where,params = where + ['sample_id=?'],params + [sample_id]
+        if job_type is not None:
+            where,params = where + ['job_type=?'],params + [job_type]
+        sql = f'SELECT {",".join(COLUMNS)} FROM jobs'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        cursor = self.connection().execute(sql + ' ORDER BY rowid',params)
+        return [dict(zip(COLUMNS,row)) for row in cursor]
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_job_state_cache(configpath):
+    """
+    Return the job state cache shared by the stages, creating it on first use.
+    """
+    with _caches_lock:
+        if configpath not in _caches:
+            sys_conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+            sys_conf.optionxform=str
+            sys_conf.read(configpath)
+            lookback = float(sys_conf['process_server'].get('sacct_lookback',DEFAULT_LOOKBACK))
+            _caches[configpath] = JobStateCache( sample_queue_store.get_db_path(sys_conf),
+                cluster_stats.get_cluster_snapshot(configpath), lookback=lookback )
+        return _caches[configpath]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Poll sacct into the job state cache and print cached jobs""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '-i', dest='sample_id', type=str, default=None, help='only jobs of this sample')
+    parser.add_argument( '-t', dest='job_type', type=str, default=None, help='only jobs of this type, e.g. chips')
+    args = parser.parse_args()
+
+    cache = get_job_state_cache(args.configpath)
+    print(f'{len(cache.poll())} jobs changed since the last poll')
+    print('\t'.join(COLUMNS))
+    for job in cache.get_jobs(sample_id=args.sample_id,job_type=args.job_type):
+        print('\t'.join(['' if job[column] is None else str(job[column]) for column in COLUMNS]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Metrics of the scheduler in the Prometheus text format.
+The scheduler updates gauges and counters as it runs (stage passes, job submissions,
+squeue/sacct calls, transfers) and a collect function refreshes the gauges read from
+the sample queue and the cluster snapshot (queue depth, jobs per type, scratch use).
+The metrics are written to a textfile, e.g. for the node exporter textfile collector,
+and/or served on a local HTTP port, settings in [process_server]:
+    metrics_textfile = /n/holyscratch01/xiaoleliu_lab/cistrome_data_collection/metrics/cistrome_scheduler.prom
+    metrics_port     = 9108
+    metrics_host     = 127.0.0.1   address the HTTP endpoint listens on
+    metrics_interval = 60     seconds between collections
+
+To print the metrics of a running scheduler:
+    curl -s localhost:9108/metrics
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import traceback
+
+DEFAULT_INTERVAL = 60
+
+# name: (type, help)
+METRICS = {
+    'cistrome_queue_samples':                    ('gauge',   'Samples in the local queue by pipeline stage'),
+    'cistrome_jobs':                             ('gauge',   'Cluster jobs of the pipeline by job type and state'),
+    'cistrome_jobs_submitted_total':             ('counter', 'Jobs submitted by job type'),
+    'cistrome_stage_runs_total':                 ('counter', 'Stage passes, full or on ready samples'),
+    'cistrome_stage_failures_total':             ('counter', 'Stage passes that raised an exception'),
+    'cistrome_stage_duration_seconds':           ('gauge',   'Duration of the last pass of a stage'),
+    'cistrome_stage_seconds_total':              ('counter', 'Time spent in passes of a stage'),
+    'cistrome_stage_submitted':                  ('gauge',   'Samples work was submitted for in the last pass of a stage'),
+    'cistrome_stage_last_run_timestamp_seconds': ('gauge',   'End of the last pass of a stage'),
+    'cistrome_cluster_command_seconds':          ('summary', 'Latency of squeue, sacct, sshare, sinfo and lfs calls'),
+    'cistrome_scratch_used_bytes':               ('gauge',   'Scratch space used by the account'),
+    'cistrome_scratch_quota_bytes':              ('gauge',   'Scratch quota of the account'),
+    'cistrome_fairshare':                        ('gauge',   'FairShare factor of the account'),
+    'cistrome_max_jobs':                         ('gauge',   'Job caps set by the FairShare throttle'),
+    'cistrome_transfers_total':                  ('counter', 'Finished transfers by destination'),
+    'cistrome_transfer_bytes_total':             ('counter', 'Bytes transferred by destination'),
+    'cistrome_transfer_seconds_total':           ('counter', 'Time spent transferring by destination'),
+    'cistrome_transfer_bytes_per_second':        ('gauge',   'Rate of the last transfer by destination'),
+}
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    items = []
+    for key,val in labels:
+        val = str(val).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+        items += [f'{key}="{val}"']
+    return '{' + ','.join(items) + '}'
+
+
+class Metrics():
+    """
+    Thread-safe registry of metric values, keyed by name and labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # name: {labels: value}
+
+
+    def set(self,name,value,**labels):
+        with self.lock:
+            self.values.setdefault(name,{})[tuple(sorted(labels.items()))] = float(value)
+
+
+    def inc(self,name,value=1,**labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name,{})
+            series[key] = series.get(key,0.0) + float(value)
+
+
+    def observe(self,name,value,**labels):
+        """
+        Add an observation to a summary, kept as {name}_sum and {name}_count.
+        """
+        self.inc(f'{name}_sum',value,**labels)
+        self.inc(f'{name}_count',1,**labels)
+
+
+    def get(self,name,**labels):
+        with self.lock:
+            return self.values.get(name,{}).get(tuple(sorted(labels.items())))
+
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            values = {name:dict(series) for name,series in self.values.items()}
+        lines = []
+        described = set()
+        for name in sorted(values):
+            family = name
+            for suffix in ['_sum','_count']:
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                    family = name[:-len(suffix)]
+            if family not in described:
+                metric_type,help_text = METRICS.get(family,('untyped',''))
+                lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {metric_type}']
+                described.add(family)
+            for labels,value in sorted(values[name].items()):
+                lines += [f'{name}{format_labels(labels)} {value:.17g}']
+        return '\n'.join(lines) + '\n'
+
+
+    def write_textfile(self,path):
+        """
+        Write the metrics atomically, so a collector never reads a partial file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path,'w') as fp:
+            fp.write(self.render())
+        os.replace(tmp_path,path)
+
+
+_metrics = Metrics()
+
+def get_metrics():
+    """
+    The metrics registry shared by all modules of the scheduler process.
+    """
+    return _metrics
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ['/','/metrics']:
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+
+class MetricsExporter():
+
+    def __init__(self,sys_config,collect=None):
+        """
+        args:
+           - sys_config: pipeline config, settings are read from [process_server]
+           - collect: function called before each export to refresh the gauges
+        """
+        conf = sys_config['process_server']
+        self.textfile = conf.get('metrics_textfile')
+        self.port = int(conf['metrics_port']) if 'metrics_port' in conf else None
+        self.host = conf.get('metrics_host','127.0.0.1')
+        self.interval = float(conf.get('metrics_interval',DEFAULT_INTERVAL))
+        self.collect = collect
+        self.server = None
+        self.stopped = threading.Event()
+
+
+    def export(self):
+        try:
+            if self.collect is not None:
+                self.collect()
+            if self.textfile is not None:
+                get_metrics().write_textfile(self.textfile)
+        except Exception:
+            print('metrics export failed')
+            traceback.print_exc()
+
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.export()
+            self.stopped.wait(self.interval)
+
+
+    def start(self):
+        """
+        Start exporting in background threads, nothing is started if neither textfile nor port are set.
+        """
+        if self.textfile is None and self.port is None:
+            return
+        if self.port is not None:
+            self.server = ThreadingHTTPServer((self.host,self.port),MetricsHandler)
+            threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        threading.Thread(target=self.run,daemon=True).start()
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
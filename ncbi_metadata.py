@@ -0,0 +1,354 @@
+"""
+Metadata of GEO samples from NCBI: the SRA experiments (SRX) and runs (SRR) of a GSM, with the
+layout, spots and bases of each run.
+Samples are resolved in batches with the E-utilities: one esearch of the SRA for many GSMs
+(GSM1[All Fields] OR GSM2[All Fields] .., kept on the history server) and one efetch of the
+runinfo table of the hits:
+    Run, Experiment, SampleName, LibraryName, LibraryLayout, spots, bases, size_MB, ..
+GEO names the SRA sample, or the library, after the GSM; runs are assigned to the samples by that name.
+The expected size of the fastq files of a sample, before download, is 2 bytes per base (sequence and quality)
+plus two deflines of about DEFLINE_BYTES per read, each paired-end spot giving two reads; the SRA files
+are expected to be the sum of the run sizes.
+Requests are spaced to rate per second, NCBI allows 3 per second without and 10 with an API key.
+Results are kept in a SQLite cache, so a sample is asked for once: the scheduler resolves the samples
+waiting for download and the download jobs read them from the cache. Samples NCBI did not know are
+asked for again after not_found_retry seconds.
+The cache is not in WAL mode, as the download jobs read it from other nodes.
+Settings in [ncbi]:
+    eutils_url      = https://eutils.ncbi.nlm.nih.gov/entrez/eutils
+    api_key         =                  NCBI API key, raises the rate limit
+    email           =                  contact NCBI asks E-utility users for
+    rate            = 3                requests per second
+    batch_size      = 200              GSMs per esearch
+    not_found_retry = 86400            seconds
+    cache_db        = path             by default ncbi_metadata.sqlite in data_collection_root
+
+To resolve samples, or all samples in the queue:
+    python ncbi_metadata.py -c config/rc-fas-harvard.conf -i GSM1234567 [GSM1234568 ..]
+    python ncbi_metadata.py -c config/rc-fas-harvard.conf --queue
+"""
+
+import argparse
+import configparser
+import csv
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+
+import requests_from_cistromeDB
+import sample_queue_store
+
+EUTILS_URL      = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+TOOL            = 'cistrome_processing_pipeline'
+RATE            = 3       # requests per second
+BATCH_SIZE      = 200     # GSMs per esearch
+RUNINFO_PAGE    = 5000    # experiments per efetch
+NOT_FOUND_RETRY = 86400   # seconds
+TIMEOUT         = 60      # seconds per request
+MAX_TRIES       = 4
+RETRY_WAIT      = 2       # seconds before the first retry, doubled for each further one
+
+DEFLINE_BYTES   = 30      # e.g. @SRR1234567.1 1 length=50
+
+GSM_PATTERN = re.compile(r'GSM[0-9]+')
+
+# stages of the samples resolved with --queue
+DOWNLOAD_STAGES = ['REQUESTED','SRA_SUBMITTED']
+
+RUN_COLUMNS = ['run','gsm','experiment','layout','spots','bases','size_mb']
+
+
+def parse_runinfo(text):
+    """
+    Rows of a runinfo table, the header may be repeated where pages were joined.
+    returns:
+       - list of {column: value}
+    """
+    rows = []
+    for row in csv.DictReader(io.StringIO(text)):
+        if row.get('Run') in [None,'','Run']:
+            continue
+        rows += [row]
+    return rows
+
+
+def runinfo_gsm(row,gsm_ids):
+    """
+    The GSM of a runinfo row, from its sample or library name, None if it is not one of gsm_ids.
+    """
+    for key in ['SampleName','LibraryName']:
+        match = GSM_PATTERN.match(row.get(key) or '')
+        if match and match.group() in gsm_ids:
+            return match.group()
+    return None
+
+
+def to_int(val):
+    try:
+        return int(val)
+    except (TypeError,ValueError):
+        return None
+
+
+def expected_fastq_bytes(runs):
+    """
+    Size of the uncompressed fastq files of runs.
+    """
+    size = 0
+    for run in runs:
+        reads = (run['spots'] or 0)*(2 if run['layout'] == 'PAIRED' else 1)
+        # sequence, quality, two deflines and four newlines per read
+        size += 2*(run['bases'] or 0) + reads*(2*DEFLINE_BYTES + 4)
+    return size
+
+
+def sample_layout(runs):
+    """
+    SINGLE or PAIRED if all runs of a sample have that layout, otherwise OTHER.
+    """
+    layouts = set(run['layout'] for run in runs)
+    if len(layouts) == 1 and list(layouts)[0] in ['SINGLE','PAIRED']:
+        return list(layouts)[0]
+    return 'OTHER'
+
+
+class RateLimiter():
+    """
+    Spaces requests at least 1/rate seconds apart, over the threads of a process.
+    """
+
+    def __init__(self,rate,clock=time.monotonic,sleep=time.sleep):
+        self.interval = 1.0/rate
+        self.clock = clock
+        self.sleep = sleep
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        with self.lock:
+            now = self.clock()
+            start = max(now,self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+
+class NCBIMetadata():
+
+    def __init__(self,db_path,sys_config,clock=time.time):
+        """
+        args:
+           - db_path: SQLite database of the cache
+           - sys_config: pipeline config, settings are read from [ncbi]
+           - clock: time source, epoch seconds
+        """
+        conf = sys_config['ncbi'] if 'ncbi' in sys_config else {}
+        self.db_path = db_path
+        self.clock = clock
+        self.eutils_url = conf.get('eutils_url',EUTILS_URL).rstrip('/')
+        self.api_key = conf.get('api_key','')
+        self.email = conf.get('email','')
+        self.batch_size = int(conf.get('batch_size',BATCH_SIZE))
+        self.not_found_retry = float(conf.get('not_found_retry',NOT_FOUND_RETRY))
+        self.limiter = RateLimiter(float(conf.get('rate',RATE)))
+        self.resolve_lock = threading.Lock()
+        self.local = threading.local()
+        self.create_tables()
+
+
+    def connection(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=sample_queue_store.TIMEOUT, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+
+    def create_tables(self):
+        conn = self.connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS ncbi_samples (
+            gsm         TEXT PRIMARY KEY,
+            found       INTEGER NOT NULL,
+            resolved_at REAL NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS ncbi_runs (
+            run        TEXT PRIMARY KEY,
+            gsm        TEXT NOT NULL,
+            experiment TEXT,
+            layout     TEXT,
+            spots      INTEGER,
+            bases      INTEGER,
+            size_mb    REAL)""")
+        conn.execute('CREATE INDEX IF NOT EXISTS ncbi_runs_gsm ON ncbi_runs (gsm)')
+
+
+    def request(self,utility,params):
+        """
+        POST to an E-utility, in the rate limit, retrying on errors of the connection or the server.
+        """
+        params = dict(params,tool=TOOL)
+        if self.api_key != '':
+            params['api_key'] = self.api_key
+        if self.email != '':
+            params['email'] = self.email
+        error = None
+        for attempt in range(MAX_TRIES):
+            if attempt > 0:
+                time.sleep(RETRY_WAIT*2**(attempt - 1))
+            self.limiter.wait()
+            try:
+                response = requests.post(f'{self.eutils_url}/{utility}', data=params, timeout=TIMEOUT)
+            except requests.RequestException as request_error:
+                error = request_error
+                continue
+            # 429: over the rate limit
+            if response.status_code == 429 or response.status_code >= 500:
+                error = requests.HTTPError(f'{utility}: HTTP {response.status_code}',response=response)
+                continue
+            response.raise_for_status()
+            return response
+        raise error
+
+
+    def fetch_runinfo(self,gsm_ids):
+        """
+        Runinfo rows of the SRA experiments found for a batch of GSMs.
+        """
+        term = ' OR '.join(f'{gsm}[All Fields]' for gsm in gsm_ids)
+        search = self.request('esearch.fcgi',{'db':'sra', 'term':term, 'usehistory':'y', 'retmax':0, 'retmode':'json'})
+        result = search.json()['esearchresult']
+        count = int(result.get('count',0))
+        rows = []
+        for retstart in range(0,count,RUNINFO_PAGE):
+            runinfo = self.request('efetch.fcgi',{'db':'sra', 'rettype':'runinfo', 'retmode':'text',
+                'WebEnv':result['webenv'], 'query_key':result['querykey'], 'retstart':retstart, 'retmax':RUNINFO_PAGE})
+            rows += parse_runinfo(runinfo.text)
+        return rows
+
+
+    def store(self,gsm_ids,rows):
+        now = self.clock()
+        found = set()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for row in rows:
+                gsm = runinfo_gsm(row,gsm_ids)
+                if gsm is None:
+                    continue
+                found.add(gsm)
+                conn.execute('INSERT OR REPLACE INTO ncbi_runs (run, gsm, experiment, layout, spots, bases, size_mb) VALUES (?,?,?,?,?,?,?)',
+                    (row['Run'], gsm, row.get('Experiment'), (row.get('LibraryLayout') or '').upper(),
+                     to_int(row.get('spots')), to_int(row.get('bases')), to_int(row.get('size_MB'))))
+            for gsm in gsm_ids:
+                conn.execute('INSERT OR REPLACE INTO ncbi_samples (gsm, found, resolved_at) VALUES (?,?,?)',(gsm,int(gsm in found),now))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+
+    def cached(self,gsm_ids):
+        """
+        Cached metadata of samples.
+        returns:
+           - {gsm: info} of the samples that were found, info as from resolve
+           - {gsm: time it was last asked for} of the samples that were not
+        """
+        conn = self.connection()
+        found,not_found = {},{}
+        for gsm in gsm_ids:
+            row = conn.execute('SELECT found, resolved_at FROM ncbi_samples WHERE gsm=?',(gsm,)).fetchone()
+            if row is None:
+                continue
+            if row[0] == 0:
+                not_found[gsm] = row[1]
+                continue
+            cursor = conn.execute(f'SELECT {",".join(RUN_COLUMNS)} FROM ncbi_runs WHERE gsm=? ORDER BY run',(gsm,))
+            runs = [dict(zip(RUN_COLUMNS,run)) for run in cursor]
+            found[gsm] = {'gsm':gsm, 'runs':runs,
+                'experiments':sorted(set(run['experiment'] for run in runs if run['experiment'])),
+                'layout':sample_layout(runs),
+                'spots':sum(run['spots'] or 0 for run in runs),
+                'bases':sum(run['bases'] or 0 for run in runs),
+                'fastq_bytes':expected_fastq_bytes(runs),
+                'sra_bytes':sum(run['size_mb'] or 0 for run in runs)*1024**2}
+        return found,not_found
+
+
+    def resolve(self,gsm_ids,refresh=False):
+        """
+        Metadata of samples, from the cache or asked from NCBI in batches.
+        args:
+           - gsm_ids: GEO sample ids, ids that are not GSMs are left out
+           - refresh: ask NCBI also for samples in the cache
+        returns:
+           - {gsm: {'gsm':.., 'experiments': [SRX..], 'runs': [{'run','experiment','layout','spots','bases','size_mb'}..],
+                    'layout': SINGLE, PAIRED or OTHER, 'spots':.., 'bases':.., 'fastq_bytes': expected uncompressed fastq size,
+                    'sra_bytes': expected SRA file size}}, of the samples NCBI knows
+        """
+        gsm_ids = [gsm for gsm in dict.fromkeys(gsm_ids) if GSM_PATTERN.fullmatch(gsm)]
+        with self.resolve_lock:
+            found,not_found = self.cached(gsm_ids)
+            now = self.clock()
+            missing = [gsm for gsm in gsm_ids if refresh or (gsm not in found and now - not_found.get(gsm,-self.not_found_retry) >= self.not_found_retry)]
+            for i in range(0,len(missing),self.batch_size):
+                batch = missing[i:i + self.batch_size]
+                self.store(batch,self.fetch_runinfo(batch))
+            if len(missing) > 0:
+                found,not_found = self.cached(gsm_ids)
+        return found
+
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+def get_cache_path(sys_config):
+    if 'ncbi' in sys_config and 'cache_db' in sys_config['ncbi']:
+        return sys_config['ncbi']['cache_db']
+    return os.path.join(sys_config['paths']['data_collection_root'],'ncbi_metadata.sqlite')
+
+
+def get_ncbi_metadata(configpath):
+    """
+    Return the NCBI metadata resolver of a config, creating it on first use.
+    """
+    with _resolvers_lock:
+        if configpath not in _resolvers:
+            sys_conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+            sys_conf.optionxform=str
+            sys_conf.read(configpath)
+            _resolvers[configpath] = NCBIMetadata(get_cache_path(sys_conf),sys_conf)
+        return _resolvers[configpath]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Resolve GEO samples to their SRA runs""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '-i', dest='sample_ids', type=str, nargs='*', default=[], help='GSM ids')
+    parser.add_argument( '--queue', action='store_true', default=False, help='all samples in the queue waiting for download')
+    parser.add_argument( '--refresh', action='store_true', default=False, help='ask NCBI also for cached samples')
+    args = parser.parse_args()
+
+    sample_ids = args.sample_ids
+    if args.queue:
+        sample_queue = requests_from_cistromeDB.SampleQueue(args.configpath)
+        sample_ids += list(sample_queue.get_samples_in_stages(DOWNLOAD_STAGES))
+    resolved = get_ncbi_metadata(args.configpath).resolve(sample_ids,refresh=args.refresh)
+    print('\t'.join(['gsm','layout','spots','bases','fastq_GB','runs']))
+    for gsm in sample_ids:
+        if gsm in resolved:
+            info = resolved[gsm]
+            print('\t'.join([gsm, info['layout'], str(info['spots']), str(info['bases']), '%.2f' % (info['fastq_bytes']/1024**3),
+                ','.join(run['run'] for run in info['runs'])]))
+        else:
+            print(f'{gsm}\tnot found')
+
+
+if __name__ == '__main__':
+    main()
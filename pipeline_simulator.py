@@ -0,0 +1,691 @@
+"""
+Discrete-event simulation of the whole pipeline, to compare schedules, job caps and
+priority policies without waiting for production.
+
+The real scheduler stages (scheduler.py) are run by the scheduler core on a virtual clock
+against a simulated cluster, which stands in for SLURM, lfs, sshare and the marker files
+on scratch: submitted jobs wait for a free slot, run for a modelled time and end in
+COMPLETED, FAILED, OUT_OF_MEMORY, PREEMPTED or TIMEOUT, and a completed job leaves the
+marker the scheduler waits for. Time jumps from one event (stage pass, completion poll,
+job start or end) to the next, so a month of production runs in minutes.
+Synthetic samples are put in a fresh sample queue in a work directory; the sample queue,
+process status files and stage logs are real files there.
+
+Run:
+    python scheduler.py -c config/rc-fas-harvard.conf --simulate 30 --samples 10000 [--model model.json]
+    python pipeline_simulator.py -c config/rc-fas-harvard.conf --days 30 --samples 10000 --arrivals-per-day 500
+
+Model (JSON, all optional, defaults in DEFAULT_MODEL):
+    {"max_running": 200, "pending_seconds": 300, "seed": 0, "scratch_quota": "50T",
+     "size_gb": [3.0, 1.0], "reference_gb": 3.0, "expected_bytes": false,
+     "preemptible_partitions": ["serial_requeue"],
+     "fairshare": {"norm_shares": 0.01, "half_life": 604800, "cluster_cpu_seconds": 1e9},
+     "rules": [{"match": "_chips$", "duration": [7200, 21600], "size_scaled": true, "cpus": 8,
+                "p_fail": 0.03, "p_oom": 0.02, "p_preempt": 0.1}]}
+Rules have the fake_slurm.py format and match the job names {ID}_{type}; durations are drawn
+uniformly and, with size_scaled, multiplied by the sample size over reference_gb. Sample sizes
+are lognormal with median size_gb[0] GB and log standard deviation size_gb[1]. Preemption only
+happens on preemptible partitions. With expected_bytes the size is known to the scheduler before download.
+"""
+
+import argparse
+import configparser
+import contextlib
+import heapq
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import chips_job_submission
+import cluster_stats
+import fake_slurm
+import requests_from_cistromeDB
+import resource_model
+import sample_priority
+import scheduler
+import scheduler_core
+import scratch_admission
+import stage_timeline
+
+DEFAULT_MODEL = {
+    'max_running': 200,
+    'pending_seconds': 300,
+    'seed': 0,
+    'scratch_quota': '50T',
+    'size_gb': [3.0, 1.0],
+    'reference_gb': 3.0,
+    'expected_bytes': False,
+    'sra_size_fraction': scratch_admission.SRA_SIZE_FRACTION,
+    'chips_output_fraction': scratch_admission.CHIPS_OUTPUT_FRACTION,
+    'chips_time_limit': 24*60,
+    'cistrome_id_fraction': 0.9,
+    'species': {'hg38':0.6, 'mm10':0.4},
+    'sampletypes': {'tf':0.5, 'h3k27ac':0.2, 'h3k4me3':0.1, 'dnase':0.1, 'atac':0.1},
+    'preemptible_partitions': ['serial_requeue'],
+    'fairshare': dict(fake_slurm.DEFAULT_CONFIG['fairshare']),
+    'rules': [
+        {'match':'_sra$',          'duration':[1200,3600],  'size_scaled':True, 'p_fail':0.05, 'p_preempt':0.05},
+        {'match':'_chips$',        'duration':[7200,21600], 'size_scaled':True, 'cpus':8, 'p_fail':0.03, 'p_oom':0.02, 'p_preempt':0.1},
+        {'match':'_chips_check$',  'duration':[60,300],     'p_fail':0.01},
+        {'match':'_data_rsync$',   'duration':[300,1800],   'size_scaled':True, 'p_fail':0.01},
+        {'match':'_backup_rsync$', 'duration':[600,3600],   'size_scaled':True, 'p_fail':0.01},
+    ],
+}
+
+# marker left by a completed job of each type
+JOB_MARKERS = {
+    'sra':          'fastq_check',
+    'chips':        'chips_complete',
+    'chips_check':  'chips_check_complete',
+    'data_rsync':   'transfer_complete',
+    'backup_rsync': 'backup_complete',
+}
+
+def read_model(model_path=None):
+    model = json.loads(json.dumps(DEFAULT_MODEL))
+    if model_path is not None:
+        with open(model_path) as fp:
+            model.update(json.load(fp))
+    return model
+
+
+def local_midnight(epoch):
+    day = time.localtime(epoch)
+    return time.mktime((day.tm_year,day.tm_mon,day.tm_mday,0,0,0,0,0,-1))
+
+
+class VirtualClock():
+
+    def __init__(self,start):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedCluster():
+    """
+    Stands in for the cluster snapshot (cluster_stats.ClusterSnapshot), the state scanner
+    (state_scanner.StateScanner) and the job submitter (scheduler.SlurmSubmitter).
+    """
+
+    def __init__(self,model,clock,sys_config):
+        self.model = model
+        self.clock = clock
+        self.now = clock()
+        self.sys_config = sys_config
+        self.max_running = int(model['max_running'])
+        self.pending_seconds = float(model['pending_seconds'])
+        self.reference_gb = float(model['reference_gb'])
+        self.scratch_quota = fake_slurm.parse_mem(str(model['scratch_quota']))*1024**2
+        self.preemptible = set(model['preemptible_partitions'])
+        # drawing outcomes on partitions that are not preemptible
+        self.no_preempt_model = dict(model, rules=[dict(rule,p_preempt=0.0) for rule in model['rules']])
+        self.next_job_id = 1000
+        self.jobs = {}          # job_id: job
+        self.pending = []       # job ids in submission order
+        self.running = set()
+        self.ends = []          # heap of (end time, job_id)
+        self.ended = []         # jobs that ended, for sacct
+        self.array_running = {} # array job id: running tasks
+        self.usage = 0.0
+        self.usage_time = self.now
+        self.markers = {}       # sample_id: set of marker names
+        self.fastq = set()      # names in the fastq directory
+        sra_conf = sys_config['sra_download'] if sys_config.has_section('sra_download') else {}
+        compressed = str(sra_conf.get('gzip',scheduler.SRA_GZIP)).lower() == 'true'
+        self.fastq_suffix = '.fastq.gz' if compressed else '.fastq'
+        # fastq files on scratch relative to the fastq size of a sample
+        self.fastq_fraction = 1/sample_priority.GZIP_RATIO if compressed else 1
+        self.sizes = {}         # sample_id: fastq bytes
+        self.scratch = {}       # sample_id: bytes on scratch
+        self.scratch_used = 0
+        self.peak_scratch = 0
+        self.submitted = {}     # job type: tasks submitted
+        self.sbatch_calls = {}  # job type: sbatch calls
+        self.outcomes = {}      # job type: {state: count}
+
+    # ------------------------------------------------------------------ jobs
+
+    def new_job_id(self):
+        self.next_job_id += 1
+        return self.next_job_id
+
+
+    def add_job(self,job_id,name,job_type,sample_id,partition,time_limit,mem,array_job_id=None,array_limit=None,cpus=None):
+        job = {'job_id':str(job_id), 'name':name, 'type':job_type, 'sample_id':sample_id, 'partition':partition,
+            'time_limit':time_limit, 'mem_mb':mem, 'array_job_id':array_job_id, 'array_limit':array_limit, 'cpus':cpus,
+            'state':'PENDING', 'eligible':self.now + self.pending_seconds, 'start_time':None, 'end_time':None}
+        self.jobs[job['job_id']] = job
+        self.pending += [job['job_id']]
+        self.submitted[job_type] = self.submitted.get(job_type,0) + 1
+        return job
+
+
+    def submit_array(self,cmd,sbatch_path,time=1,mem=200,job_name='test',partition=None,manifest_path=None,
+            array_limit=None,task_jobname_suffix='',submit=False,**sbatch_options):
+        with open(manifest_path) as fp:
+            sample_ids = [line.strip() for line in fp if line.strip() != '']
+        array_job_id = str(self.new_job_id())
+        for task,sample_id in enumerate(sample_ids):
+            self.add_job(f'{array_job_id}_{task}', job_name, task_jobname_suffix, sample_id, partition, time, mem,
+                array_job_id=array_job_id, array_limit=array_limit)
+        self.sbatch_calls[task_jobname_suffix] = self.sbatch_calls.get(task_jobname_suffix,0) + 1
+        return array_job_id
+
+
+    def submit_chips(self,configpath,external_id,species,sampletype,partition=None,mem_factor=1.0,time_factor=1.0):
+        retry_policy = scheduler.Config.retry_policy
+        cpus = chips_job_submission.set_cpus(self.sample_size(external_id))
+        rule_cpus = int(fake_slurm.find_rule(self.model,f'{external_id}_chips').get('cpus',1))
+        time_limit = self.model['chips_time_limit']*resource_model.parallel_time_factor(cpus)/resource_model.parallel_time_factor(rule_cpus)
+        job = self.add_job(self.new_job_id(), f'{external_id}_chips', 'chips', external_id, partition, 
+            retry_policy.scaled_time(time_limit,time_factor), retry_policy.scaled_mem(8000,mem_factor), cpus=cpus)
+        self.sbatch_calls['chips'] = self.sbatch_calls.get('chips',0) + 1
+        return job['job_id']
+
+
+    def startable(self,job):
+        if job['array_limit'] is None:
+            return True
+        return self.array_running.get(job['array_job_id'],0) < int(job['array_limit'])
+
+
+    def start_pending(self):
+        """
+        Start eligible pending jobs, in submission order, while slots are free.
+        returns:
+           - time the next pending job becomes eligible, or None
+        """
+        next_eligible = None
+        still_pending = []
+        for job_id in self.pending:
+            job = self.jobs[job_id]
+            if len(self.running) < self.max_running and job['eligible'] <= self.now and self.startable(job):
+                self.start_job(job)
+                continue
+            if job['eligible'] > self.now:
+                next_eligible = job['eligible'] if next_eligible is None else min(next_eligible,job['eligible'])
+            still_pending += [job_id]
+        self.pending = still_pending
+        if len(self.running) >= self.max_running:
+            return None
+        return next_eligible
+
+
+    def start_job(self,job):
+        sample_id = job['sample_id']
+        # array tasks rename themselves to {ID}_{type} when they start
+        job['name'] = f"{sample_id}_{job['type']}"
+        job['state'] = 'RUNNING'
+        job['start_time'] = self.now
+        rule = fake_slurm.find_rule(self.model,job['name'])
+        scale = self.sample_size(sample_id)/1024**3/self.reference_gb if rule.get('size_scaled') else 1.0
+        rule_cpus = int(rule.get('cpus',1))
+        if job['cpus'] is None:
+            job['cpus'] = rule_cpus
+        else:
+            # durations of the model are on the cores of the rule
+            scale *= resource_model.parallel_time_factor(job['cpus'])/resource_model.parallel_time_factor(rule_cpus)
+        model = self.model if job['partition'] in self.preemptible else self.no_preempt_model
+        fake_slurm.draw_outcome(job,model,job['name'],scale=scale)
+        self.running.add(job['job_id'])
+        if job['array_job_id'] is not None:
+            self.array_running[job['array_job_id']] = self.array_running.get(job['array_job_id'],0) + 1
+        heapq.heappush(self.ends,(self.now + job['duration'],job['job_id']))
+
+        if job['type'] == 'sra':
+            # SRA file and fastq files, the runs are joined in place
+            self.set_scratch(sample_id,(self.model['sra_size_fraction'] + self.fastq_fraction)*self.sample_size(sample_id))
+        elif job['type'] == 'chips':
+            self.set_scratch(sample_id,self.scratch.get(sample_id,0) + self.model['chips_output_fraction']*self.sample_size(sample_id))
+
+
+    def end_job(self,job):
+        job['state'] = job['outcome']
+        job['end_time'] = self.now
+        self.running.discard(job['job_id'])
+        if job['array_job_id'] is not None:
+            self.array_running[job['array_job_id']] -= 1
+        self.ended += [job]
+        outcomes = self.outcomes.setdefault(job['type'],{})
+        outcomes[job['outcome']] = outcomes.get(job['outcome'],0) + 1
+
+        sample_id = job['sample_id']
+        if job['type'] == 'sra':
+            if job['outcome'] == 'COMPLETED':
+                self.set_scratch(sample_id,(self.model['sra_size_fraction'] + self.fastq_fraction)*self.sample_size(sample_id))
+                self.fastq |= set([f'{sample_id}{self.fastq_suffix}',f'{sample_id}.check'])
+            else:
+                self.set_scratch(sample_id,0)
+        if job['outcome'] == 'COMPLETED':
+            self.markers.setdefault(sample_id,set()).add(JOB_MARKERS[job['type']])
+
+
+    def advance(self,until):
+        """
+        Run the cluster forward to time until.
+        """
+        while True:
+            next_eligible = self.start_pending()
+            next_times = [until]
+            if len(self.ends) > 0:
+                next_times += [self.ends[0][0]]
+            if next_eligible is not None:
+                next_times += [next_eligible]
+            next_time = min(next_times)
+            self.update_usage(next_time)
+            self.now = next_time
+            while len(self.ends) > 0 and self.ends[0][0] <= self.now:
+                end_time,job_id = heapq.heappop(self.ends)
+                self.end_job(self.jobs[job_id])
+            if next_time >= until:
+                self.start_pending()
+                return
+
+
+    def next_event_time(self):
+        next_times = [self.ends[0][0]] if len(self.ends) > 0 else []
+        if len(self.running) < self.max_running:
+            next_times += [max(self.now,self.jobs[job_id]['eligible']) for job_id in self.pending if self.startable(self.jobs[job_id])]
+        return min(next_times) if len(next_times) > 0 else math.inf
+
+
+    def update_usage(self,now):
+        fairshare = self.model['fairshare']
+        dt = now - self.usage_time
+        if dt > 0:
+            running_cpus = sum([self.jobs[job_id]['cpus'] for job_id in self.running])
+            self.usage = self.usage*0.5**(dt/fairshare['half_life']) + running_cpus*dt
+        self.usage_time = now
+
+    # ------------------------------------------------------------------ samples
+
+    def sample_size(self,sample_id):
+        return self.sizes.get(sample_id,scratch_admission.DEFAULT_FASTQ_BYTES)
+
+
+    def set_scratch(self,sample_id,size):
+        self.scratch_used += size - self.scratch.get(sample_id,0)
+        if size > 0:
+            self.scratch[sample_id] = size
+        else:
+            self.scratch.pop(sample_id,None)
+        self.peak_scratch = max(self.peak_scratch,self.scratch_used)
+
+
+    def clear_sample(self,sample_id):
+        """
+        The files of the sample were deleted.
+        """
+        self.set_scratch(sample_id,0)
+        self.markers.pop(sample_id,None)
+        self.fastq -= set([f'{sample_id}{self.fastq_suffix}',f'{sample_id}.check'])
+
+    # ------------------------------------------------------------------ cluster snapshot
+
+    def get_jobs_in_queue(self,force=False):
+        pass
+
+
+    def active_jobs(self):
+        return [self.jobs[job_id] for job_id in self.pending] + [self.jobs[job_id] for job_id in self.running]
+
+
+    def get_pending_job_count(self):
+        return len(self.pending)
+
+
+    def get_running_job_count(self):
+        return len(self.running)
+
+
+    def is_job_name_in_queue(self,job_name):
+        return any( job['name'] == job_name for job in self.active_jobs() )
+
+
+    def is_job_id_in_queue(self,job_id):
+        return str(job_id) in self.running or (str(job_id) in self.jobs and self.jobs[str(job_id)]['state'] == 'PENDING')
+
+
+    def list_job_names_in_queue(self):
+        return [job['name'] for job in self.active_jobs()]
+
+
+    def record_submitted_job(self,job_name,job_id='',partition=None,memory=math.nan):
+        pass
+
+
+    def get_account_records(self,starttime):
+        """
+        sacct records of the jobs since starttime, without job steps.
+        """
+        self.ended = [job for job in self.ended if job['end_time'] >= starttime]
+        records = []
+        for job in self.ended + self.active_jobs():
+            elapsed = 0 if job['start_time'] is None else (job['end_time'] or self.now) - job['start_time']
+            records += [{'JobID':job['job_id'], 'JobName':job['name'], 'Partition':job['partition'], 'State':job['state'],
+                'ExitCode':'0:0', 'MaxRSS':'', 'Elapsed':fake_slurm.format_elapsed(elapsed),
+                'Start':fake_slurm.format_timestamp(job['start_time']), 'End':fake_slurm.format_timestamp(job['end_time']),
+                'ReqMem':'%dM' % job['mem_mb'], 'Timelimit':fake_slurm.format_elapsed(job['time_limit']*60),
+                'AllocCPUS':str(job['cpus'] or 1)}]
+        return records
+
+
+    def get_scratch_use(self,force=False):
+        return {'used':self.scratch_used, 'quota':self.scratch_quota, 'limit':self.scratch_quota}
+
+
+    def get_fairshare(self,force=False):
+        fairshare = self.model['fairshare']
+        norm_shares = float(fairshare['norm_shares'])
+        effective_usage = self.usage/float(fairshare['cluster_cpu_seconds'])
+        return {'NormShares':str(norm_shares), 'EffectvUsage':str(effective_usage),
+            'FairShare':str(2**(-effective_usage/norm_shares))}
+
+    # ------------------------------------------------------------------ state scanner
+
+    def has_marker(self,sample_id,marker):
+        if marker == 'process_status_file':
+            path = os.path.join(scheduler.get_process_status_path(sample_id),f'{sample_id}_status.json')
+            return os.path.exists(path)
+        return marker in self.markers.get(sample_id,())
+
+
+    def fastq_names(self):
+        return set(self.fastq)
+
+
+    def invalidate(self,sample_id):
+        pass
+
+
+class PipelineSimulator():
+
+    def __init__(self,configpath,work_dir,model,n_samples=10000,arrivals_per_day=0):
+        """
+        args:
+           - configpath: pipeline config, its schedule, caps and priority settings are simulated
+           - work_dir: directory for the simulated scratch, sample queue and logs
+           - model: cluster and sample model, see DEFAULT_MODEL
+           - n_samples: number of synthetic samples
+           - arrivals_per_day: samples requested per day, 0 for all at the start
+        """
+        self.work_dir = os.path.abspath(work_dir)
+        self.model = model
+        self.n_samples = n_samples
+        self.arrivals_per_day = arrivals_per_day
+        self.rng = random.Random(model['seed'])
+        self.start = local_midnight(time.time())
+        self.clock = VirtualClock(self.start)
+        self.configpath = self.write_config(configpath)
+        self.log = open(os.path.join(self.work_dir,'simulation_log.txt'),'a')
+        self.requested_at = {}
+        self.completion_times = []
+        self.given_up = 0
+        self.stage_passes = {}
+        self.stage_seconds = {}
+
+        sys_config = self.read_config(self.configpath)
+        self.cluster = SimulatedCluster(model,self.clock,sys_config)
+        cluster_stats.set_cluster_snapshot(self.configpath,self.cluster)
+        scheduler.Config(self.configpath)
+        scheduler.Config.state_scanner = self.cluster
+        scheduler.Config.submitter = self.cluster
+        # synthetic samples are not known to NCBI
+        scheduler.Config.ncbi_metadata = None
+        scheduler.Config.priority = sample_priority.SamplePriority(scheduler.Config.sys_config, fastq_names=self.cluster.fastq_names, clock=self.clock)
+        self.sample_queue = requests_from_cistromeDB.SampleQueue(self.configpath)
+        # stage events are recorded in virtual time
+        self.sample_queue.store.clock = self.clock
+        scheduler.Config.job_states.clock = self.clock
+        self.samples = self.make_samples()
+        self.core = self.build_core()
+        scheduler.Config.core = self.core
+
+
+    @staticmethod
+    def read_config(configpath):
+        sys_config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+        sys_config.optionxform=str
+        sys_config.read(configpath)
+        return sys_config
+
+
+    def write_config(self,configpath):
+        """
+        Copy of the config with the scratch paths and the sample queue in the work directory.
+        """
+        sys_config = self.read_config(configpath)
+        paths = {'data_collection_root':'', 'data_collection_runs':'runs', 'data_collection_sbatch':'sbatch',
+            'fastq':'fastq', 'sra':'sra', 'log_file':'cistrome_pipeline_log.txt'}
+        for key,path in paths.items():
+            sys_config['paths'][key] = os.path.join(self.work_dir,path)
+            if key not in ['log_file']:
+                os.makedirs(sys_config['paths'][key],exist_ok=True)
+        sys_config['process_server']['local_queue_file'] = os.path.join(self.work_dir,'sample_queue.json')
+        sys_config['process_server']['local_queue_db'] = os.path.join(self.work_dir,'sample_queue.sqlite')
+        sim_configpath = os.path.join(self.work_dir,'simulation.conf')
+        with open(sim_configpath,'w') as fp:
+            sys_config.write(fp)
+        return sim_configpath
+
+
+    def choose(self,weights):
+        keys = list(weights)
+        return self.rng.choices(keys,weights=[weights[key] for key in keys])[0]
+
+
+    def make_samples(self):
+        """
+        Synthetic samples, with their request time and fastq size.
+        returns:
+           - list of (request time, sample_id, sample_info), in request order
+        """
+        median_gb,sigma = self.model['size_gb']
+        samples = []
+        for i in range(self.n_samples):
+            sample_id = f'GSM{i+1:07d}'
+            if self.arrivals_per_day > 0:
+                requested_at = self.start + i/self.arrivals_per_day*scheduler.DAY
+            else:
+                requested_at = self.start
+            size = median_gb*math.exp(self.rng.gauss(0,sigma))*1024**3
+            self.cluster.sizes[sample_id] = size
+            sample_info = {'CistromeID': str(i+1) if self.rng.random() < self.model['cistrome_id_fraction'] else 'NA',
+                'species':self.choose(self.model['species']), 'sampletype':self.choose(self.model['sampletypes']),
+                'GSMID':sample_id, 'REQUESTED_AT':requested_at}
+            if self.model['expected_bytes']:
+                sample_info['EXPECTED_BYTES'] = size
+            samples += [(requested_at,sample_id,sample_info)]
+        samples.reverse()
+        return samples
+
+
+    def update_samples_in_local_queue(self,samples=None):
+        """
+        Stands in for the request file on the home server: add the samples requested by now.
+        """
+        new_samples = {}
+        while len(self.samples) > 0 and self.samples[-1][0] <= self.clock():
+            requested_at,sample_id,sample_info = self.samples.pop()
+            new_samples[sample_id] = sample_info
+            self.requested_at[sample_id] = requested_at
+        self.sample_queue.store.add_samples(new_samples)
+        return set(new_samples)
+
+
+    def setup_and_run_chips(self,samples=None):
+        submitted = scheduler.setup_and_run_chips(samples)
+        if samples is None:
+            # samples restarted from scratch by clean_up_failed_samples lost their files
+            for sample_id in self.sample_queue.store.select_ids("stage = 'REQUESTED' AND restarts > 0"):
+                if sample_id in self.cluster.markers or sample_id in self.cluster.scratch:
+                    self.cluster.clear_sample(sample_id)
+        return submitted
+
+
+    def transfer_to_server(self,samples=None):
+        submitted = scheduler.transfer_to_server(samples)
+        # samples given up are finished once their process status is reported
+        for sample_id in list(self.cluster.markers):
+            markers = self.cluster.markers[sample_id]
+            if 'transfer_complete' in markers and 'chips_check_complete' not in markers:
+                self.given_up += 1
+                self.cluster.clear_sample(sample_id)
+        return submitted
+
+
+    def clean_up_after_completion(self,samples=None):
+        """
+        The simulated files of the samples the pass will finish are deleted here,
+        so the pass itself does not find any files to delete.
+        """
+        samples_to_process = scheduler.read_samples_for_stage(self.sample_queue,'clean_up_after_completion',samples)
+        finished = [sample_id for sample_id in samples_to_process
+            if self.cluster.has_marker(sample_id,'transfer_complete') and self.cluster.has_marker(sample_id,'backup_complete')]
+        for sample_id in finished:
+            shutil.rmtree(os.path.join(scheduler.Config.sys_config['paths']['data_collection_runs'],sample_id),ignore_errors=True)
+        scheduler.clean_up_after_completion(samples)
+        for sample_id in finished:
+            self.completion_times += [self.clock() - self.requested_at.get(sample_id,self.start)]
+            self.cluster.clear_sample(sample_id)
+
+
+    def build_core(self):
+        poll_interval = float(scheduler.Config.sys_config['process_server'].get('completion_poll_interval',scheduler.COMPLETION_POLL_INTERVAL))
+        core = scheduler_core.SchedulerCore(max_workers=1, poll_interval=poll_interval, clock=self.clock, log=self.log, on_done=scheduler.record_stage_done)
+        for name,stage_sched in scheduler.event_sched.items():
+            if name == 'test':
+                continue
+            start_time = stage_sched['start_time']
+            first_run = self.start + start_time['hr']*scheduler.HOUR + start_time['min']*scheduler.MINUTE + start_time['sec']
+            action = getattr(self,name,None) or getattr(scheduler,name)
+            stage = scheduler_core.Stage( name, self.timed(name,action), stage_sched['interval'], first_run=first_run,
+                downstream=stage_sched['downstream'], done_check=scheduler.stage_done_checks.get(name) )
+            core.add_stage(stage)
+        return core
+
+
+    def timed(self,name,action):
+        """
+        Count stage passes and the real time they take, scheduler output goes to the simulation log.
+        """
+        def run(samples):
+            start = time.time()
+            with contextlib.redirect_stdout(self.log):
+                submitted = action(samples)
+            self.stage_passes[name] = self.stage_passes.get(name,0) + 1
+            self.stage_seconds[name] = self.stage_seconds.get(name,0) + time.time() - start
+            return submitted
+        return run
+
+
+    def run(self,days):
+        """
+        Run the scheduler core on the virtual clock for a number of days.
+        """
+        core = self.core
+        end = self.start + days*scheduler.DAY
+        for name in core.stages:
+            core.request_full_pass(name)
+        core.next_poll = self.clock() + core.poll_interval
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            while self.clock() < end:
+                now = self.clock()
+                for stage_name,samples in core.due_stages(now):
+                    core.running.add(stage_name)
+                    core.run_stage(stage_name,samples)
+                if now >= core.next_poll:
+                    with contextlib.redirect_stdout(self.log):
+                        core.poll_completions()
+                    core.next_poll = now + core.poll_interval
+                if any( len(samples) > 0 for samples in core.ready.values() ) or len(core.full_pass_requested) > 0:
+                    continue
+                next_time = min(end, now + core.wait_time(now), self.cluster.next_event_time())
+                self.cluster.advance(next_time)
+                self.clock.now = next_time
+        finally:
+            os.chdir(cwd)
+        return self.report(days)
+
+
+    def report(self,days):
+        hours = [seconds/scheduler.HOUR for seconds in self.completion_times]
+        return {
+            'days': days,
+            'samples_requested': len(self.requested_at),
+            'samples_completed': len(self.completion_times),
+            'samples_given_up': self.given_up,
+            'samples_per_day': len(self.completion_times)/days,
+            'completion_hours': {f'p{pct}':stage_timeline.percentile(hours,pct) for pct in stage_timeline.PERCENTILES},
+            'stage_hours': stage_timeline.stage_latencies(self.sample_queue.store.read_events()),
+            'peak_scratch_bytes': self.cluster.peak_scratch,
+            'jobs_submitted': dict(self.cluster.submitted),
+            'sbatch_calls': dict(self.cluster.sbatch_calls),
+            'job_outcomes': dict(self.cluster.outcomes),
+            'stages': self.sample_queue.count_samples_by_stage(),
+            'stage_passes': dict(self.stage_passes),
+            'stage_seconds': {name:round(seconds,2) for name,seconds in self.stage_seconds.items()},
+        }
+
+
+def print_report(report):
+    print(f"simulated {report['days']:g} days: {report['samples_requested']} samples requested, "
+        f"{report['samples_completed']} completed, {report['samples_given_up']} given up")
+    print(f"samples/day: {report['samples_per_day']:.1f}")
+    for key,val in report['completion_hours'].items():
+        print(f'time to completion {key}: ' + ('-' if val is None else f'{val:.1f} h'))
+    print(f"peak scratch use: {report['peak_scratch_bytes']/1024**4:.2f} TB")
+    for job_type,n_jobs in report['jobs_submitted'].items():
+        print(f"{job_type} jobs: {n_jobs} in {report['sbatch_calls'].get(job_type,0)} sbatch calls, {report['job_outcomes'].get(job_type,{})}")
+    print(f"sample stages: {report['stages']}")
+    for name,latency in report['stage_hours'].items():
+        print(f"{name}: n={latency['n']} " + ' '.join([f"{key}=" + ('-' if val is None else f'{val:.1f}h') for key,val in latency.items() if key != 'n']))
+    for name,n_passes in report['stage_passes'].items():
+        print(f"{name}: {n_passes} passes, {report['stage_seconds'][name]:.1f}s")
+
+
+def simulate(configpath,days,n_samples=10000,model_path=None,arrivals_per_day=0,work_dir=None,report_path=None):
+    """
+    Simulate the pipeline and print the report.
+    returns:
+       - report dictionary
+    """
+    model = read_model(model_path)
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(work_dir,exist_ok=True)
+        simulator = PipelineSimulator(configpath, work_dir, model, n_samples=n_samples, arrivals_per_day=arrivals_per_day)
+        report = simulator.run(days)
+        simulator.log.close()
+    print_report(report)
+    if report_path is not None:
+        with open(report_path,'w') as fp:
+            json.dump(report,fp,indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Simulate the processing pipeline on a virtual clock""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '--days', dest='days', type=float, default=30, help='simulated days')
+    parser.add_argument( '--samples', dest='n_samples', type=int, default=10000, help='number of synthetic samples')
+    parser.add_argument( '--arrivals-per-day', dest='arrivals_per_day', type=float, default=0, help='samples requested per day (default: all at the start)')
+    parser.add_argument( '--model', dest='model_path', type=str, default=None, help='JSON cluster and sample model')
+    parser.add_argument( '--work-dir', dest='work_dir', type=str, default=None, help='keep the simulated queue and logs here (default: temporary)')
+    parser.add_argument( '--report', dest='report_path', type=str, default=None, help='write the report as JSON')
+    args = parser.parse_args()
+    simulate(args.configpath, args.days, n_samples=args.n_samples, model_path=args.model_path,
+        arrivals_per_day=args.arrivals_per_day, work_dir=args.work_dir, report_path=args.report_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,18 @@ import requests
 #import urllib.request
 #import urllib.parse
 import os
-from threading import Lock
+import time
+
+import job_failures
+import sample_queue_store
 
 TIMEOUT = 10
 
+# pipeline stages of a sample, in order.
+# FINISHED samples need no further work and are left out of the scheduler passes.
+STAGES = ['REQUESTED','SRA_SUBMITTED','FASTQ_READY','CHIPS_SUBMITTED','CHIPS_COMPLETE',
+    'CHECK_SUBMITTED','CHECKED','TRANSFERRED','BACKED_UP','FINISHED']
+
 class SystemConfig():
 
     def __init__(self,config_filename):
@@ -23,12 +31,33 @@ class SystemConfig():
 
 
 class SampleQueue():
+    """
+    Local queue of samples to be processed.
+    Samples are kept in a SQLite store (sample_queue_store.py), every update is written 
+    to the store immediately as an atomic per-sample transaction. 
+    local_samples is an in-memory copy of the store, refreshed by read_local_queue.
+    """
 
     def __init__(self,system_config_filename):
-        self.lock = Lock() 
         tmp_conf = SystemConfig(system_config_filename)
         tmp_conf.read_config()
         self.sys_conf = tmp_conf.config
+        self.local_samples = {}
+        self.store = sample_queue_store.get_store(sample_queue_store.get_db_path(self.sys_conf))
+        self.migrate_local_queue_file()
+
+
+    def migrate_local_queue_file(self):
+        """
+        One-off migration of the JSON queue file into an empty store.
+        """
+        local_queue_file = self.sys_conf['process_server']['local_queue_file']
+        if self.store.count() == 0 and os.path.exists(local_queue_file):
+            try:
+                n_samples = self.store.import_json(local_queue_file)
+                print(f'migrated {n_samples} samples from {local_queue_file}')
+            except ValueError:
+                print(f'could not migrate {local_queue_file}')
 
 
     def download_cistromedb_json(self):
@@ -46,14 +75,65 @@ class SampleQueue():
         self.requested_samples = json.loads(docstring)
 
 
-    def read_local_queue(self):
-         local_queue_file = self.sys_conf['process_server']['local_queue_file']
-         try:
-             with open(local_queue_file) as fp:
-                self.local_samples = json.load(fp)
-                #print(self.local_samples)
-         except:
-             self.local_samples = {}
+    def read_local_queue(self,stages=None,sample_ids=None,process_status=None):
+        """
+        Read the sample queue from the store.
+        With no arguments all samples are read, otherwise the samples matching any of:
+        args:
+           - stages: pipeline stages to read
+           - sample_ids: samples to read, regardless of stage
+           - process_status: process status values to read, for samples that are not FINISHED
+        """
+        if stages is None and sample_ids is None and process_status is None:
+            self.local_samples = {'samples_to_be_processed': self.store.read_all()}
+            return
+
+        samples = {}
+        if stages is not None:
+            samples.update(self.store.read_where(f'stage IN ({",".join("?"*len(stages))})',list(stages)))
+        if process_status is not None:
+            samples.update(self.store.read_where(f'process_status IN ({",".join("?"*len(process_status))}) AND stage != ?',list(process_status) + ['FINISHED']))
+        if sample_ids is not None:
+            sample_ids = list(sample_ids)
+            for i in range(0,len(sample_ids),500):
+                chunk = sample_ids[i:i+500]
+                samples.update(self.store.read_where(f'sample_id IN ({",".join("?"*len(chunk))})',chunk))
+        self.local_samples = {'samples_to_be_processed': samples}
+
+
+    def get_samples_in_stages(self,stages):
+        """
+        Samples in the given stages, read without changing the local copy of the queue.
+        """
+        return self.store.read_where(f'stage IN ({",".join("?"*len(stages))})',list(stages))
+
+
+    def get_sample_ids(self):
+        return self.store.select_ids('1')
+
+
+    def get_samples_by_stage(self,stages):
+        return self.store.select_ids(f'stage IN ({",".join("?"*len(stages))})',list(stages))
+
+
+    def get_samples_by_process_status(self,process_status_list):
+        return self.store.select_ids(f'process_status IN ({",".join("?"*len(process_status_list))})',list(process_status_list))
+
+
+    def get_samples_by_restart_count(self,min_restarts):
+        return self.store.select_ids('restarts >= ?',(min_restarts,))
+
+
+    def get_samples_at_max_fails(self,max_fails):
+        """
+        Samples where SRA or CHIPS jobs failed, or CHIPS check ran, at least max_fails times.
+        Preemptions and node failures are not counted, see job_failures.py.
+        """
+        return self.store.select_ids('sra_fails >= ? OR chips_fails >= ? OR chips_check_runs >= ?',(max_fails,max_fails,max_fails))
+
+
+    def count_samples_by_stage(self):
+        return self.store.count_by('stage')
 
 
     def get_local_queue(self):
@@ -63,34 +143,40 @@ class SampleQueue():
         return self.local_samples['samples_to_be_processed']
  
 
+    def modify_sample(self,sample_id,modify):
+        """
+        Apply modify(sample) to a sample in the store, also when it is not in the local copy, 
+        and refresh the sample in the local copy.
+        """
+        local_queue = self.get_local_queue()
+        sample = self.store.modify_sample(sample_id,modify)
+        if sample is not None and sample_id in local_queue:
+            local_queue[sample_id] = sample
+
+
     def set_sample_process_status(self,sample_id='',process_status=''):
         """
         Set sample process status.
         """
-        local_queue = self.get_local_queue()
-        if sample_id in local_queue:
-            sample = self.local_samples['samples_to_be_processed'][sample_id]
+        def modify(sample):
             sample['process_status'] = process_status
+        self.modify_sample(sample_id,modify)
 
 
     # set dictionary of run events to empty
     def clear_sample_info(self,sample_id='',info_key=''):
-        local_queue = self.get_local_queue()
         info_key = info_key.upper()
-        if sample_id in local_queue:
-            sample = self.local_samples['samples_to_be_processed'][sample_id]
+        def modify(sample):
             sample[info_key] = {}
+        self.modify_sample(sample_id,modify)
 
 
     def set_sample_info(self,sample_id='',info_key='',info_val={}):
         """
         Set sample run information: dictionary of run ids on cluster and status.
         """
-        local_queue = self.get_local_queue()
         info_key = info_key.upper()
-        if sample_id in local_queue:
-            sample = self.local_samples['samples_to_be_processed'][sample_id]
-
+        def modify(sample):
             if not info_key in sample:
                 sample[info_key] = {}
 
@@ -99,16 +185,74 @@ class SampleQueue():
 
             for key,val in info_val.items():               
                 sample[info_key][key] = val
+        self.modify_sample(sample_id,modify)
 
 
-    def increment_sample_restart_count(self,sample_id=''):
+    def set_sample_expected_size(self,sample_id='',expected={}):
+        """
+        Record what is known of the size of a sample before download, 
+        e.g. {'EXPECTED_BYTES': fastq bytes, 'EXPECTED_SRA_BYTES': SRA bytes}, only when it changed.
+        """
+        local_queue = self.get_local_queue()
+        if sample_id in local_queue and all(local_queue[sample_id].get(key) == val for key,val in expected.items()):
+            return
+        def modify(sample):
+            sample.update(expected)
+        self.modify_sample(sample_id,modify)
+
+
+    def set_sample_stage(self,sample_id='',stage='',reset=False):
+        """
+        Record the pipeline stage of a sample. 
+        Stages only move forward unless reset is set, e.g. when a sample is restarted from scratch.
+        The first time a sample reaches a stage, since it was requested or restarted, is kept 
+        in STAGE_TIMES and recorded as a stage event.
+        """
+        if self.get_sample_stage(sample_id) == stage and not reset:
+            return
+        def modify(sample):
+            current = sample.get('STAGE',STAGES[0])
+            if reset or STAGES.index(stage) > STAGES.index(current):
+                sample['STAGE'] = stage
+            if reset:
+                sample['STAGE_TIMES'] = {}
+            # transfer and backup finish in either order, so a stage can be reached after a later one
+            stage_times = sample.setdefault('STAGE_TIMES',{})
+            if stage not in stage_times:
+                stage_times[stage] = self.store.clock()
+                return [(stage,stage_times[stage])]
+        self.modify_sample(sample_id,modify)
+
+
+    def record_sample_event(self,sample_id='',event='',event_time=None):
+        """
+        Record an event that is not a stage, e.g. the start of a job, once per event time.
+        """
+        local_queue = self.get_local_queue()
+        if sample_id in local_queue and local_queue[sample_id].get('STAGE_TIMES',{}).get(event) == event_time:
+            return
+        def modify(sample):
+            stage_times = sample.setdefault('STAGE_TIMES',{})
+            if stage_times.get(event) != event_time:
+                stage_times[event] = event_time
+                return [(event,event_time)]
+        self.modify_sample(sample_id,modify)
+
+
+    def get_sample_stage(self,sample_id=''):
         local_queue = self.get_local_queue()
         if sample_id in local_queue:
-            sample = self.local_samples['samples_to_be_processed'][sample_id]
+            return local_queue[sample_id].get('STAGE',STAGES[0])
+        return None
+
+
+    def increment_sample_restart_count(self,sample_id=''):
+        def modify(sample):
             if not 'RESTARTS' in sample:
                 sample['RESTARTS'] = 1
             else:
                 sample['RESTARTS'] += 1
+        self.modify_sample(sample_id,modify)
 
 
     def get_sample_restart_count(self,sample_id=''):
@@ -133,13 +277,21 @@ class SampleQueue():
         count = 0
         if (sample and (info_key in sample) and
             isinstance(sample[info_key],dict)):
-
-            for key,val in sample[info_key].items():
-                if val == "FAILED":          
-                    count += 1
+            # preemptions and node failures are not counted
+            count = job_failures.count_failures(sample[info_key])
         return count
 
 
+    def get_sample_attempt_count(self,sample_id='',info_key=''):
+        """
+        Number of jobs of a type run for a sample, not counting preempted jobs and node failures.
+        """
+        local_queue = self.get_local_queue()
+        if sample_id not in local_queue:
+            return 0
+        return job_failures.count_attempts(local_queue[sample_id].get(info_key.upper()))
+
+
     # TODO extract function to look for status
     def get_sample_status_count(self,sample_id='',info_key='',status=''):
         local_queue = self.get_local_queue()
@@ -163,25 +315,22 @@ class SampleQueue():
 
 
     def write_local_queue(self):             
-        local_queue_file = self.sys_conf['process_server']['local_queue_file']
-        with self.lock:
-            with open(local_queue_file,'w') as fp:
-                json.dump(self.local_samples,fp)
+        """
+        Kept for compatibility: updates are committed to the store as they are made.
+        """
+        pass
 
  
     def update_local_queue(self):
-        self.read_local_queue()
         self.download_cistromedb_json()
-        #print(self.requested_samples)
+        # note: local sample parameters overwrite requested, so only new samples are added
         if 'samples_to_be_processed' in self.requested_samples:
-            updated_sample_queue = self.requested_samples 
-        # combine dictionaries of samples in local queue and requests
-        if 'samples_to_be_processed' in self.local_samples:
-            # note: local sample parameters overwrite requested 
-            updated_sample_queue['samples_to_be_processed'] = { **self.requested_samples['samples_to_be_processed'], **self.local_samples['samples_to_be_processed'] } 
- 
-        self.local_samples['samples_to_be_processed'] =  updated_sample_queue['samples_to_be_processed'] 
-        self.write_local_queue()
+            requested = self.requested_samples['samples_to_be_processed']
+            # the request time is kept for new samples only, used to rank samples by age
+            requested_at = time.time()
+            for sample in requested.values():
+                sample.setdefault('REQUESTED_AT',requested_at)
+            self.store.add_samples(requested)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,455 @@
+"""
+Memory and time requests of CHIPS jobs, learned from the sacct history of earlier jobs.
+When a CHIPS job is set up, the features of its sample are recorded in the sample_features
+table of the sample queue database:
+    sample_id -> fastq_bytes, reads (estimated from the first records), layout, species, sample_type
+fastq_bytes is the uncompressed size; of gzip compressed fastq files (.fastq.gz) it is estimated from the
+compression ratio of the first records.
+They are joined with the jobs table of the job state cache (job_state_cache.py), and the peak memory
+(MaxRSS) and run time (Elapsed) of the samples that completed are fitted by least squares as
+    log(y) = b0 + b1 log(fastq GB) + b2 fastq GB + b3 log(million reads) + layout, species and sample type terms
+(the linear size term lets the fit bend from the fixed cost of small samples, e.g. the mapping index,
+to the growth of large ones), plus a log(cores) term once jobs ran on different numbers of cores.
+Until then requests are scaled from the cores of the earlier jobs to the cores of the new one: time by
+Amdahl's law with serial_fraction, memory by mem_per_cpu MB for each added core.
+A job asks for the fit plus a quantile of the residuals of the earlier jobs, plus headroom:
+    request = exp(fit + residual quantile) * (1 + headroom)
+so that about that fraction of the jobs fit in their request. Until min_jobs samples are known,
+the fixed formulas set_mem and set_runtime of chips_job_submission.py are used.
+Settings in [resources]:
+    mem_quantile   = 0.95
+    mem_headroom   = 0.1
+    time_quantile  = 0.95
+    time_headroom  = 0.2
+    min_jobs       = 30
+    refit_interval = 21600   seconds between fits
+    min_mem        = 4000    MB
+    max_mem        = 64000   MB
+    min_minutes    = 60
+    max_minutes    = 1380
+    serial_fraction = 0.3    part of a CHIPS run that does not speed up with more cores
+    mem_per_cpu    = 1000    MB
+
+To print requested vs used memory and time of the CHIPS jobs, and what the model would have requested:
+    python resource_model.py -c config/rc-fas-harvard.conf [--days 30]
+"""
+
+import argparse
+import configparser
+import math
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import sample_queue_store
+import stage_timeline
+
+MEM_QUANTILE   = 0.95
+MEM_HEADROOM   = 0.1
+TIME_QUANTILE  = 0.95
+TIME_HEADROOM  = 0.2
+MIN_JOBS       = 30
+REFIT_INTERVAL = 6*3600
+MIN_MEM        = 4000     # MB
+MAX_MEM        = 64000    # MB
+MIN_MINUTES    = 60
+MAX_MINUTES    = 60*23
+SERIAL_FRACTION = 0.3
+MEM_PER_CPU    = 1000     # MB
+
+READ_SAMPLE_RECORDS = 1000  # fastq records read to estimate the read count
+BYTES_PER_READ = 250        # used when the read count could not be estimated
+GZIP_CHUNK = 4096           # bytes of a compressed fastq file read at a time
+RIDGE = 1e-3                # keeps the fit defined for categories with few jobs
+MIN_ELAPSED = 60            # seconds, shorter runs are counted as this long
+
+FEATURE_COLUMNS = ['fastq_bytes','reads','layout','species','sample_type']
+CATEGORICAL = ['layout','species','sample_type']
+
+
+def read_fastq_head(fastq_path,n_lines):
+    """
+    First lines of a fastq file, decompressed if it is gzip compressed (.gz), also when it consists of several gzip members.
+    returns:
+       - (lines, uncompressed bytes per file byte over the part read)
+    """
+    if not fastq_path.endswith('.gz'):
+        with open(fastq_path,'rb') as fp:
+            return list(itertools.islice(fp,n_lines)),1.0
+    data,file_bytes = b'',0
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    with open(fastq_path,'rb') as fp:
+        while data.count(b'\n') < n_lines:
+            chunk = fp.read(GZIP_CHUNK)
+            if chunk == b'':
+                break
+            file_bytes += len(chunk)
+            while len(chunk) > 0:
+                data += decompressor.decompress(chunk)
+                chunk = b''
+                if decompressor.eof:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    ratio = len(data)/file_bytes if file_bytes > 0 else 1.0
+    return data.splitlines(keepends=True)[:n_lines],ratio
+
+
+def estimate_fastq(fastq_path,n_records=READ_SAMPLE_RECORDS):
+    """
+    Reads in a fastq file and its uncompressed size, estimated from the size of its first records.
+    returns:
+       - (number of reads, uncompressed bytes), each None if the file can not be read
+    """
+    try:
+        size = os.path.getsize(fastq_path)
+        lines,ratio = read_fastq_head(fastq_path,4*n_records)
+    except (OSError,zlib.error):
+        return None,None
+    n_read = len(lines)//4
+    if n_read == 0:
+        return None,int(size*ratio)
+    n_bytes = sum(len(line) for line in lines[:4*n_read])
+    return int(size*ratio*n_read/n_bytes),int(size*ratio)
+
+
+def estimate_reads(fastq_path,n_records=READ_SAMPLE_RECORDS):
+    """
+    Reads in a fastq file, estimated from the size of its first records.
+    returns:
+       - number of reads, None if the file can not be read
+    """
+    return estimate_fastq(fastq_path,n_records)[0]
+
+
+def fastq_size(fastq_path):
+    """
+    Uncompressed size of a fastq file in bytes.
+    """
+    size = estimate_fastq(fastq_path)[1]
+    return os.path.getsize(fastq_path) if size is None else size
+
+
+def sample_features(fastq_paths,species,sample_type):
+    """
+    Features of a sample the resource requests are predicted from.
+    args:
+       - fastq_paths: fastq files of the sample, one for single end, two for paired end
+    returns:
+       - {feature: value} for the FEATURE_COLUMNS
+    """
+    reads = [estimate_reads(path) for path in fastq_paths]
+    return {'fastq_bytes':sum(fastq_size(path) for path in fastq_paths),
+        # paired end mates are counted once
+        'reads':None if None in reads else max(reads),
+        'layout':'paired' if len(fastq_paths) > 1 else 'single',
+        'species':str(species), 'sample_type':str(sample_type).lower()}
+
+
+def parallel_time_factor(cpus,serial_fraction=SERIAL_FRACTION):
+    """
+    Run time on cpus cores relative to one core, by Amdahl's law.
+    """
+    return serial_fraction + (1 - serial_fraction)/cpus
+
+
+def solve(matrix,vector):
+    """
+    Solve a linear system by Gaussian elimination with partial pivoting.
+    """
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col,n),key=lambda i: abs(rows[i][col]))
+        rows[col],rows[pivot] = rows[pivot],rows[col]
+        for i in range(col+1,n):
+            factor = rows[i][col]/rows[col][col]
+            for j in range(col,n+1):
+                rows[i][j] -= factor*rows[col][j]
+    solution = [0.0]*n
+    for i in reversed(range(n)):
+        solution[i] = (rows[i][n] - sum(rows[i][j]*solution[j] for j in range(i+1,n)))/rows[i][i]
+    return solution
+
+
+class LogLinearFit():
+    """
+    Least squares fit of log(y) on the size, the log size and read count, the cores and the categorical features.
+    """
+
+    def __init__(self,samples,values,quantile):
+        """
+        args:
+           - samples: list of features, as from sample_features, with the cores of the job
+           - values: observed value for each sample, e.g. peak memory in bytes
+           - quantile: quantile of the residuals added to the fit
+        """
+        self.levels = {name:sorted(set(sample[name] for sample in samples)) for name in CATEGORICAL}
+        cpus = set(sample['cpus'] for sample in samples)
+        # without a cores term the fit is for the cores all jobs had
+        self.fit_cpus = len(cpus) > 1
+        self.base_cpus = max(cpus)
+        rows = [self.design_row(sample) for sample in samples]
+        ys = [math.log(value) for value in values]
+        n = len(rows[0])
+        # normal equations with a small ridge on all terms but the intercept
+        xtx = [[sum(row[i]*row[j] for row in rows) + (RIDGE*len(rows) if i == j and i > 0 else 0.0) for j in range(n)] for i in range(n)]
+        xty = [sum(row[i]*y for row,y in zip(rows,ys)) for i in range(n)]
+        self.coefficients = solve(xtx,xty)
+        residuals = [y - self.log_fit(row) for row,y in zip(rows,ys)]
+        self.offset = stage_timeline.percentile(residuals,100*quantile)
+        self.n = len(rows)
+
+
+    def design_row(self,sample):
+        gb = max(sample['fastq_bytes'],1)/1024**3
+        reads = sample['reads'] if sample['reads'] else sample['fastq_bytes']/BYTES_PER_READ
+        row = [1.0, math.log(gb), gb, math.log(max(reads,1)/1e6)]
+        if self.fit_cpus:
+            row += [math.log(sample['cpus'])]
+        for name in CATEGORICAL:
+            # a level not seen in the fit gets no term
+            row += [1.0 if sample[name] == level else 0.0 for level in self.levels[name]]
+        return row
+
+
+    def log_fit(self,row):
+        return sum(coefficient*x for coefficient,x in zip(self.coefficients,row))
+
+
+    def predict(self,sample):
+        """
+        Value at the quantile for a sample.
+        """
+        return math.exp(self.log_fit(self.design_row(sample)) + self.offset)
+
+
+class ResourceModel():
+
+    def __init__(self,db_path,sys_config,clock=time.time):
+        """
+        args:
+           - db_path: SQLite database, the sample queue database
+           - sys_config: pipeline config, settings are read from [resources] if present
+           - clock: time source, epoch seconds
+        """
+        conf = sys_config['resources'] if 'resources' in sys_config else {}
+        self.mem_quantile   = float(conf.get('mem_quantile',MEM_QUANTILE))
+        self.mem_headroom   = float(conf.get('mem_headroom',MEM_HEADROOM))
+        self.time_quantile  = float(conf.get('time_quantile',TIME_QUANTILE))
+        self.time_headroom  = float(conf.get('time_headroom',TIME_HEADROOM))
+        self.min_jobs       = int(conf.get('min_jobs',MIN_JOBS))
+        self.refit_interval = float(conf.get('refit_interval',REFIT_INTERVAL))
+        self.min_mem        = float(conf.get('min_mem',MIN_MEM))
+        self.max_mem        = float(conf.get('max_mem',MAX_MEM))
+        self.min_minutes    = float(conf.get('min_minutes',MIN_MINUTES))
+        self.max_minutes    = float(conf.get('max_minutes',MAX_MINUTES))
+        self.serial_fraction = float(conf.get('serial_fraction',SERIAL_FRACTION))
+        self.mem_per_cpu    = float(conf.get('mem_per_cpu',MEM_PER_CPU))
+        self.db_path = db_path
+        self.clock = clock
+        self.mem_fit = None
+        self.time_fit = None
+        self.fitted_at = None
+        self.fit_lock = threading.Lock()
+        self.local = threading.local()
+        self.create_tables()
+
+
+    def connection(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=sample_queue_store.TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+
+    def create_tables(self):
+        self.connection().execute("""CREATE TABLE IF NOT EXISTS sample_features (
+            sample_id   TEXT PRIMARY KEY,
+            fastq_bytes REAL NOT NULL,
+            reads       REAL,
+            layout      TEXT NOT NULL,
+            species     TEXT NOT NULL,
+            sample_type TEXT NOT NULL)""")
+
+
+    def record_features(self,sample_id,features):
+        self.connection().execute(f'INSERT OR REPLACE INTO sample_features (sample_id,{",".join(FEATURE_COLUMNS)}) '
+            f'VALUES (?,{",".join("?"*len(FEATURE_COLUMNS))})', [sample_id] + [features[name] for name in FEATURE_COLUMNS])
+
+
+    def get_jobs(self,job_type='chips',since=None):
+        """
+        Cached jobs of a type with the features of their sample, in the order they were first seen.
+        returns:
+           - list of {column: value}, features are None for samples without recorded features
+        """
+        conn = self.connection()
+        if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='jobs'").fetchone() is None:
+            return []
+        columns = ['job_id','sample_id','state','max_rss','elapsed','req_mem','timelimit','cpus','end_time']
+        sql = (f'SELECT {",".join("jobs."+column for column in columns)},{",".join("sample_features."+name for name in FEATURE_COLUMNS)} '
+            'FROM jobs LEFT JOIN sample_features ON jobs.sample_id = sample_features.sample_id WHERE jobs.job_type=?')
+        params = [job_type]
+        if since is not None:
+            sql += ' AND jobs.end_time >= ?'
+            params += [since]
+        cursor = conn.execute(sql + ' ORDER BY jobs.rowid',params)
+        return [dict(zip(columns + FEATURE_COLUMNS,row)) for row in cursor]
+
+
+    def training_data(self):
+        """
+        Peak memory and run time of the samples whose CHIPS jobs completed.
+        The peak memory is the largest of the jobs that were not killed for memory; the run time
+        is only taken when the first job ran through, as a job resumed after a preemption is shorter.
+        returns:
+           - (memory data, time data), lists of (features with the cores of the job, peak memory in bytes or run time in seconds)
+        """
+        samples = {}
+        for job in self.get_jobs('chips'):
+            if job['fastq_bytes'] is not None:
+                samples.setdefault(job['sample_id'],[]).append(job)
+        mem_data,time_data = [],[]
+        for sample_id,jobs in samples.items():
+            if not any(job['state'] == 'COMPLETED' for job in jobs):
+                continue
+            features = {name:jobs[0][name] for name in FEATURE_COLUMNS}
+            peaks = [job for job in jobs if job['max_rss'] and job['state'] != 'OUT_OF_MEMORY']
+            if len(peaks) > 0:
+                peak = max(peaks,key=lambda job: job['max_rss'])
+                mem_data += [(dict(features,cpus=peak['cpus'] or 1),peak['max_rss'])]
+            if jobs[0]['state'] == 'COMPLETED' and jobs[0]['elapsed'] is not None:
+                time_data += [(dict(features,cpus=jobs[0]['cpus'] or 1),max(jobs[0]['elapsed'],MIN_ELAPSED))]
+        return mem_data,time_data
+
+
+    def fit(self):
+        """
+        Fit the memory and time models, a model is left out while fewer than min_jobs samples are known.
+        """
+        mem_data,time_data = self.training_data()
+        mem_fit,time_fit = None,None
+        if len(mem_data) >= self.min_jobs:
+            mem_fit = LogLinearFit(*zip(*mem_data),self.mem_quantile)
+        if len(time_data) >= self.min_jobs:
+            time_fit = LogLinearFit(*zip(*time_data),self.time_quantile)
+        with self.fit_lock:
+            self.mem_fit,self.time_fit = mem_fit,time_fit
+            self.fitted_at = self.clock()
+
+
+    def refresh(self):
+        if self.fitted_at is None or self.clock() - self.fitted_at >= self.refit_interval:
+            self.fit()
+
+
+    def request(self,features,default_mem,default_minutes,cpus=1):
+        """
+        Memory and time to request for a CHIPS job.
+        args:
+           - features: features of the sample, as from sample_features
+           - default_mem, default_minutes: requests on one core, used while there is no fit
+           - cpus: cores of the job
+        returns:
+           - (memory in MB, time in minutes)
+        """
+        self.refresh()
+        with self.fit_lock:
+            mem_fit,time_fit = self.mem_fit,self.time_fit
+        sample = dict(features,cpus=cpus)
+        mem,mem_cpus = default_mem,1
+        if mem_fit is not None:
+            mem = mem_fit.predict(sample)/1024**2*(1 + self.mem_headroom)
+            mem_cpus = cpus if mem_fit.fit_cpus else mem_fit.base_cpus
+        minutes,time_cpus = default_minutes,1
+        if time_fit is not None:
+            minutes = time_fit.predict(sample)/60*(1 + self.time_headroom)
+            time_cpus = cpus if time_fit.fit_cpus else time_fit.base_cpus
+        # from the cores the request is for to the cores of the job
+        mem += (cpus - mem_cpus)*self.mem_per_cpu
+        minutes *= parallel_time_factor(cpus,self.serial_fraction)/parallel_time_factor(time_cpus,self.serial_fraction)
+        mem = int(min(max(mem,self.min_mem),self.max_mem)) if mem_fit is not None else int(mem)
+        minutes = int(min(max(minutes,self.min_minutes),self.max_minutes)) if time_fit is not None else int(minutes)
+        return mem,minutes
+
+
+    def efficiency(self,job_type='chips',since=None):
+        """
+        Requested vs used memory and time of the completed jobs of a type, and of the model requests.
+        The FairShare charge of memory is the request times the run time, so memory is summed in GB hours.
+        returns:
+           - {name: value}
+        """
+        jobs = [job for job in self.get_jobs(job_type,since) if job['state'] == 'COMPLETED']
+        mem_jobs  = [job for job in jobs if job['max_rss'] and job['req_mem'] and job['elapsed'] is not None]
+        time_jobs = [job for job in jobs if job['elapsed'] is not None and job['timelimit']]
+        mem_eff  = [job['max_rss']/job['req_mem'] for job in mem_jobs]
+        time_eff = [job['elapsed']/job['timelimit'] for job in time_jobs]
+        report = {'jobs':len(jobs), 'memory_jobs':len(mem_eff), 'time_jobs':len(time_eff),
+            'requested_gb_hours':sum(job['req_mem']*job['elapsed'] for job in mem_jobs)/1024**3/3600,
+            'used_gb_hours':sum(job['max_rss']*job['elapsed'] for job in mem_jobs)/1024**3/3600}
+        for pct in stage_timeline.PERCENTILES[:2]:
+            report[f'memory_efficiency_p{pct}'] = stage_timeline.percentile(mem_eff,pct)
+            report[f'time_efficiency_p{pct}'] = stage_timeline.percentile(time_eff,pct)
+        if job_type == 'chips':
+            self.fit()
+            report.update(self.model_efficiency(mem_jobs,time_jobs))
+        return report
+
+
+    def model_efficiency(self,mem_jobs,time_jobs):
+        """
+        What the model would have requested for the same jobs, fitted on all of them.
+        """
+        report = {}
+        mem_jobs  = [job for job in mem_jobs if job['fastq_bytes'] is not None]
+        time_jobs = [job for job in time_jobs if job['fastq_bytes'] is not None]
+        if self.mem_fit is not None and len(mem_jobs) > 0:
+            requests = [self.request(job,0,0,job['cpus'] or 1)[0]*1024**2 for job in mem_jobs]
+            report['model_requested_gb_hours'] = sum(mem*job['elapsed'] for mem,job in zip(requests,mem_jobs))/1024**3/3600
+            report['model_memory_exceeded'] = len([1 for mem,job in zip(requests,mem_jobs) if job['max_rss'] > mem])/len(mem_jobs)
+        if self.time_fit is not None and len(time_jobs) > 0:
+            requests = [self.request(job,0,0,job['cpus'] or 1)[1]*60 for job in time_jobs]
+            report['model_time_exceeded'] = len([1 for minutes,job in zip(requests,time_jobs) if job['elapsed'] > minutes])/len(time_jobs)
+        return report
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_resource_model(configpath):
+    """
+    Return the resource model shared by the CHIPS submissions, creating it on first use.
+    """
+    with _models_lock:
+        if configpath not in _models:
+            sys_conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+            sys_conf.optionxform=str
+            sys_conf.read(configpath)
+            _models[configpath] = ResourceModel(sample_queue_store.get_db_path(sys_conf),sys_conf)
+        return _models[configpath]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Report requested vs used memory and time of pipeline jobs""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '-t', dest='job_type', type=str, default='chips', help='job type, e.g. chips or sra')
+    parser.add_argument( '--days', dest='days', type=float, default=None, help='only jobs that ended in the last days (default: all)')
+    args = parser.parse_args()
+
+    model = get_resource_model(args.configpath)
+    since = time.time() - args.days*86400 if args.days is not None else None
+    for name,value in model.efficiency(args.job_type,since).items():
+        print(f'{name}\t' + ('-' if value is None else '%.3g' % value))
+    for name,fit in [('memory',model.mem_fit),('time',model.time_fit)]:
+        if fit is not None:
+            print(f'{name} model: {fit.n} samples, coefficients ' + ' '.join('%.3g' % coefficient for coefficient in fit.coefficients))
+
+
+if __name__ == '__main__':
+    main()
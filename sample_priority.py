@@ -0,0 +1,236 @@
+"""
+Priority order in which the scheduler stages admit samples.
+Each stage walks its samples from the highest score down, so when a stage stops at
+a job limit the samples left waiting are the ones least worth the cluster time.
+The score is the product of the factors of the configured policies; it aims at the
+number of completed samples per FairShare hour: cheap, likely to succeed samples
+first, with waiting time raising the score so nothing starves.
+
+Policies and their weights are set in the [priority] section of the config, e.g.
+    [priority]
+    policies            = age,retries,size,sampletype,cistrome
+    chips_policies      = age,retries,sampletype,cistrome
+    age_scale_hours     = 24
+    retry_penalty       = 0.5
+    size_scale_gb       = 5
+    sampletype_weights  = tf:1.0,h3k27ac:1.0,dnase:0.8,atac:0.8
+
+To print the ranking of a stage:
+    python sample_priority.py -c config/rc-fas-harvard.conf --stage setup_and_run_chips
+"""
+
+import argparse
+import os
+import time
+
+import job_failures
+import requests_from_cistromeDB
+import sample_queue_store
+
+DEFAULT_POLICIES   = 'age,retries,size,sampletype,cistrome'
+AGE_SCALE_HOURS    = 24    # waiting this long doubles the score
+RETRY_PENALTY      = 0.5   # score factor per failed job or restart, failures counted as for max_fails (job_failures.py)
+SIZE_SCALE_GB      = 5     # a sample of this size has half the score of a tiny one
+DEFAULT_SIZE_GB    = 2     # used when the size of a sample is not known yet
+NO_CISTROME_ID_WEIGHT = 0.5
+FASTQ_SUFFIXES     = ['.fastq','.fastq.gz']
+GZIP_RATIO         = 4     # typical size of fastq relative to gzip compressed fastq
+
+# policies for stages that are not listed here are set by 'policies'
+STAGE_POLICY_KEYS = {
+    'download_from_sra':   'download_policies',
+    'setup_and_run_chips': 'chips_policies',
+    'check_chips_results': 'check_policies',
+    'transfer_to_server':  'transfer_policies',
+    'transfer_to_backup_server': 'backup_policies',
+}
+
+
+def age_policy(priority,sample_id,sample):
+    requested_at = sample.get('REQUESTED_AT')
+    if requested_at is None:
+        return 1.0
+    age_hours = max(0.0, priority.now() - float(requested_at))/3600
+    return 1.0 + age_hours/priority.age_scale_hours
+
+
+def retries_policy(priority,sample_id,sample):
+    retries  = int(sample.get('RESTARTS',0))
+    # preemptions and node failures say nothing about the sample
+    retries += job_failures.count_failures(sample.get('SRA'))
+    retries += job_failures.count_failures(sample.get('CHIPS'))
+    return priority.retry_penalty**retries
+
+
+def size_policy(priority,sample_id,sample):
+    size_gb = priority.sample_size_gb(sample_id,sample)
+    return 1.0/(1.0 + size_gb/priority.size_scale_gb)
+
+
+def sampletype_policy(priority,sample_id,sample):
+    sampletype = str(sample.get('sampletype','')).lower()
+    return priority.sampletype_weights.get(sampletype,1.0)
+
+
+def cistrome_policy(priority,sample_id,sample):
+    """
+    Priority set on the home server, otherwise samples without a CistromeID are worth less.
+    """
+    try:
+        return float(sample['priority'])
+    except (KeyError,TypeError,ValueError):
+        pass
+    cistrome_id = str(sample.get('CistromeID','NA'))
+    if cistrome_id.upper() in ['','NA','NONE']:
+        return priority.no_cistrome_id_weight
+    return 1.0
+
+
+POLICIES = {
+    'age':        age_policy,
+    'retries':    retries_policy,
+    'size':       size_policy,
+    'sampletype': sampletype_policy,
+    'cistrome':   cistrome_policy,
+}
+
+
+def parse_weights(weights_str):
+    """
+    'tf:1.0,atac:0.8' -> {'tf':1.0,'atac':0.8}
+    """
+    weights = {}
+    for item in weights_str.split(','):
+        if ':' in item:
+            key,val = item.split(':',1)
+            weights[key.strip().lower()] = float(val)
+    return weights
+
+
+def sample_fastq_names(sample_id):
+    """
+    Names the fastq files of a sample may have in the fastq directory, uncompressed or gzip compressed.
+    """
+    return [f'{sample_id}{name}{suffix}' for suffix in FASTQ_SUFFIXES for name in ['','_R1','_R2']]
+
+
+def fastq_bytes(fastq_path,fastq_names,sample_id):
+    """
+    Total size of the fastq files of a sample on scratch, 0 if not downloaded.
+    Compressed files are counted at GZIP_RATIO times their size, as uncompressed fastq.
+    """
+    size = 0
+    for name in sample_fastq_names(sample_id):
+        if name in fastq_names:
+            try:
+                size += os.path.getsize(os.path.join(fastq_path,name))*(GZIP_RATIO if name.endswith('.gz') else 1)
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class SamplePriority():
+
+    def __init__(self,sys_config,fastq_names=None,clock=time.time):
+        """
+        args:
+           - sys_config: pipeline config, policies are read from [priority] if present
+           - fastq_names: function returning the names in the fastq directory,
+             used to look up the size of downloaded samples (default: list the directory)
+           - clock: time source, epoch seconds
+        """
+        conf = sys_config['priority'] if sys_config.has_section('priority') else {}
+        self.conf = conf
+        self.fastq_path = sys_config['paths']['fastq']
+        self.fastq_names = fastq_names
+        self.names = None   # fastq directory listing, taken once per ranking
+        self.now = clock
+        self.age_scale_hours = float(conf.get('age_scale_hours',AGE_SCALE_HOURS))
+        self.retry_penalty   = float(conf.get('retry_penalty',RETRY_PENALTY))
+        self.size_scale_gb   = float(conf.get('size_scale_gb',SIZE_SCALE_GB))
+        self.default_size_gb = float(conf.get('default_size_gb',DEFAULT_SIZE_GB))
+        self.no_cistrome_id_weight = float(conf.get('no_cistrome_id_weight',NO_CISTROME_ID_WEIGHT))
+        self.sampletype_weights = parse_weights(conf.get('sampletype_weights',''))
+
+
+    def policies(self,stage_name=None):
+        policies_str = self.conf.get('policies',DEFAULT_POLICIES)
+        if stage_name in STAGE_POLICY_KEYS:
+            policies_str = self.conf.get(STAGE_POLICY_KEYS[stage_name],policies_str)
+        return [policy.strip() for policy in policies_str.split(',') if policy.strip() in POLICIES]
+
+
+    def list_fastq_names(self):
+        if self.fastq_names is not None:
+            self.names = self.fastq_names()
+        elif os.path.exists(self.fastq_path):
+            self.names = set(os.listdir(self.fastq_path))
+        else:
+            self.names = set()
+
+
+    def sample_size_gb(self,sample_id,sample):
+        """
+        Size of the sample fastq files if downloaded, otherwise the expected size if known.
+        """
+        if self.names is None:
+            self.list_fastq_names()
+        size = fastq_bytes(self.fastq_path,self.names,sample_id)
+        if size == 0 and 'EXPECTED_BYTES' in sample:
+            size = float(sample['EXPECTED_BYTES'])
+        if size == 0:
+            return self.default_size_gb
+        return size/1024**3
+
+
+    def factors(self,sample_id,sample,stage_name=None):
+        return {name:POLICIES[name](self,sample_id,sample) for name in self.policies(stage_name)}
+
+
+    def score(self,sample_id,sample,stage_name=None):
+        score = 1.0
+        for factor in self.factors(sample_id,sample,stage_name).values():
+            score *= factor
+        return score
+
+
+    def rank(self,samples,stage_name=None):
+        """
+        Order samples by decreasing score, ties keep their queue order.
+        args:
+           - samples: list of (sample_id, sample_info)
+        returns:
+           - list of (sample_id, sample_info)
+        """
+        self.list_fastq_names()
+        scores = {sample_id:self.score(sample_id,sample,stage_name) for sample_id,sample in samples}
+        return sorted(samples, key=lambda item: -scores[item[0]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Print the order in which a scheduler stage admits samples""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '--stage', dest='stage', type=str, default=None, help='scheduler stage, e.g. setup_and_run_chips (default: all unfinished samples)')
+    parser.add_argument( '-n', dest='n', type=int, default=50, help='number of samples to print')
+    args = parser.parse_args()
+
+    import scheduler
+    sample_queue = requests_from_cistromeDB.SampleQueue(args.configpath)
+    if args.stage is not None:
+        sample_queue.read_local_queue(stages=scheduler.stage_inputs[args.stage])
+    else:
+        sample_queue.read_local_queue(stages=requests_from_cistromeDB.STAGES[:-1])
+    samples = list(sample_queue.get_local_queue().items())
+
+    priority = SamplePriority(sample_queue.sys_conf)
+    policies = priority.policies(args.stage)
+    print('\t'.join(['rank','sample_id','stage','score'] + policies))
+    for i,(sample_id,sample) in enumerate(priority.rank(samples,args.stage)[:args.n]):
+        factors = priority.factors(sample_id,sample,args.stage)
+        row = [str(i+1), sample_id, sample.get('STAGE',sample_queue_store.DEFAULT_STAGE), '%.3g' % priority.score(sample_id,sample,args.stage)]
+        row += ['%.3g' % factors[name] for name in policies]
+        print('\t'.join(row))
+
+
+if __name__ == '__main__':
+    main()
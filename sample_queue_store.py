@@ -0,0 +1,296 @@
+"""
+SQLite store for the local sample queue.
+Each sample is one row, and every update is a read-modify-write of that row inside
+its own transaction, so concurrent scheduler threads (and processes) cannot overwrite
+each other's changes. The database runs in WAL mode so readers do not block the writer.
+Stage transitions and job starts of the samples are appended to the stage_events table
+in the same transaction, see stage_timeline.py for the report.
+
+To migrate an existing JSON queue file:
+    python sample_queue_store.py -c config/rc-fas-harvard.conf --migrate
+"""
+
+import argparse
+import configparser
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import job_failures
+
+TIMEOUT = 60 # seconds to wait for a lock held by another writer
+
+DEFAULT_STAGE = 'REQUESTED'
+
+INDEX_COLUMNS = {
+    'stage':            "TEXT NOT NULL DEFAULT 'REQUESTED'",
+    'sra_fails':        'INTEGER NOT NULL DEFAULT 0',
+    'chips_fails':      'INTEGER NOT NULL DEFAULT 0',
+    'chips_check_runs': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+COLUMNS = ['sample_id','process_status','restarts'] + list(INDEX_COLUMNS) + ['info']
+
+# version of the index column definitions, the index columns are recomputed when it changes
+INDEX_VERSION = 2
+
+
+def status_count(sample,info_key,status=''):
+    """
+    Number of cluster jobs of one type recorded for a sample, optionally only those with a given status.
+    """
+    jobs = sample.get(info_key)
+    if not isinstance(jobs,dict):
+        return 0
+    return len([val for val in jobs.values() if status == '' or val == status])
+
+
+class SampleQueueStore():
+
+    def __init__(self,db_path,clock=time.time):
+        self.db_path = db_path
+        self.clock = clock             # time source of the stage events, epoch seconds
+        self.local = threading.local() # sqlite connections can not be shared between threads
+        self.create_tables()
+
+
+    def connection(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            # autocommit mode, transactions are opened explicitly
+            conn = sqlite3.connect(self.db_path, timeout=TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+
+    def create_tables(self):
+        conn = self.connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS samples (
+            sample_id      TEXT PRIMARY KEY,
+            process_status TEXT,
+            restarts       INTEGER NOT NULL DEFAULT 0,
+            info           TEXT NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS stage_events (
+            sample_id TEXT NOT NULL,
+            event     TEXT NOT NULL,
+            time      REAL NOT NULL)""")
+        conn.execute('CREATE INDEX IF NOT EXISTS stage_events_sample_id ON stage_events (sample_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS stage_events_time ON stage_events (time)')
+        # secondary index columns, derived from info on every write
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(samples)')]
+        missing = [column for column in INDEX_COLUMNS if column not in columns]
+        for column in missing:
+            conn.execute(f'ALTER TABLE samples ADD COLUMN {column} {INDEX_COLUMNS[column]}')
+        for column in ['process_status','restarts'] + list(INDEX_COLUMNS):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS samples_{column} ON samples ({column})')
+        if len(missing) > 0 or conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+            self.reindex()
+            conn.execute(f'PRAGMA user_version={INDEX_VERSION}')
+
+
+    def reindex(self):
+        """
+        Recompute the index columns of all samples from their info.
+        """
+        self.put_samples(self.read_all())
+
+
+    @staticmethod
+    def row_values(sample_id,sample):
+        return (sample_id, sample.get('process_status'), int(sample.get('RESTARTS',0)), 
+            sample.get('STAGE',DEFAULT_STAGE), 
+            job_failures.count_failures(sample.get('SRA')), job_failures.count_failures(sample.get('CHIPS')), status_count(sample,'CHIPS_CHECK'),
+            json.dumps(sample))
+
+
+    def read_all(self):
+        cursor = self.connection().execute('SELECT sample_id, info FROM samples ORDER BY rowid')
+        return {sample_id:json.loads(info) for sample_id,info in cursor}
+
+
+    def read_where(self,where,params=()):
+        """
+        Read the samples matching an SQL condition on the index columns.
+        """
+        cursor = self.connection().execute(f'SELECT sample_id, info FROM samples WHERE {where} ORDER BY rowid',params)
+        return {sample_id:json.loads(info) for sample_id,info in cursor}
+
+
+    def select_ids(self,where,params=()):
+        cursor = self.connection().execute(f'SELECT sample_id FROM samples WHERE {where} ORDER BY rowid',params)
+        return [row[0] for row in cursor]
+
+
+    def count_by(self,column):
+        cursor = self.connection().execute(f'SELECT {column}, COUNT(*) FROM samples GROUP BY {column}')
+        return {key:n for key,n in cursor}
+
+
+    def get_sample(self,sample_id):
+        row = self.connection().execute('SELECT info FROM samples WHERE sample_id=?',(sample_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+
+    def count(self):
+        return self.connection().execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+
+
+    def modify_sample(self,sample_id,modify):
+        """
+        Atomically apply modify(sample) to the stored sample.
+        args:
+           - sample_id: sample to update
+           - modify: function that changes the sample dictionary in place. It can return
+             a list of (event, time) to record in stage_events, time None for now.
+        returns:
+           - the updated sample, or None if the sample is not in the store
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT info FROM samples WHERE sample_id=?',(sample_id,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None
+            sample = json.loads(row[0])
+            events = modify(sample)
+            values = self.row_values(sample_id,sample)
+            assignments = ', '.join([f'{column}=?' for column in COLUMNS[1:]])
+            conn.execute(f'UPDATE samples SET {assignments} WHERE sample_id=?', values[1:] + (sample_id,))
+            if events:
+                now = self.clock()
+                conn.executemany('INSERT INTO stage_events (sample_id, event, time) VALUES (?,?,?)',
+                    [(sample_id, event, now if event_time is None else event_time) for event,event_time in events])
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return sample
+
+
+    def add_samples(self,samples):
+        """
+        Add samples that are not yet in the store, existing samples are left unchanged.
+        A REQUESTED event is recorded for the samples added, at their REQUESTED_AT time if set.
+        returns:
+           - number of samples added
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            added = 0
+            now = self.clock()
+            for sample_id,sample in samples.items():
+                cursor = conn.execute(f'INSERT OR IGNORE INTO samples ({",".join(COLUMNS)}) VALUES ({",".join("?"*len(COLUMNS))})',
+                    self.row_values(sample_id,sample))
+                if cursor.rowcount == 1:
+                    conn.execute('INSERT INTO stage_events (sample_id, event, time) VALUES (?,?,?)',
+                        (sample_id, DEFAULT_STAGE, float(sample.get('REQUESTED_AT',now))))
+                    added += 1
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return added
+
+
+    def put_samples(self,samples):
+        """
+        Insert or replace samples.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(f'INSERT OR REPLACE INTO samples ({",".join(COLUMNS)}) VALUES ({",".join("?"*len(COLUMNS))})',
+                [self.row_values(sample_id,sample) for sample_id,sample in samples.items()])
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+
+    def read_events(self,since=None):
+        """
+        Stage events, ordered by sample and time.
+        args:
+           - since: only events of samples with an event at or after this time (epoch seconds)
+        returns:
+           - list of (sample_id, event, time)
+        """
+        if since is None:
+            cursor = self.connection().execute('SELECT sample_id, event, time FROM stage_events ORDER BY sample_id, time, rowid')
+        else:
+            cursor = self.connection().execute('''SELECT sample_id, event, time FROM stage_events 
+                WHERE sample_id IN (SELECT DISTINCT sample_id FROM stage_events WHERE time >= ?) ORDER BY sample_id, time, rowid''',(since,))
+        return cursor.fetchall()
+
+
+    def import_json(self,json_path):
+        """
+        Migrate a JSON queue file ({'samples_to_be_processed': {...}}) into the store.
+        """
+        with open(json_path) as fp:
+            local_samples = json.load(fp)
+        samples = local_samples.get('samples_to_be_processed',{})
+        self.put_samples(samples)
+        return len(samples)
+
+
+    def export_json(self,json_path):
+        with open(json_path,'w') as fp:
+            json.dump({'samples_to_be_processed':self.read_all()},fp)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(db_path):
+    """
+    Return the shared store for a database file, creating it on first use.
+    """
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = SampleQueueStore(db_path)
+        return _stores[db_path]
+
+
+def get_db_path(sys_conf):
+    """
+    The store is configured by [process_server] local_queue_db, by default it sits
+    next to the JSON local_queue_file it replaces.
+    """
+    if 'local_queue_db' in sys_conf['process_server']:
+        return sys_conf['process_server']['local_queue_db']
+    local_queue_file = sys_conf['process_server']['local_queue_file']
+    return os.path.splitext(local_queue_file)[0] + '.sqlite'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Manage the SQLite sample queue store""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '--migrate', dest='migrate', type=str, nargs='?', const='', default=None, help='import a JSON queue file (default: local_queue_file)')
+    parser.add_argument( '--export', dest='export', type=str, default=None, help='write the queue to a JSON file')
+    args = parser.parse_args()
+
+    sys_conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    sys_conf.optionxform=str
+    sys_conf.read(args.configpath)
+    store = get_store(get_db_path(sys_conf))
+
+    if args.migrate is not None:
+        json_path = args.migrate or sys_conf['process_server']['local_queue_file']
+        n_samples = store.import_json(json_path)
+        print(f'imported {n_samples} samples from {json_path}')
+    if args.export is not None:
+        store.export_json(args.export)
+        print(f'exported {store.count()} samples to {args.export}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
 import datetime
 import os,sys,time
+import subprocess
 from socket import gethostname
 import argparse
 
+import job_spool
+
 # ===============================================================================================
 #
 # Note: the files sbatch_configuration_for_CLUSTERNAME and environment_for_CLUSTERNAME
 # need to be defined as part of the configuration of CLUSTERNAME
-# Note: the configuration function is looked up using the domain name.
+# Note: the configuration function is looked up using the domain name,
+# or the CISTROME_CLUSTER environment variable if set.
 #
 # ===============================================================================================
 
 def get_domain_name():
+    # set CISTROME_CLUSTER to use a cluster configuration elsewhere, e.g. with fake_slurm.py
+    if 'CISTROME_CLUSTER' in os.environ:
+        return os.environ['CISTROME_CLUSTER']
     name = gethostname()
     name = name.split('.')[-4:]
     name = '.'.join(name)
@@ -29,7 +36,7 @@ def time_format_as_day_hr_min(minutes):
 
 class SbatchHeader():
 
-    def __init__(self,  nodes=1, cpus=1, time=1, mem=1, job_name='test', partition='test', log_filename='test_log_tmp'):
+    def __init__(self,  nodes=1, cpus=1, time=1, mem=1, job_name='test', partition=None, log_filename='test_log_tmp', array_size=None, array_limit=None):
 
         """ Configuration note: cluster specific header configuration register. Add method to generate sbatch header below."""
         self.cluster_register = {'rc.fas.harvard.edu':self.sbatch_configuration_for_odyssey,'O2':self.sbatch_configuration_for_O2}
@@ -44,6 +51,9 @@ class SbatchHeader():
         self.mem_Mb = str(mem)
         self.log_filename = log_filename
         self.job_name = job_name
+        self.partition = partition      # None: chosen by the cluster configuration
+        self.array_size = array_size    # number of tasks in a job array
+        self.array_limit = array_limit  # maximum number of array tasks running at the same time
  
     def __str__(self):
         tmp_str  = self.cluster_str_method()
@@ -57,6 +67,8 @@ class SbatchHeader():
         #    partition = 'shared'
         if self.time < 10:
             partition = 'test'
+        elif self.partition is not None:
+            partition = self.partition
         else:
             partition = 'serial_requeue'  # serial_request is half the cost of other queues
 
@@ -65,12 +77,17 @@ class SbatchHeader():
         header  = ['#!/bin/bash']
         header += [f'#SBATCH --job-name={self.job_name}']
         header += [f'#SBATCH --nodes {self.nodes}']
-        header += [f'#SBATCH -n {self.cpus}']
+        # one task, its threads on cpus cores of the node
+        header += [f'#SBATCH --ntasks 1']
+        header += [f'#SBATCH --cpus-per-task {self.cpus}']
         header += [f'#SBATCH --time {day_hr_min}']
         header += [f'#SBATCH --mem={self.mem_Mb}MB']
         header += [f'#SBATCH --partition {partition}']
         header += [f'#SBATCH -o {self.log_filename}']
         header += [f'#SBATCH --no-requeue'] # so the same job is not submitted twice
+        if self.array_size is not None:
+            array_limit = f'%{self.array_limit}' if self.array_limit else ''
+            header += [f'#SBATCH --array=0-{self.array_size-1}{array_limit}']
         header += ['']
         return '\n'.join(header) 
 
@@ -100,11 +117,74 @@ def write_sbatch(cmd, sbatch_path='', header=''):
         fp.write(cmd)
 
 
-def submit_sbatch(sbatch_path):
-    if os.path.exists(sbatch_path):
-        os.system(f'sbatch {sbatch_path}')
+def write_manifest(sample_ids, manifest_path):
+    """
+    Job array manifest: line i holds the sample id of array task i.
+    """
+    with open(manifest_path, "w") as fp:
+        for sample_id in sample_ids:
+            fp.write(f'{sample_id}\n')
+
+
+def array_task_cmd(cmd, manifest_path, task_jobname_suffix='', task_log='', spool_dir=None):
+    """
+    Wrap a command so that each array task runs it for its own sample.
+    The sample id of the task is read from the manifest into $SAMPLE_ID, which cmd and task_log can use.
+    The task renames itself to {SAMPLE_ID}_{suffix}, the name single sample jobs have, 
+    so squeue and sacct report it per sample.
+    With spool_dir each task writes a completion record there when it exits, see job_spool.py.
+    """
+    task_cmd  = f'SAMPLE_ID=$(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" {manifest_path})\n'
+    if spool_dir is not None:
+        task_cmd += job_spool.spool_trap_cmd(spool_dir, task_jobname_suffix)
+    if task_jobname_suffix != '':
+        task_cmd += f'scontrol update JobId=${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}} JobName=${{SAMPLE_ID}}_{task_jobname_suffix} || true\n'
+    if task_log != '':
+        task_cmd += f'{cmd} >> {task_log} 2>&1\n'
     else:
+        task_cmd += f'{cmd}\n'
+    return task_cmd
+
+
+def submit_sbatch(sbatch_path):
+    """
+    Submit an sbatch file.
+    returns:
+       - SLURM job id, or None if the submission failed
+    """
+    if not os.path.exists(sbatch_path):
         print('sbatch file is missing')
+        return None
+    ret = subprocess.run(['sbatch','--parsable',sbatch_path],capture_output=True)
+    if ret.returncode != 0:
+        print('sbatch failed:', str(ret.stderr,'utf-8'))
+        return None
+    # --parsable prints jobid or jobid;cluster
+    return str(ret.stdout,'utf-8').strip().split(';')[0]
+
+
+def create_sbatch(cmd, sbatch_path, time=1, mem=200, job_name='test', partition=None, log_filename='tmp.log', nodes=1, cpus=1,
+        manifest_path=None, array_limit=None, task_jobname_suffix='', task_log='', spool_dir=None, submit=False):
+    """
+    Write an sbatch file and optionally submit it, without starting a new interpreter.
+    args:
+       - manifest_path: job array manifest, cmd is then run by each array task with $SAMPLE_ID set
+       - spool_dir: array tasks write completion records to this spool directory
+       - submit: submit the sbatch file
+    returns:
+       - SLURM job id if submitted, otherwise None
+    """
+    array_size = None
+    if manifest_path is not None:
+        with open(manifest_path) as fp:
+            array_size = len([line for line in fp if line.strip() != ''])
+        cmd = array_task_cmd(cmd, manifest_path, task_jobname_suffix=task_jobname_suffix, task_log=task_log, spool_dir=spool_dir)
+
+    header = SbatchHeader(nodes=nodes, cpus=cpus, time=time, mem=mem, job_name=job_name, partition=partition, log_filename=log_filename, array_size=array_size, array_limit=array_limit)
+    write_sbatch( cmd, sbatch_path=sbatch_path, header=header.__str__())
+    if submit == True:
+        return submit_sbatch(sbatch_path)
+    return None
 
 
 def main():
@@ -112,22 +192,26 @@ def main():
     parser.add_argument( '--cmd',       dest='cmd_str',   type=str, required=True,                       help='command to be executed')
     parser.add_argument( '--time',      dest='time',      type=int, required=False, default=1,           help='time in minutes')
     parser.add_argument( '--mem',       dest='mem',       type=int, required=False, default=200,         help='memory in Mb')
-    parser.add_argument( '--partition', dest='partition', type=str, required=False, default='test',      help='name of partition')
+    parser.add_argument( '--partition', dest='partition', type=str, required=False, default=None,        help='name of partition (default: chosen by the cluster configuration)')
     parser.add_argument( '--nodes',     dest='nodes',     type=int, required=False, default=1,           help='number of nodes')
     parser.add_argument( '--cpus',      dest='cpus',      type=int, required=False, default=1,           help='number of cpus')
     parser.add_argument( '--jobname',   dest='jobname',   type=str, required=False, default='test',      help='job name')
     parser.add_argument( '--log',       dest='logfile',   type=str, required=False, default='tmp.log',   help='log file name')
     parser.add_argument( '--sbatchfile',dest='sbatchfile',type=str, required=False, default='tmp.sbatch',help='sbatch file name') # TODO default to stdout
+    parser.add_argument( '--manifest',  dest='manifest',  type=str, required=False, default=None,        help='job array manifest, one sample id per line; cmd can use $SAMPLE_ID')
+    parser.add_argument( '--array-limit',dest='array_limit',type=int, required=False, default=None,      help='maximum number of array tasks running at the same time')
+    parser.add_argument( '--task-jobname',dest='task_jobname',type=str, required=False, default='',     help='array tasks are renamed to {SAMPLE_ID}_{task-jobname}')
+    parser.add_argument( '--task-log',  dest='task_log',  type=str, required=False, default='',          help='per task log file; can use $SAMPLE_ID')
+    parser.add_argument( '--spool',     dest='spool_dir', type=str, required=False, default=None,        help='array tasks write completion records to this spool directory')
     parser.add_argument( '--submit',    dest='submit', action='store_true', help='submit job to sbatch queue')
     #parser.add_argument( '--config', dest='configpath', type=str, required=False, help='the path of config file')
 
     args = parser.parse_args()
-    header = SbatchHeader(nodes=args.nodes, cpus=args.cpus, time=args.time, mem=args.mem, job_name=args.jobname, partition=args.partition, log_filename=args.logfile)
-    
-    write_sbatch( args.cmd_str, sbatch_path=args.sbatchfile, header=header.__str__())
-    if args.submit == True:
-        time.sleep(1)
-        submit_sbatch(args.sbatchfile)
+    job_id = create_sbatch( args.cmd_str, args.sbatchfile, time=args.time, mem=args.mem, job_name=args.jobname, partition=args.partition, 
+        log_filename=args.logfile, nodes=args.nodes, cpus=args.cpus, manifest_path=args.manifest, array_limit=args.array_limit, 
+        task_jobname_suffix=args.task_jobname, task_log=args.task_log, spool_dir=args.spool_dir, submit=args.submit )
+    if job_id is not None:
+        print(job_id)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,8 @@
 """
 This script controls the entire processing pipeline from raw data download to 
 chips pipeline execution and data transfer to backup and to the home server.
-The script runs jobs asynchronously and submits larger jobs to other nodes by SLURM sbatch.
+The stages are run by a single event-driven scheduler core (scheduler_core.py) 
+and larger jobs are submitted to other nodes by SLURM sbatch.
 This script is run on a work node like this: 
     sbatch schedule.sbatch
 """
@@ -9,18 +10,29 @@ This script is run on a work node like this:
 import argparse
 import configparser
 import datetime
-from functools import wraps
-import glob
+import itertools
 import json
+import math
 import os
 import re
-import sched
 import subprocess
 import time
-from threading import Thread
 
 import requests_from_cistromeDB
+import chips_job_submission
 import cluster_stats
+import fairshare_throttle
+import job_failures
+import job_spool
+import job_state_cache
+import metrics_exporter
+import ncbi_metadata
+import sample_priority
+import scratch_admission
+import sbatch_header
+import sra_download
+import scheduler_core
+import state_scanner
 
 DEBUG = False
 
@@ -31,19 +43,69 @@ HOUR = 60*MINUTE
 DAY = 24*HOUR
 
 # This is the schedule for the steps in the processing pipeline.
+# Each step runs a full pass at its interval and is also run as soon as upstream steps finish samples.
 # setup_and_run_chips is the main and longest phase.
 # transfer_to_server and transfer_to_backup_server can be bottlenecks depending on network bandwidth and traffic.
 event_sched = {
-    'update_samples_in_local_queue':  { 'start_time': {'hr':START_HOUR,'min':10,'sec':0}, 'interval': DAY },
-    'download_from_sra':              { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': HOUR },
-    'setup_and_run_chips':            { 'start_time': {'hr':START_HOUR,'min':15,'sec':0}, 'interval': 30*MINUTE },
-    'check_chips_results':            { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': HOUR },
-    'transfer_to_server':             { 'start_time': {'hr':START_HOUR,'min':40,'sec':0}, 'interval': HOUR },
-    'transfer_to_backup_server':      { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': DAY },
-    'clean_up_after_completion':      { 'start_time': {'hr':START_HOUR,'min':55,'sec':0}, 'interval': HOUR },
-    'test':                           { 'start_time': {'hr':START_HOUR,'min':22,'sec':0}, 'interval': 10*MINUTE }
+    'update_samples_in_local_queue':  { 'start_time': {'hr':START_HOUR,'min':10,'sec':0}, 'interval': DAY,         'downstream': ['download_from_sra'] },
+    'download_from_sra':              { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': HOUR,        'downstream': ['setup_and_run_chips'] },
+    'setup_and_run_chips':            { 'start_time': {'hr':START_HOUR,'min':15,'sec':0}, 'interval': 30*MINUTE,   'downstream': ['check_chips_results'] },
+    'check_chips_results':            { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': HOUR,        'downstream': ['transfer_to_server','transfer_to_backup_server'] },
+    'transfer_to_server':             { 'start_time': {'hr':START_HOUR,'min':40,'sec':0}, 'interval': HOUR,        'downstream': ['clean_up_after_completion'] },
+    'transfer_to_backup_server':      { 'start_time': {'hr':START_HOUR,'min':50,'sec':0}, 'interval': DAY,         'downstream': ['clean_up_after_completion'] },
+    'clean_up_after_completion':      { 'start_time': {'hr':START_HOUR,'min':55,'sec':0}, 'interval': HOUR,        'downstream': [] },
+    'test':                           { 'start_time': {'hr':START_HOUR,'min':22,'sec':0}, 'interval': HOUR,        'downstream': [] }
 }
 
+# stages run once when the scheduler starts, before they follow their schedule, [process_server] startup_stages
+STARTUP_STAGES = ['update_samples_in_local_queue','download_from_sra','setup_and_run_chips','check_chips_results',
+    'transfer_to_server','transfer_to_backup_server','clean_up_after_completion']
+
+# seconds between checks of samples with jobs in flight
+COMPLETION_POLL_INTERVAL = 2*MINUTE
+
+# resources of an SRA download task, retries can ask for more, see job_failures.py
+# fixed while the size of a sample is not known, otherwise from its expected fastq size (EXPECTED_BYTES,
+# from the NCBI run info), settings in [sra_download]: base_minutes, minutes_per_gb, max_minutes, base_mem, mem_per_gb, max_mem
+SRA_TIME_MINUTES = 300
+SRA_MEM = 2000
+SRA_BASE_MINUTES = 30
+SRA_MINUTES_PER_GB = 10
+SRA_MAX_MINUTES = 48*60
+SRA_BASE_MEM = 1000
+SRA_MEM_PER_GB = 25
+SRA_MAX_MEM = 8000
+# requests are rounded up to these steps, so that samples of similar size share a job array
+SRA_TIME_STEPS = [60,120,240,480,720,1440,2880]
+SRA_MEM_STEP = 500
+SRA_CPUS = 1 # [sra_download] cpus, cores for the runs converted at the same time
+SRA_GZIP = False # [sra_download] gzip, write compressed fastq files
+
+# exit codes of batch scripts killed by a signal, SIGKILL after running out of memory or SIGTERM at the time limit
+KILLED_EXIT_CODES = [137,143]
+
+# sacct states of jobs that ended; a preempted job may be requeued under the same job id
+JOB_END_STATES = ['COMPLETED','FAILED','CANCELLED','TIMEOUT','DEADLINE','OUT_OF_MEMORY','NODE_FAIL','BOOT_FAIL']
+
+# stage that submits the jobs of each job type
+job_type_stages = {
+    'sra':         'download_from_sra',
+    'chips':       'setup_and_run_chips',
+    'chips_check': 'check_chips_results',
+}
+
+# pipeline stages (requests_from_cistromeDB.STAGES) of the samples each step looks at on a full pass
+stage_inputs = {
+    'download_from_sra':         ['REQUESTED','SRA_SUBMITTED'],
+    'setup_and_run_chips':       ['SRA_SUBMITTED','FASTQ_READY','CHIPS_SUBMITTED'],
+    'check_chips_results':       ['CHIPS_SUBMITTED','CHIPS_COMPLETE','CHECK_SUBMITTED'],
+    'transfer_to_server':        ['CHECK_SUBMITTED','CHECKED','BACKED_UP'],
+    'transfer_to_backup_server': ['CHECKED','TRANSFERRED'],
+    'clean_up_after_completion': ['TRANSFERRED','BACKED_UP'],
+}
+
+ERROR_STATUS = ['DOWNLOAD_ERROR','PROCESSING_ERROR']
+
 
 def replace_multiplier(string):
     multiplier = {'K':2**10,'M':2**20,'G':2**30,'T':2**40,'P':2**50}
@@ -68,88 +130,52 @@ def set_next_hour_minute(hour,minute,second):
     return set_time_epoch_secs
 
 
-def asynch(func):
-    @wraps(func)
-    def async_func(*args, **kwargs):
-        func_h1 = Thread(target=func, args=args, kwargs=kwargs)
-        func_h1.start()
-        return func_h1
-    return async_func
-
-
-def schedule(init_time,interval=24*60*60):
+def select_samples(samples_to_process,samples=None,stage_name=None):
     """
-    Function scheduler
-    args:
-        - init_time: initial time for running function
-        - interval: interval between runs in seconds 
-    """
-    def decorator(func):
-        def periodic(scheduler, interval, action, actionargs=()):
-            print('periodic')
-            priority = 1
-            scheduler.enter(interval,priority,periodic, (scheduler,interval,action,actionargs))
-            action(*actionargs)
-
-        def first_run(scheduler, init_time, interval, action, actionargs=()):
-            print('first')
-            priority = 1
-            init_time = set_next_hour_minute(init_time['hr'],init_time['min'],init_time['sec'])
-            scheduler.enterabs(init_time,priority,periodic, (scheduler,interval,action,actionargs))
-            action(*actionargs)
-
-        @wraps(func)
-        def wrap(*args, **kwargs):
-            scheduler = sched.scheduler(time.time, time.sleep)
-            first_run(scheduler, init_time, interval, func)
-            scheduler.run()
-        return wrap
-    return decorator
-
-
-def match_sbatch_history(suffix='',jobs_name=[],jobs_status=[],jobs_id=[]):
-    """
-    find jobs in jobs_name list matching suffix-based pattern.
+    Restrict a stage pass to the samples on its ready queue, in priority order (sample_priority.py).
     args:
-       - suffix: indictates the type of job we want to find
-       - jobs_name: list is jobs in history
-       - jobs_status: status on SLURM
-       - jobs_id: SLURM job id numbers
+       - samples_to_process: local sample queue
+       - samples: ready sample ids, or None for a full pass over the queue
+       - stage_name: stage the samples are ranked for
     returns:
-       e.g.
-       - {GSM001: {'type': 'chips', 'status': 'RUNNING' }}
-
+       - list of (external_id, sample_info)
     """
-    pattern    = re.compile(f'([a-zA-Z0-9]+)_{suffix}\Z')
-    job_status = {}
+    if samples is None:
+        selected = list(samples_to_process.items())
+    else:
+        selected = [(external_id,samples_to_process[external_id]) for external_id in samples if external_id in samples_to_process]
+    if Config.priority is None:
+        return selected
+    return Config.priority.rank(selected,stage_name)
 
-    for i,jobname in enumerate(jobs_name):
-        status = jobs_status[i]
-        job_id = jobs_id[i]
-        match  = pattern.match(jobname)
-        if not isinstance(match,type(None)):
-            job_type = suffix
-            sampleid = match.group(1)
-            job_status[sampleid] = {'type':job_type, 'status':{job_id:status}}
 
-    return job_status
+def read_samples_for_stage(sample_queue,stage_name,samples=None,process_status=None):
+    """
+    Read the part of the sample queue a step needs: the ready samples, or 
+    on a full pass the samples in the step's input stages.
+    """
+    if samples is not None:
+        sample_queue.read_local_queue(sample_ids=samples)
+    else:
+        sample_queue.read_local_queue(stages=stage_inputs[stage_name],process_status=process_status)
+    return sample_queue.get_local_queue()
 
 
-@asynch
-@schedule( event_sched['update_samples_in_local_queue']['start_time'],interval=event_sched['update_samples_in_local_queue']['interval'])
-def update_samples_in_local_queue():
+def update_samples_in_local_queue(samples=None):
     """
     Check the requested sample file on the home server (via http) and update local list.
+    returns:
+       - ids of samples that were newly added to the local queue
     """
     configpath = Config.configpath
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
+    known_samples = set(sample_queue.get_sample_ids())
     sample_queue.update_local_queue()
+    return set(sample_queue.get_sample_ids()) - known_samples
 
 
 def fastq_check(external_id):
-    fastq_path = Config.sys_config['paths']['fastq']
-    sample_check_path = os.path.join(fastq_path,f'{external_id}.check')
-    return os.path.exists(sample_check_path)         
+    return Config.state_scanner.has_marker(external_id,'fastq_check')
 
 
 def filter_fastq_samples(sample_set):
@@ -164,95 +190,234 @@ def filter_fastq_samples(sample_set):
 
 
 def get_fastq_sample_number():
-    fastq_path = Config.sys_config['paths']['fastq']
-    sample_check_path = os.path.join(fastq_path,'*.fastq')
     # count paired end files for same sample as one
-    fastq_list = [os.path.split(elem)[1] for elem in glob.glob(sample_check_path)]
+    fastq_list = [elem for elem in Config.state_scanner.fastq_names() if elem.endswith(tuple(sample_priority.FASTQ_SUFFIXES))]
     fastq_list = [elem.split('.')[0] for elem in fastq_list]
     fastq_set  = set([elem.split('_')[0] for elem in fastq_list])
     fastq_set = filter_fastq_samples(fastq_set)
     return len(fastq_set)
 
 
-@asynch
-@schedule( event_sched['download_from_sra']['start_time'], interval=event_sched['download_from_sra']['interval'])
-def download_from_sra():
+def is_sample_job_in_queue(cluster_status,external_id,sample_info,job_suffix):
+    """
+    A sample job is in the queue under its own name {ID}_{suffix}, 
+    or by one of the job ids recorded for the sample when it was submitted, 
+    e.g. a pending task of a job array.
+    """
+    if cluster_status.is_job_name_in_queue(f'{external_id}_{job_suffix}') == True:
+        return True
+    job_ids = sample_info.get(job_suffix.upper(),{})
+    if not isinstance(job_ids,dict):
+        return False
+    return any( cluster_status.is_job_id_in_queue(job_id) for job_id in job_ids )
+
+
+def record_submitted_job(sample_queue,cluster_status,external_id,job_suffix,job_id,partition=None):
+    """
+    Record a submitted job by id in the sample queue, under the job type key, e.g. SRA: {job_id: PENDING}, 
+    and in the cached cluster queue.
+    """
+    sample_queue.set_sample_info( sample_id=external_id, info_key=job_suffix, info_val={job_id:'PENDING'})
+    cluster_status.record_submitted_job(f'{external_id}_{job_suffix}',job_id=job_id,partition=partition)
+
+
+# sequence number of the job arrays submitted by this process, arrays submitted in the same second get distinct names
+array_sequence = itertools.count()
+
+
+def array_jobname(sbatch_dir,job_suffix):
+    """
+    Name of a new job array, {type}_array_{date}_{n}, with no sbatch file or manifest of that name yet:
+    the tasks of an array read their sample from the manifest when they start.
+    """
+    date = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    while True:
+        jobname = f'{job_suffix}_array_{date}_{next(array_sequence)}'
+        if not os.path.exists(os.path.join(sbatch_dir,f'{jobname}.manifest')):
+            return jobname
+
+
+def submit_array_job(sample_queue,cluster_status,sample_ids,job_suffix,cmd,time_minutes,mem,task_log,array_limit=None,cpus=1):
+    """
+    Submit one SLURM job array for a batch of samples.
+    args:
+       - sample_ids: samples in the batch, task i processes sample_ids[i]
+       - job_suffix: job type, e.g. sra; tasks rename themselves to {ID}_{job_suffix}
+       - cmd: command run by each task, $SAMPLE_ID is the sample of the task
+       - task_log: per task log file, can use $SAMPLE_ID
+       - array_limit: maximum number of tasks running at the same time
+       - cpus: cores of each task
+    returns:
+       - ids of the samples submitted
+    """
+    if len(sample_ids) == 0:
+        return []
+    # short jobs, they stay on the default partition whatever the FairShare
+    partition   = Config.sys_config['process_server']['partition']
+    sbatch_dir  = Config.sys_config['paths']['data_collection_sbatch']
+    jobname     = array_jobname(sbatch_dir,job_suffix)
+    sbatch_path   = os.path.join( sbatch_dir, f'{jobname}.sbatch')
+    manifest_path = os.path.join( sbatch_dir, f'{jobname}.manifest')
+    log_path      = os.path.join( sbatch_dir, f'{jobname}_%a.log')
+
+    sbatch_header.write_manifest(sample_ids, manifest_path)
+    job_id = Config.submitter.submit_array( cmd, sbatch_path, time=time_minutes, mem=mem, cpus=cpus, job_name=jobname, partition=partition, log_filename=log_path,
+        manifest_path=manifest_path, array_limit=array_limit, task_jobname_suffix=job_suffix, task_log=task_log, 
+        spool_dir=Config.job_spool.spool_dir, submit=not DEBUG )
+    if job_id is None:
+        return []
+    metrics_exporter.get_metrics().inc('cistrome_jobs_submitted_total',job_type=job_suffix)
+
+    # array task i has job id {job_id}_{i}
+    for task,external_id in enumerate(sample_ids):
+        record_submitted_job(sample_queue,cluster_status,external_id,job_suffix,f'{job_id}_{task}',partition=partition)
+    return list(sample_ids)
+
+
+def sra_resources(sample_info,sra_conf):
+    """
+    Time (minutes) and memory (MB) of the download of a sample, from its expected fastq size when it is known.
+    """
+    expected_bytes = float(sample_info.get('EXPECTED_BYTES',0) or 0)
+    if expected_bytes <= 0:
+        return SRA_TIME_MINUTES,SRA_MEM
+    size_gb = expected_bytes/1024**3
+    minutes = float(sra_conf.get('base_minutes',SRA_BASE_MINUTES)) + float(sra_conf.get('minutes_per_gb',SRA_MINUTES_PER_GB))*size_gb
+    minutes = min(minutes,float(sra_conf.get('max_minutes',SRA_MAX_MINUTES)))
+    minutes = ([step for step in SRA_TIME_STEPS if step >= minutes] + [math.ceil(minutes)])[0]
+    mem = float(sra_conf.get('base_mem',SRA_BASE_MEM)) + float(sra_conf.get('mem_per_gb',SRA_MEM_PER_GB))*size_gb
+    mem = min(mem,float(sra_conf.get('max_mem',SRA_MAX_MEM)))
+    mem = math.ceil(mem/SRA_MEM_STEP)*SRA_MEM_STEP
+    return int(minutes),int(mem)
+
+
+def resolve_ncbi_metadata(sample_ids,fp):
+    """
+    Resolve the SRA runs of samples waiting for download in batched NCBI queries, 
+    so the download jobs find them in the metadata cache; samples already cached are not asked for again.
+    """
+    if Config.ncbi_metadata is None:
+        return {}
+    try:
+        return Config.ncbi_metadata.resolve(sample_ids)
+    except Exception as error:
+        # the download jobs resolve their sample themselves
+        print('NCBI metadata not resolved:',error,file=fp)
+        return {}
+
+
+def download_from_sra(samples=None):
+    """
+    Submit SRA download and fastq conversion for samples that have no fastq files yet.
+    The samples admitted in one pass are submitted as one job array per request size.
+    """
 
     configpath = Config.configpath
-    config = Config.sys_config
-    partition = config['process_server']['partition']
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
     max_fastq_file_number = int(Config.sys_config['process_server']['max_fastq_file_number'])
     max_fails = int(Config.sys_config['process_server']['max_fails'])
     max_restarts = int(Config.sys_config['process_server']['max_restarts'])
-
-    # TODO scratch = cluster_status.get_scratch_use()
-    # check disk space availability
-    # if (scratch['quota'] - scratch['used']) < float(config['process_server']['min_disk_space_avail']):
-    #    return
+    max_jobs_pending = Config.throttle.max_jobs_pending()
+    max_jobs_running = Config.throttle.max_jobs_running()
 
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
-
+    samples_to_process = read_samples_for_stage(sample_queue,'download_from_sra',samples)
     fp = open('schedule_sra_log.txt','a')
 
-    for external_id,sample_info in samples_to_process.items():
+    # sizes known before download order the queue, size the jobs and project the scratch use
+    for external_id,metadata in resolve_ncbi_metadata(list(samples_to_process),fp).items():
+        sample_queue.set_sample_expected_size(sample_id=external_id, expected={'EXPECTED_BYTES':metadata['fastq_bytes'],
+            'EXPECTED_SRA_BYTES':metadata['sra_bytes'], 'EXPECTED_SPOTS':metadata['spots'], 'EXPECTED_BASES':metadata['bases']})
+
+    # check disk space availability
+    admission = scratch_admission.ScratchAdmission(Config.sys_config, cluster_status, Config.state_scanner.fastq_names)
+    admission.start_pass(sample_queue)
+
+    fastq_sample_number = get_fastq_sample_number()
+    batch = []
+
+    for external_id,sample_info in select_samples(samples_to_process,samples,'download_from_sra'):
 
         # don't download if there are already enough files to process
-        if get_fastq_sample_number() > max_fastq_file_number:
-            print('too many fastq files', get_fastq_sample_number(), max_fastq_file_number, file=fp)
+        if fastq_sample_number + len(batch) > max_fastq_file_number:
+            print('too many fastq files', fastq_sample_number + len(batch), max_fastq_file_number, file=fp)
             break
 
         print(external_id,file=fp)
 
-        log_path = get_sra_log_path(external_id)
-
         # check results have not been sent back already
         if transfer_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='TRANSFERRED')
             continue
  
         # check fastq check-file does not exist
         if fastq_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='FASTQ_READY')
             continue
 
         # limit number of restarts
         if sample_queue.get_sample_restart_count(sample_id=external_id) >= max_restarts:
             continue
 
-        # limit number of download tries
-        if sample_queue.get_sample_status_count(sample_id=external_id,info_key='SRA') > max_fails:
+        # limit number of download tries, preempted downloads are not counted
+        if sample_queue.get_sample_attempt_count(sample_id=external_id,info_key='SRA') > max_fails:
             continue
 
         # check number of jobs pending
         cluster_status.get_jobs_in_queue()
-        if (cluster_status.get_pending_job_count() > int(Config.sys_config['process_server']['max_jobs_pending'])):
-            print(external_id,'too many jobs pending', cluster_status.get_pending_job_count(), int(Config.sys_config['process_server']['max_jobs_pending']), file=fp)
+        if (cluster_status.get_pending_job_count() + len(batch) > max_jobs_pending):
+            print(external_id,'too many jobs pending', cluster_status.get_pending_job_count() + len(batch), max_jobs_pending, file=fp)
             break
 
         # check number of jobs running
-        if (cluster_status.get_running_job_count() > int(Config.sys_config['process_server']['max_jobs_running'])):
-            print(external_id,'too many jobs running', cluster_status.get_running_job_count(), int(Config.sys_config['process_server']['max_jobs_running']), file=fp)
+        if (cluster_status.get_running_job_count() > max_jobs_running):
+            print(external_id,'too many jobs running', cluster_status.get_running_job_count(), max_jobs_running, file=fp)
             break
 
         # check job is not already in queue
-        jobname = f'{external_id}_sra'
-        if cluster_status.is_job_name_in_queue(f'{external_id}_sra') == True:  # SRA download job name: {ID}_sra
+        if is_sample_job_in_queue(cluster_status,external_id,sample_info,'sra') == True:  # SRA download job name: {ID}_sra
             continue       
 
-        cmd = f'python sra_download.py -c {configpath} -i {external_id}'
+        # check the download and CHIPS output fit on scratch
+        if admission.admit_download(external_id,sample_info) == False:
+            print(external_id,'not enough scratch space', file=fp)
+            continue
 
-        sbatch_path = os.path.join( Config.sys_config['paths']['data_collection_sbatch'], f'{jobname}.sbatch')
+        batch += [external_id]
 
-        if DEBUG:
-            sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 300 --mem 2000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path}'
-        else:
-            sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 300 --mem 2000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path} --submit'
+    cmd = f'python sra_download.py -c {configpath} -i $SAMPLE_ID'
+    sra_conf = Config.sys_config['sra_download'] if Config.sys_config.has_section('sra_download') else {}
+    if str(sra_conf.get('gzip',SRA_GZIP)).lower() == 'true':
+        cmd += ' --gzip'
 
-        subprocess.run(sbatch_cmd,shell=True)
-        time.sleep(1)
-        print(datetime.datetime.now(),file=fp)
+    submitted = submit_sra_batches(sample_queue, cluster_status, {external_id:samples_to_process[external_id] for external_id in batch}, cmd, sra_conf)
+    for external_id in submitted:
+        sample_queue.set_sample_stage(sample_id=external_id,stage='SRA_SUBMITTED')
+    print(f'submitted {len(submitted)} sra downloads', datetime.datetime.now(),file=fp)
     fp.close()
+    return submitted
+
+
+def submit_sra_batches(sample_queue,cluster_status,batch,cmd,sra_conf):
+    """
+    Submit the downloads of a batch of samples, {sample_id: sample_info}, as one job array per request size:
+    samples go in arrays by the size of their requests, retries after running out of memory or time ask for more.
+    returns:
+       - ids of the samples submitted
+    """
+    sra_cpus = int(sra_conf.get('cpus',SRA_CPUS))
+    escalated_batches = {}
+    for external_id,sample_info in batch.items():
+        key = Config.retry_policy.escalation(sample_info.get('SRA')) + sra_resources(sample_info,sra_conf)
+        escalated_batches.setdefault(key,[])
+        escalated_batches[key] += [external_id]
+
+    submitted = []
+    for (mem_factor,time_factor,base_minutes,base_mem),escalated_batch in sorted(escalated_batches.items()):
+        time_minutes = Config.retry_policy.scaled_time(base_minutes,time_factor)
+        mem = Config.retry_policy.scaled_mem(base_mem,mem_factor)
+        submitted += submit_array_job(sample_queue, cluster_status, escalated_batch, 'sra', cmd, time_minutes, mem, get_sra_log_path('${SAMPLE_ID}'), cpus=sra_cpus)
+    return submitted
 
 
 def get_process_status_path(external_id):
@@ -262,62 +427,86 @@ def get_process_status_path(external_id):
     return path 
 
 
+# marker files are looked up in the state scanner, which lists the sample directories once per scan interval
+
 def process_status_file_check(external_id):
-    path = get_process_status_path(external_id)
-    process_status_path = os.path.join( path, f'{external_id}_status.json' )
-    return os.path.exists(process_status_path) 
+    return Config.state_scanner.has_marker(external_id,'process_status_file')
 
 
 def chips_complete_check(external_id):
-    chips_run_path = Config.sys_config['paths']['data_collection_runs']
-    sample_check_path = os.path.join(chips_run_path,f'{external_id}/analysis/logs/empty_file_list.txt')
-    return os.path.exists(sample_check_path) 
+    return Config.state_scanner.has_marker(external_id,'chips_complete')
 
 
 def chips_check_complete_check(external_id):
-    chips_run_path = Config.sys_config['paths']['data_collection_runs']
-    sample_check_path = os.path.join(chips_run_path,f'{external_id}/cistrome/{external_id}.md5')
-    return os.path.exists(sample_check_path) 
+    return Config.state_scanner.has_marker(external_id,'chips_check_complete')
 
 
 def transfer_complete_check(external_id):
-    chips_run_path = Config.sys_config['paths']['data_collection_runs']
-    sample_check_path = os.path.join(chips_run_path,f'{external_id}/{external_id}_rsync_ok.txt')
-    return os.path.exists(sample_check_path) 
+    return Config.state_scanner.has_marker(external_id,'transfer_complete')
 
 
 def transfer_to_backup_complete_check(external_id):
-    chips_run_path = Config.sys_config['paths']['data_collection_runs']
-    sample_check_path = os.path.join(chips_run_path,f'{external_id}/{external_id}_backup_ok.txt')
-    return os.path.exists(sample_check_path) 
+    return Config.state_scanner.has_marker(external_id,'backup_complete')
 
 
 def update_cluster_runstats_in_local_queue():
     """
-    Get stats from the SLURM system and parse the output to get 
-    numbers of different stage jobs running or in the queue.
+    Poll sacct for the jobs that changed since the last poll, see job_state_cache.py, 
+    and record their states in the local queue, e.g. CHIPS: {job_id: COMPLETED}.
+    Samples whose jobs ended are settled in the scheduler core.
     """
     configpath = Config.configpath
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue()
 
-    cluster_status = cluster_stats.ClusterStats(configpath)
-    cluster_status.get_account_info()
+    changed_jobs = Config.job_states.poll()
+    sample_jobs = {}
+    for job in changed_jobs:
+        sample_jobs.setdefault(job['sample_id'],[])
+        sample_jobs[job['sample_id']] += [job]
+
+    # only samples with changed jobs are read from the queue
+    sample_queue.read_local_queue(sample_ids=set(sample_jobs))
+    for sampleid,jobs in sample_jobs.items():
+        job_status = {}
+        for job in jobs:
+            job_status.setdefault(job['job_type'],{})
+            job_status[job['job_type']][job['job_id']] = job['state']
+        for job_type,status in job_status.items():
+            sample_queue.set_sample_info( sample_id=sampleid, info_key=job_type, info_val=status)
+        # start of the download and CHIPS jobs for the stage timeline, e.g. CHIPS_STARTED
+        for job in jobs:
+            if job['job_type'] in ['sra','chips'] and job['start_time'] is not None:
+                sample_queue.record_sample_event( sample_id=sampleid, event=job['job_type'].upper() + '_STARTED', event_time=job['start_time'])
 
-    # update record of sbatch jobs
-    job_status = match_sbatch_history( suffix='sra', jobs_name=cluster_status.account_info['name'], jobs_status=cluster_status.account_info['status'], jobs_id=cluster_status.account_info['job_id'])
-    for sampleid,job_type_status in job_status.items():
-        sample_queue.set_sample_info( sample_id=sampleid, info_key=job_type_status['type'], info_val=job_type_status['status'])
+    sample_queue.write_local_queue() 
 
-    job_status = match_sbatch_history( suffix='chips', jobs_name=cluster_status.account_info['name'], jobs_status=cluster_status.account_info['status'], jobs_id=cluster_status.account_info['job_id'])
-    for sampleid,job_type_status in job_status.items():
-        sample_queue.set_sample_info( sample_id=sampleid, info_key=job_type_status['type'], info_val=job_type_status['status'])
+    if Config.core is not None:
+        for job in changed_jobs:
+            if job['state'] in JOB_END_STATES and job['job_type'] in job_type_stages:
+                Config.core.jobs_ended(job_type_stages[job['job_type']],[job['sample_id']])
 
-    job_status = match_sbatch_history( suffix='chips_check', jobs_name=cluster_status.account_info['name'], jobs_status=cluster_status.account_info['status'], jobs_id=cluster_status.account_info['job_id'])
-    for sampleid,job_type_status in job_status.items():
-        sample_queue.set_sample_info( sample_id=sampleid, info_key=job_type_status['type'], info_val=job_type_status['status'])
 
-    sample_queue.write_local_queue() 
+def record_spooled_jobs(records,core=None):
+    """
+    Record the completion records the jobs wrote to the spool, see job_spool.py, in the local queue 
+    and settle the samples of the jobs that ended in the scheduler core.
+    The exit code only tells success from failure, sacct later refines the state, e.g. to OUT_OF_MEMORY.
+    """
+    sample_queue = requests_from_cistromeDB.SampleQueue(Config.configpath)
+    sample_queue.read_local_queue(sample_ids=set([record.get('sample_id') for record in records]))
+    for record in records:
+        sample_id = record.get('sample_id')
+        # the files the job wrote are seen on the next check
+        Config.state_scanner.invalidate(sample_id)
+        # jobs killed by SLURM, e.g. for memory, time or preemption, are left for sacct to classify
+        if record.get('job_type') in ['sra','chips','chips_check'] and record.get('exit_code') not in KILLED_EXIT_CODES:
+            state = 'COMPLETED' if record.get('exit_code') == 0 else 'FAILED'
+            sample_queue.set_sample_info( sample_id=sample_id, info_key=record['job_type'], info_val={record['job_id']:state})
+    if core is not None:
+        for record in records:
+            if record.get('job_type') in job_type_stages and record.get('exit_code') not in KILLED_EXIT_CODES:
+                core.jobs_ended(job_type_stages[record['job_type']],[record.get('sample_id')])
+        core.request_poll()
 
 
 def write_process_status_file( external_id='', external_id_type='GEO', process_status=''):
@@ -342,11 +531,12 @@ def write_process_status_file( external_id='', external_id_type='GEO', process_s
     path = get_process_status_path(external_id)
     # write file to results folder eg. cistrome/GSM12345/
     if not os.path.exists(path):
-        os.mkdir(path)
+        os.makedirs(path)
 
     filename = os.path.join(path, f'{external_id}_status.json' )
     with open(filename,'w') as fp:
         json.dump( samples_json, fp )
+    Config.state_scanner.invalidate(external_id)
 
 
 def clean_up_failed_samples():
@@ -359,13 +549,14 @@ def clean_up_failed_samples():
     """
 
     configpath = Config.configpath
-    partition = Config.sys_config['process_server']['partition']
     max_fails = int(Config.sys_config['process_server']['max_fails'])
     max_restarts = int(Config.sys_config['process_server']['max_restarts'])
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
 
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
+    # only samples at max_fails or max_restarts need attention
+    candidates = set(sample_queue.get_samples_at_max_fails(max_fails)) | set(sample_queue.get_samples_by_restart_count(max_restarts))
+    sample_queue.read_local_queue(sample_ids=candidates) 
     samples_to_process = sample_queue.get_local_queue()
  
     for external_id,sample_info in samples_to_process.items(): 
@@ -381,7 +572,7 @@ def clean_up_failed_samples():
         else:
             process_status = 'UNPROCESSED'
     
-        if process_status in ['DOWNLOAD_ERROR','PROCESSING_ERROR']:
+        if process_status in ERROR_STATUS:
             print(f'cleaning up failed sample {external_id}') 
             sample_queue.clear_sample_info( sample_id=external_id, info_key='SRA')
             sample_queue.clear_sample_info( sample_id=external_id, info_key='CHIPS')
@@ -391,8 +582,12 @@ def clean_up_failed_samples():
             delete_fastq_files(external_id)
             delete_result_files(external_id,complete=False)
             sample_queue.increment_sample_restart_count(sample_id=external_id)
+            sample_queue.set_sample_stage(sample_id=external_id,stage='REQUESTED',reset=True)
+            if Config.core is not None:
+                Config.core.release([external_id])
  
-        if sample_queue.get_sample_restart_count(sample_id=external_id) >= max_restarts:
+        if (sample_queue.get_sample_restart_count(sample_id=external_id) >= max_restarts and
+            sample_info.get('process_status') not in ERROR_STATUS):
             # only write after sample is given up
             write_process_status_file( external_id=external_id, external_id_type='GEO', process_status=process_status )
             # update process_status in local queue
@@ -402,37 +597,39 @@ def clean_up_failed_samples():
     return
 
 
-@asynch
-@schedule( event_sched['setup_and_run_chips']['start_time'], interval=event_sched['setup_and_run_chips']['interval'])
-def setup_and_run_chips():
+def setup_and_run_chips(samples=None):
     """
     Find samples that need processing.
     Check cluster resources and load.
     Set up directories, config files and running CHIPs.
+    Job statistics and failed samples are only updated on a full pass.
     """
 
     fp = open('schedule_chips_log.txt','a')
-    print('job stat update running:',datetime.datetime.now(),file=fp)
-    update_cluster_runstats_in_local_queue()
-    print('clean up failed samples:',datetime.datetime.now(),file=fp)
-    clean_up_failed_samples()
+    if samples is None:
+        print('job stat update running:',datetime.datetime.now(),file=fp)
+        update_cluster_runstats_in_local_queue()
+        print('clean up failed samples:',datetime.datetime.now(),file=fp)
+        clean_up_failed_samples()
 
     print('chips job submission running:',datetime.datetime.now(),file=fp)
     # processing differs between sample types
     sampletype_lookup = {'dnase':'dnase', 'atac':'atac', 'tf':'tf', 'h3k27ac':'h3k27ac', 'h3k4me3':'h3k4me3' } 
 
-    max_jobs_pending = int(Config.sys_config['process_server']['max_jobs_pending'])
+    max_jobs_pending = Config.throttle.max_jobs_pending()
     max_restarts = int(Config.sys_config['process_server']['max_restarts'])
     configpath = Config.configpath
-    partition = Config.sys_config['process_server']['partition']
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
 
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
+    samples_to_process = read_samples_for_stage(sample_queue,'setup_and_run_chips',samples)
+    admission = scratch_admission.ScratchAdmission(Config.sys_config, cluster_status, Config.state_scanner.fastq_names)
+    admission.start_pass(sample_queue)
  
+    submitted = []
+
     # TODO confirm consistency between words used to specify chips and types in sample request file
-    for external_id,sample_info in samples_to_process.items():
+    for external_id,sample_info in select_samples(samples_to_process,samples,'setup_and_run_chips'):
  
         #print('chips loop',external_id,file=fp)
         if sample_queue.get_sample_restart_count(sample_id=external_id) >= max_restarts:
@@ -441,13 +638,16 @@ def setup_and_run_chips():
         # check fastq check-file exists
         if fastq_check(external_id) == False:
             continue
+        sample_queue.set_sample_stage(sample_id=external_id,stage='FASTQ_READY')
 
         # check chips run is not complete 
         if chips_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='CHIPS_COMPLETE')
             continue
 
         # check results have not been sent back already
         if transfer_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='TRANSFERRED')
             continue
 
         # check number of jobs in queue
@@ -457,119 +657,133 @@ def setup_and_run_chips():
             break
 
         # check job is not already in queue
-        if cluster_status.is_job_name_in_queue(f'{external_id}_chips') == True:  # chips job name: {ID}_chips
+        if is_sample_job_in_queue(cluster_status,external_id,sample_info,'chips') == True:  # chips job name: {ID}_chips
             continue            
  
+        # check the CHIPS output fits on scratch
+        if admission.admit_chips(external_id,sample_info) == False:
+            print(external_id,'not enough scratch space',file=fp)
+            continue
+
         species = sample_info['species']
         sampletype = sample_info['sampletype']
-        if sample_info['broad'].lower() == 'true':
-            broad = '--broad'
-        else:
-            broad = ''
 
         # Improve place of Lookup
         sampletype = sampletype_lookup[sampletype.lower()]
-        cmd = f'python chips_job_submission.py -c {configpath} --gsm {external_id} --species {species} --sampletype {sampletype} {broad} --submit'
         if DEBUG:
             print(external_id)
             print(sample_info)
-            print(cmd)
-        else:
-            subprocess.run(cmd,shell=True)
-            print(external_id,datetime.datetime.now(),file=fp)
-            time.sleep(1)
+            continue
+
+        partition = Config.throttle.partition()
+        # more memory after running out of memory, more time after a timeout
+        mem_factor,time_factor = Config.retry_policy.escalation(sample_info.get('CHIPS'))
+        if mem_factor != 1 or time_factor != 1:
+            print(external_id,'retry with memory x%.2f, time x%.2f' % (mem_factor,time_factor),file=fp)
+        job_id = Config.submitter.submit_chips( configpath, external_id, species, sampletype, partition=partition,
+            mem_factor=mem_factor, time_factor=time_factor )
+        if job_id is None:
+            continue
+        metrics_exporter.get_metrics().inc('cistrome_jobs_submitted_total',job_type='chips')
+        record_submitted_job(sample_queue,cluster_status,external_id,'chips',job_id,partition=partition)
+        sample_queue.set_sample_stage(sample_id=external_id,stage='CHIPS_SUBMITTED')
+        submitted += [external_id]
+        print(external_id,job_id,datetime.datetime.now(),file=fp)
 
     fp.close()
+    return submitted
 
 
-@asynch
-@schedule( event_sched['check_chips_results']['start_time'], interval=event_sched['check_chips_results']['interval'])
-def check_chips_results():
+def check_chips_results(samples=None):
+    """
+    Submit integrity checks of finished CHIPS runs, as a single job array per pass.
+    """
 
     configpath     = Config.configpath
-    partition      = Config.sys_config['process_server']['partition']
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
+    max_jobs_pending = Config.throttle.max_jobs_pending()
 
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
-
-    for external_id,sample_info in samples_to_process.items():
+    samples_to_process = read_samples_for_stage(sample_queue,'check_chips_results',samples)
+    batch = []
 
-        sample_path = os.path.join( Config.sys_config['paths']['data_collection_runs'], external_id  )
-        log_path    = os.path.join( sample_path, f'chips_check_log_{external_id}.txt' )
-        chips_yaml  = os.path.join( sample_path,'config.yaml')
-        jobname     = f'{external_id}_chips_check'
-        sbatch_path = os.path.join( Config.sys_config['paths']['data_collection_sbatch'], f'{jobname}.sbatch')
+    for external_id,sample_info in select_samples(samples_to_process,samples,'check_chips_results'):
 
         print(external_id)
         # check results have not been sent back already
         if transfer_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='TRANSFERRED')
             continue
 
         # check chips run is complete 
         if chips_complete_check(external_id) == False:
             continue
+        sample_queue.set_sample_stage(sample_id=external_id,stage='CHIPS_COMPLETE')
 
         # check chips run has not been checked already 
         if chips_check_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='CHECKED')
             continue
 
         # check number of jobs in queue
         cluster_status.get_jobs_in_queue()
-        if (cluster_status.get_pending_job_count() > int(Config.sys_config['process_server']['max_jobs_pending'])):
+        if (cluster_status.get_pending_job_count() + len(batch) > max_jobs_pending):
             break
 
         # check job is not already in queue
-        if cluster_status.is_job_name_in_queue(jobname) == True:  # chips check job name: {ID}_chips_check
+        if is_sample_job_in_queue(cluster_status,external_id,sample_info,'chips_check') == True:  # chips check job name: {ID}_chips_check
             continue            
 
-        cmd = f'python check_chips.py -c {configpath} -i {external_id}'
+        batch += [external_id]
 
-        if DEBUG:
-            sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 480 --mem 2000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path}'
-        else:
-            sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 480 --mem 2000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path} --submit'
+    runs_path = Config.sys_config['paths']['data_collection_runs']
+    cmd = f'python check_chips.py -c {configpath} -i $SAMPLE_ID'
+    task_log = os.path.join( runs_path, '${SAMPLE_ID}', 'chips_check_log_${SAMPLE_ID}.txt' )
+    batch = submit_array_job(sample_queue, cluster_status, batch, 'chips_check', cmd, 480, 2000, task_log)
+    for external_id in batch:
+        sample_queue.set_sample_stage(sample_id=external_id,stage='CHECK_SUBMITTED')
+    print(f'submitted {len(batch)} chips checks', datetime.datetime.now())
 
-        subprocess.run(sbatch_cmd,shell=True)
-        time.sleep(1)
-        print(datetime.datetime.now())
+    return batch
 
-    return 
 
-
-@asynch
-@schedule( event_sched['transfer_to_server']['start_time'], interval=event_sched['transfer_to_server']['interval'])
-def transfer_to_server():
+def transfer_to_server(samples=None):
+    """
+    Submit transfers of results and process status files to the home server, as a single job array per pass.
+    """
 
     configpath = Config.configpath
     server = 'home_server'
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
+    # samples that were given up also need their process status reported
+    samples_to_process = read_samples_for_stage(sample_queue,'transfer_to_server',samples,process_status=ERROR_STATUS)
     max_data_rsync   = int(Config.sys_config['process_server']['max_jobs_rsync_data'])
-    max_jobs_running = int(Config.sys_config['process_server']['max_jobs_running'])
-    max_jobs_pending = int(Config.sys_config['process_server']['max_jobs_pending'])
-
-    partition = Config.sys_config['process_server']['partition']
+    max_jobs_running = Config.throttle.max_jobs_running()
+    max_jobs_pending = Config.throttle.max_jobs_pending()
 
     fp = open('schedule_rsync_data_log.txt','a')
     print('rsync data running:',datetime.datetime.now(),file=fp)
+    batch = []
  
-    for external_id,sample_info in samples_to_process.items():
-        if transfer_complete_check(external_id) == False:
+    for external_id,sample_info in select_samples(samples_to_process,samples,'transfer_to_server'):
+        if transfer_complete_check(external_id) == True:
+            if sample_info.get('process_status') in ERROR_STATUS:
+                sample_queue.set_sample_stage(sample_id=external_id,stage='FINISHED')
+            else:
+                sample_queue.set_sample_stage(sample_id=external_id,stage='TRANSFERRED')
+        else:
 
             # check number of jobs in queue
             cluster_status.get_jobs_in_queue() 
-            if cluster_status.get_pending_job_count() >= max_jobs_pending: 
+            if cluster_status.get_pending_job_count() + len(batch) >= max_jobs_pending: 
                 break
 
             if cluster_status.get_running_job_count() >= max_jobs_running:
                 break
 
             n_rsync_jobs = len([jobname for jobname in cluster_status.list_job_names_in_queue() if '_data_rsync' in jobname])
-            if n_rsync_jobs >= max_data_rsync:
+            if n_rsync_jobs + len(batch) >= max_data_rsync:
                 break
 
             # process_status_files is written on success or when giving up
@@ -583,58 +797,48 @@ def transfer_to_server():
             # in either case the result must be reported to the home server
             if process_status_file_check(external_id):
 
-                jobname = f'{external_id}_data_rsync'
-                if cluster_status.is_job_name_in_queue(jobname) == True:
+                if is_sample_job_in_queue(cluster_status,external_id,sample_info,'data_rsync') == True:
                     continue 
 
-                sample_path = os.path.join(Config.sys_config['paths']['data_collection_runs'], external_id)
-                log_path = os.path.join( sample_path, f'data_rsync_log_{external_id}.txt' )
-                sbatch_path = os.path.join( Config.sys_config['paths']['data_collection_sbatch'], f'{jobname}.sbatch')
-                cmd = f'python file_transfer_to_server.py -c {configpath} -i {external_id} -s {server}'
-
-                if not DEBUG:
-                    print(f'rsync {external_id}:',datetime.datetime.now(),file=fp)
-                    sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 3600 --mem 1000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path} --submit'
-                    subprocess.run(sbatch_cmd,shell=True)
-                else:
-                    print(cmd)
+                print(f'rsync {external_id}:',datetime.datetime.now(),file=fp)
+                batch += [external_id]
 
-                time.sleep(10) 
-                print(datetime.datetime.now())
-                fp.flush()
+    runs_path = Config.sys_config['paths']['data_collection_runs']
+    cmd = f'python file_transfer_to_server.py -c {configpath} -i $SAMPLE_ID -s {server}'
+    task_log = os.path.join( runs_path, '${SAMPLE_ID}', 'data_rsync_log_${SAMPLE_ID}.txt' )
+    batch = submit_array_job(sample_queue, cluster_status, batch, 'data_rsync', cmd, 3600, 1000, task_log, array_limit=max_data_rsync)
 
     fp.close()
-    return 
+    return batch
 
 
-@asynch
-@schedule( event_sched['transfer_to_backup_server']['start_time'], interval=event_sched['transfer_to_backup_server']['interval'])
-def transfer_to_backup_server():
+def transfer_to_backup_server(samples=None):
+    """
+    Submit backups of checked results, as a single job array per pass.
+    """
 
     configpath = Config.configpath
     #server = 'backup_server'
     server = 'google_cloud'
-    cluster_status = cluster_stats.ClusterStats(configpath)
+    cluster_status = cluster_stats.get_cluster_snapshot(configpath)
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
+    samples_to_process = read_samples_for_stage(sample_queue,'transfer_to_backup_server',samples)
     max_backup_rsync = int(Config.sys_config['process_server']['max_jobs_rsync_backup'])
-    max_jobs_running = int(Config.sys_config['process_server']['max_jobs_running'])
-    max_jobs_pending = int(Config.sys_config['process_server']['max_jobs_pending'])
-
-    partition = Config.sys_config['process_server']['partition']
- 
-    n_fails = 0 # keep track of failures
+    max_jobs_running = Config.throttle.max_jobs_running()
+    max_jobs_pending = Config.throttle.max_jobs_pending()
 
     fp = open('schedule_rsync_backup_log.txt','a')
     print('rsync backup running:',datetime.datetime.now(),file=fp)
+    batch = []
  
-    for external_id,sample_info in samples_to_process.items():
-        if chips_check_complete_check(external_id) == True and transfer_to_backup_complete_check(external_id) == False:
+    for external_id,sample_info in select_samples(samples_to_process,samples,'transfer_to_backup_server'):
+        if transfer_to_backup_complete_check(external_id) == True:
+            sample_queue.set_sample_stage(sample_id=external_id,stage='BACKED_UP')
+        elif chips_check_complete_check(external_id) == True:
 
             # check number of jobs in queue
             cluster_status.get_jobs_in_queue() 
-            if cluster_status.get_pending_job_count() >= max_jobs_pending: 
+            if cluster_status.get_pending_job_count() + len(batch) >= max_jobs_pending: 
                 break
 
             if cluster_status.get_running_job_count() >= max_jobs_running:
@@ -642,41 +846,22 @@ def transfer_to_backup_server():
 
             # TODO check how more than max_backup_rsync jobs can run (slurm failed to report jobs?)
             n_backup_rsync_jobs = len([jobname for jobname in cluster_status.list_job_names_in_queue() if '_backup_rsync' in jobname])
-            if n_backup_rsync_jobs >= max_backup_rsync:
+            if n_backup_rsync_jobs + len(batch) >= max_backup_rsync:
                 break
 
-            jobname = f'{external_id}_backup_rsync'
-            if cluster_status.is_job_name_in_queue(jobname) == True:
+            if is_sample_job_in_queue(cluster_status,external_id,sample_info,'backup_rsync') == True:
                 continue 
 
-            sample_path = os.path.join(Config.sys_config['paths']['data_collection_runs'], external_id)
-            log_path = os.path.join( sample_path, f'backup_rsync_log_{external_id}.txt' )
-            sbatch_path = os.path.join( Config.sys_config['paths']['data_collection_sbatch'], f'{jobname}.sbatch')
-            cmd = f'python file_transfer_to_server.py -c {configpath} -i {external_id} -s {server} --backup'
+            print(f'rsync {external_id}:',datetime.datetime.now(),file=fp)
+            batch += [external_id]
 
-            if not DEBUG:
-                print(f'rsync {external_id}:',datetime.datetime.now(),file=fp)
-                #subprocess.check_call(cmd,shell=True)
-                #print(f'rsync {external_id} complete:',datetime.datetime.now(),file=fp)
-                sbatch_cmd = f'python sbatch_header.py --cmd "{cmd}" --time 3600 --mem 1000 --partition {partition} --jobname {jobname} --sbatchfile {sbatch_path} --log {log_path} --submit'
-                subprocess.run(sbatch_cmd,shell=True)
-
-            # track failure to backup
-            #if transfer_to_backup_complete_check(external_id) == False:
-            #    n_fails += 1
-            #    print(f'rsync {external_id} failure {n_fails}:',datetime.datetime.now(),file=fp)
-            # reduce fail count on success 
-            #elif n_fails > 0:
-            #    n_fails -= 1
-            #if n_fails >= MAX_BACKUP_FAILURES:
-            #    break
-
-            time.sleep(10) 
-            print(datetime.datetime.now())
-            fp.flush()
+    runs_path = Config.sys_config['paths']['data_collection_runs']
+    cmd = f'python file_transfer_to_server.py -c {configpath} -i $SAMPLE_ID -s {server} --backup'
+    task_log = os.path.join( runs_path, '${SAMPLE_ID}', 'backup_rsync_log_${SAMPLE_ID}.txt' )
+    batch = submit_array_job(sample_queue, cluster_status, batch, 'backup_rsync', cmd, 3600, 1000, task_log, array_limit=max_backup_rsync)
 
     fp.close()
-    return 
+    return batch
 
 
 def get_sra_log_path(external_id):
@@ -717,13 +902,12 @@ def delete_sra_files(external_id):
 def delete_fastq_files(external_id):
     fastq_path = Config.sys_config['paths']['fastq']
 
-    if os.path.exists( os.path.join( fastq_path, f'{external_id}.fastq' )):
-        fastq_file_path_list  = [os.path.join( fastq_path, f'{external_id}.fastq' )]  
-    elif os.path.exists( os.path.join( fastq_path, f'{external_id}_R1.fastq' )):
-        fastq_file_path_list  = [os.path.join( fastq_path, f'{external_id}_R1.fastq' )]
-        fastq_file_path_list += [os.path.join( fastq_path, f'{external_id}_R2.fastq' )]
-    else:
-        fastq_file_path_list = []
+    # single or paired end, uncompressed or gzip compressed
+    fastq_file_path_list = [os.path.join( fastq_path, name ) for name in sample_priority.sample_fastq_names(external_id)]
+    # run fastq files and the state of an unfinished download
+    download_state = sra_download.DownloadState( sra_download.get_state_path( fastq_path, external_id ))
+    fastq_file_path_list += download_state.fastq_files() + [download_state.path]
+    fastq_file_path_list = [path for path in fastq_file_path_list if os.path.exists(path)]
 
     fastq_file_string = ' '.join(fastq_file_path_list)
 
@@ -737,6 +921,7 @@ def delete_fastq_files(external_id):
 
         if DEBUG == False:
             subprocess.call(delete_cmd,shell=True)
+            Config.state_scanner.invalidate(external_id)
             time.sleep(1)
         else:
             print(delete_cmd)
@@ -775,25 +960,23 @@ def delete_result_files(external_id,complete=False):
 
         if DEBUG == False:
             subprocess.call(delete_cmd,shell=True)
+            Config.state_scanner.invalidate(external_id)
             time.sleep(1)
         else:
             print(delete_cmd)
             pass
 
 
-@asynch
-@schedule( event_sched['clean_up_after_completion']['start_time'], interval=event_sched['clean_up_after_completion']['interval'])
-def clean_up_after_completion():
+def clean_up_after_completion(samples=None):
     """
     Determine which samples are complete and delete related raw and processed data files.
     """
 
     configpath   = Config.configpath
     sample_queue = requests_from_cistromeDB.SampleQueue(configpath)
-    sample_queue.read_local_queue() 
-    samples_to_process = sample_queue.get_local_queue()
+    samples_to_process = read_samples_for_stage(sample_queue,'clean_up_after_completion',samples)
 
-    for external_id,sample_info in samples_to_process.items():
+    for external_id,sample_info in select_samples(samples_to_process,samples,'clean_up_after_completion'):
 
         sample_path   = os.path.join( Config.sys_config['paths']['data_collection_runs'], external_id  )
         cistrome_path = os.path.join( sample_path, Config.sys_config['paths']['cistrome_result'] ) 
@@ -803,51 +986,217 @@ def clean_up_after_completion():
 
         # check transfer is complete and results have not yet been deleted
         if (transfer_complete_check(external_id) == True and 
-            transfer_to_backup_complete_check(external_id) == True and 
-            os.path.exists(cistrome_path) == True):
+            transfer_to_backup_complete_check(external_id) == True):
 
-            delete_sra_files(external_id)
-            delete_fastq_files(external_id)
-            delete_sbatch_files(external_id)
-            delete_result_files(external_id,complete=True)
+            if os.path.exists(cistrome_path) == True:
+                delete_sra_files(external_id)
+                delete_fastq_files(external_id)
+                delete_sbatch_files(external_id)
+                delete_result_files(external_id,complete=True)
+            sample_queue.set_sample_stage(sample_id=external_id,stage='FINISHED')
 
     return 
 
 
+class SlurmSubmitter():
+    """
+    Writes and submits the sbatch files of the pipeline jobs.
+    pipeline_simulator.py puts a simulated cluster in its place.
+    """
+
+    def submit_array(self,cmd,sbatch_path,**sbatch_options):
+        return sbatch_header.create_sbatch(cmd,sbatch_path,**sbatch_options)
+
+
+    def submit_chips(self,configpath,external_id,species,sampletype,partition=None,mem_factor=1.0,time_factor=1.0):
+        # the job is known not to be in the queue, so there is nothing to cancel
+        return chips_job_submission.setup_chips( configpath, external_id, species, sampletype, submit=True, cancel=False, partition=partition,
+            mem_factor=mem_factor, time_factor=time_factor )
+
+
 class Config():
     configpath = ''
     sys_config = None
+    state_scanner = None
+    priority = None
+    throttle = None
+    submitter = None
+    job_states = None
+    job_spool = None
+    retry_policy = None
+    ncbi_metadata = None
+    core = None # scheduler core of the stages, set when it is built
 
     def __init__(self,configpath):
         Config.sys_config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
         Config.sys_config.optionxform=str
         Config.sys_config.read(configpath)
         Config.configpath = configpath
-
-
-@asynch
-@schedule( event_sched['test'], interval=HOUR)
-def test():
+        paths = Config.sys_config['paths']
+        scan_interval = float(Config.sys_config['process_server'].get('state_scan_interval',state_scanner.DEFAULT_SCAN_INTERVAL))
+        Config.state_scanner = state_scanner.StateScanner( paths['fastq'], paths['data_collection_runs'], 
+            work_dir=paths['chips_work_directory'], result_dir=paths['cistrome_result'], scan_interval=scan_interval )
+        Config.priority = sample_priority.SamplePriority( Config.sys_config, fastq_names=Config.state_scanner.fastq_names )
+        Config.throttle = fairshare_throttle.FairShareThrottle( Config.sys_config, cluster_stats.get_cluster_snapshot(configpath) )
+        Config.submitter = SlurmSubmitter()
+        Config.retry_policy = job_failures.RetryPolicy(Config.sys_config)
+        Config.job_states = job_state_cache.get_job_state_cache(configpath)
+        Config.job_spool = job_spool.JobSpool(job_spool.get_spool_path(Config.sys_config))
+        Config.ncbi_metadata = ncbi_metadata.get_ncbi_metadata(configpath)
+
+
+def test(samples=None):
     configpath = Config.configpath
     with open('test_schedule_check.txt','a') as fp:
         print(datetime.datetime.now(),file=fp)
     return 
 
 
+# completion of the work a stage submitted for a sample is detected by these checks
+stage_done_checks = {
+    'download_from_sra':         fastq_check,
+    'setup_and_run_chips':       chips_complete_check,
+    'check_chips_results':       chips_check_complete_check,
+    'transfer_to_server':        transfer_complete_check,
+    'transfer_to_backup_server': transfer_to_backup_complete_check,
+}
+
+
+# stage a sample reaches when the work of a stage is finished, recorded as soon as it is seen
+stage_done_stages = {
+    'download_from_sra':         'FASTQ_READY',
+    'setup_and_run_chips':       'CHIPS_COMPLETE',
+    'check_chips_results':       'CHECKED',
+    'transfer_to_server':        'TRANSFERRED',
+    'transfer_to_backup_server': 'BACKED_UP',
+}
+
+
+# ok file written by file_transfer_to_server.py at the end of a transfer, with its statistics
+transfer_ok_files = {
+    'transfer_to_server':        '{ID}_rsync_ok.txt',
+    'transfer_to_backup_server': '{ID}_backup_ok.txt',
+}
+
+
+def record_transfer_metrics(stage_name,sample_ids):
+    """
+    Add the bytes and time of finished transfers to the metrics, ok files without statistics are skipped.
+    """
+    metrics = metrics_exporter.get_metrics()
+    runs_path = Config.sys_config['paths']['data_collection_runs']
+    for external_id in sample_ids:
+        ok_path = os.path.join(runs_path,external_id,transfer_ok_files[stage_name].format(ID=external_id))
+        try:
+            with open(ok_path,'r') as fp:
+                stats = json.load(fp)
+            server,size,seconds = stats['server'],float(stats['bytes']),float(stats['seconds'])
+        except (OSError,ValueError,KeyError,TypeError):
+            continue
+        metrics.inc('cistrome_transfers_total',server=server)
+        metrics.inc('cistrome_transfer_bytes_total',size,server=server)
+        metrics.inc('cistrome_transfer_seconds_total',seconds,server=server)
+        if seconds > 0:
+            metrics.set('cistrome_transfer_bytes_per_second',size/seconds,server=server)
+
+
+def record_stage_done(stage_name,sample_ids):
+    """
+    Move samples to the stage reached, so the stage timeline has the time the work finished
+    rather than the time of the next pass of the downstream stage.
+    """
+    if stage_name not in stage_done_stages:
+        return
+    sample_queue = requests_from_cistromeDB.SampleQueue(Config.configpath)
+    sample_queue.read_local_queue(sample_ids=sample_ids)
+    for external_id in sample_ids:
+        sample_queue.set_sample_stage(sample_id=external_id,stage=stage_done_stages[stage_name])
+    if stage_name in transfer_ok_files:
+        record_transfer_metrics(stage_name,sample_ids)
+
+
+# job names of the pipeline: {ID}_{type} for single jobs and array tasks, {type}_array_{date}_{n} for arrays
+JOB_TYPE_PATTERN = re.compile(r'^(?:\S+?_)?(sra|chips_check|chips|data_rsync|backup_rsync)(?:_array_\d+(?:_\d+)?)?$')
+JOB_STATES = {'PD':'PENDING','R':'RUNNING'}
+
+
+def job_type_from_name(job_name):
+    match = JOB_TYPE_PATTERN.match(job_name)
+    return match.group(1) if match else 'other'
+
+
+def collect_metrics():
+    """
+    Refresh the gauges of the metrics exporter from the sample queue and the cached cluster state.
+    The job queue is read as last polled by the stages, scratch use and FairShare follow their own poll intervals.
+    """
+    metrics = metrics_exporter.get_metrics()
+    sample_queue = requests_from_cistromeDB.SampleQueue(Config.configpath)
+    for stage,count in sample_queue.count_samples_by_stage().items():
+        metrics.set('cistrome_queue_samples',count,stage=stage)
+
+    cluster_status = cluster_stats.get_cluster_snapshot(Config.configpath)
+    jobs = cluster_status.copy_jobs_in_queue()
+    counts = {(job_type,state):0 for job_type in ['sra','chips','chips_check','data_rsync','backup_rsync'] for state in ['PENDING','RUNNING']}
+    for job_name,status in zip(jobs['name'],jobs['status']):
+        key = (job_type_from_name(job_name),JOB_STATES.get(status,status))
+        counts[key] = counts.get(key,0) + 1
+    for (job_type,state),count in counts.items():
+        metrics.set('cistrome_jobs',count,job_type=job_type,state=state)
+
+    scratch_use = cluster_status.get_scratch_use()
+    if 'used' in scratch_use:
+        metrics.set('cistrome_scratch_used_bytes',scratch_use['used'])
+    if 'quota' in scratch_use:
+        metrics.set('cistrome_scratch_quota_bytes',scratch_use['quota'])
+    fairshare,norm_shares,effective_usage = Config.throttle.fairshare()
+    if fairshare is not None:
+        metrics.set('cistrome_fairshare',fairshare)
+    metrics.set('cistrome_max_jobs',Config.throttle.max_jobs_pending(),state='PENDING')
+    metrics.set('cistrome_max_jobs',Config.throttle.max_jobs_running(),state='RUNNING')
+
+
+def build_scheduler_core(log=None):
+    """
+    Register all pipeline stages, with their schedule and dependencies, in one scheduler core.
+    """
+    max_workers = int(Config.sys_config['process_server'].get('scheduler_workers',len(event_sched)))
+    poll_interval = float(Config.sys_config['process_server'].get('completion_poll_interval',COMPLETION_POLL_INTERVAL))
+    core = scheduler_core.SchedulerCore(max_workers=max_workers, poll_interval=poll_interval, log=log, on_done=record_stage_done)
+    for name,stage_sched in event_sched.items():
+        start_time = stage_sched['start_time']
+        stage = scheduler_core.Stage( name, globals()[name], stage_sched['interval'], 
+            first_run=set_next_hour_minute(start_time['hr'],start_time['min'],start_time['sec']), 
+            downstream=stage_sched['downstream'], done_check=stage_done_checks.get(name) )
+        core.add_stage(stage)
+    return core
+
+
 def main(configpath):
     Config(configpath)
-    update_samples_in_local_queue()
-    download_from_sra() 
-    setup_and_run_chips()
-    check_chips_results()
-    transfer_to_server() 
-    transfer_to_backup_server() 
-    clean_up_after_completion()
+    metrics_exporter.MetricsExporter(Config.sys_config, collect=collect_metrics).start()
+    core = build_scheduler_core()
+    Config.core = core
+    spool_scan_interval = float(Config.sys_config['process_server'].get('spool_scan_interval',job_spool.DEFAULT_SCAN_INTERVAL))
+    job_spool.JobSpoolWatcher(Config.job_spool, lambda records: record_spooled_jobs(records,core), scan_interval=spool_scan_interval).start()
+    # the pipeline stages run once at startup, then all stages follow their schedule
+    startup_stages = Config.sys_config['process_server'].get('startup_stages',','.join(STARTUP_STAGES))
+    for name in [name.strip() for name in startup_stages.split(',') if name.strip() != '']:
+        if name in event_sched:
+            core.request_full_pass(name)
+    core.run()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""Run Cistrome DB data processing""")
     parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '--simulate', dest='simulate_days', type=float, default=None, help='simulate this many days on a virtual clock instead of running, see pipeline_simulator.py')
+    parser.add_argument( '--samples', dest='n_samples', type=int, default=10000, help='number of synthetic samples to simulate')
+    parser.add_argument( '--model', dest='model_path', type=str, default=None, help='JSON cluster and sample model for the simulation')
     args = parser.parse_args()
-    main(args.configpath)
+    if args.simulate_days is not None:
+        import pipeline_simulator
+        pipeline_simulator.simulate(args.configpath, args.simulate_days, n_samples=args.n_samples, model_path=args.model_path)
+    else:
+        main(args.configpath)
 
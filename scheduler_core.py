@@ -0,0 +1,270 @@
+"""
+Event-driven scheduler core.
+All pipeline stages are run from one loop and a shared thread pool.
+Each stage runs periodically (a full pass over the sample queue) and, in addition,
+as soon as samples are put on its ready queue by an upstream stage.
+A sample is handed to the downstream stages as soon as the work submitted for it is
+seen to be finished, instead of waiting for the next periodic pass. A sample whose job
+ended without finishing the work, e.g. failed or was cancelled, is no longer tracked,
+the stage submits it again on a later pass.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+import time
+import traceback
+
+import metrics_exporter
+
+
+class Stage():
+
+    def __init__(self, name, action, interval, first_run=None, downstream=(), done_check=None):
+        """
+        args:
+           - name: stage name, e.g. download_from_sra
+           - action: function called as action(samples). samples is None for a full
+             periodic pass, otherwise the set of sample ids ready for this stage.
+             Returns the sample ids work was submitted for.
+           - interval: seconds between full periodic passes
+           - first_run: epoch seconds of the first full pass (default: now)
+           - downstream: names of stages that follow this one
+           - done_check: function(sample_id) returning True when the submitted work is finished.
+             Without a done_check the samples returned by action are passed downstream right away.
+        """
+        self.name = name
+        self.action = action
+        self.interval = interval
+        self.first_run = first_run
+        self.downstream = list(downstream)
+        self.done_check = done_check
+
+
+class SchedulerCore():
+
+    def __init__(self, max_workers=4, poll_interval=60, clock=time.time, log=None, on_done=None):
+        """
+        args:
+           - max_workers: number of stages that can run at the same time
+           - poll_interval: seconds between checks of in-flight samples for completion
+           - clock: time source, epoch seconds
+           - log: open file for progress messages (default: stdout)
+           - on_done: function(stage_name, sample_ids) called when the submitted work of samples is seen to be finished
+        """
+        self.stages = {}
+        self.ready = {}
+        self.in_flight = {}
+        self.next_run = {}
+        self.running = set()
+        self.full_pass_requested = set()
+        self.poll_interval = poll_interval
+        self.next_poll = None
+        self.clock = clock
+        self.log = log
+        self.on_done = on_done
+        self.max_workers = max_workers
+        self.condition = threading.Condition()
+        self.stopped = False
+
+
+    def add_stage(self,stage):
+        with self.condition:
+            self.stages[stage.name] = stage
+            self.ready[stage.name] = set()
+            self.in_flight[stage.name] = set()
+            if stage.first_run is None:
+                self.next_run[stage.name] = self.clock()
+            else:
+                self.next_run[stage.name] = stage.first_run
+
+
+    def notify(self,stage_name,sample_ids):
+        """
+        Put samples on the ready queue of a stage and wake up the scheduler loop.
+        """
+        sample_ids = set(sample_ids)
+        if len(sample_ids) == 0:
+            return
+        with self.condition:
+            if stage_name in self.ready:
+                self.ready[stage_name] |= sample_ids
+                self.condition.notify_all()
+
+
+    def request_full_pass(self,stage_name):
+        """
+        Run a full pass of a stage as soon as possible, without changing its periodic schedule.
+        """
+        with self.condition:
+            self.full_pass_requested.add(stage_name)
+            self.condition.notify_all()
+
+
+    def request_poll(self):
+        """
+        Check the in-flight samples for completion as soon as possible, e.g. when a job reported its end.
+        """
+        with self.condition:
+            self.next_poll = self.clock()
+            self.condition.notify_all()
+
+
+    def stage_finished(self,stage_name,sample_ids):
+        """
+        The work of a stage is finished for these samples: pass them downstream.
+        """
+        for downstream_name in self.stages[stage_name].downstream:
+            self.notify(downstream_name,sample_ids)
+
+
+    def samples_done(self,stage_name,done):
+        """
+        The submitted work of a stage is seen to be finished for these samples.
+        """
+        if self.on_done is not None:
+            try:
+                self.on_done(stage_name,done)
+            except Exception:
+                self.print_log(f'on_done {stage_name} failed')
+                traceback.print_exc(file=self.log)
+        self.stage_finished(stage_name,done)
+
+
+    def poll_completions(self):
+        """
+        Check samples with work in flight and pass finished samples downstream.
+        Only in-flight samples are checked so the cost is independent of the queue size.
+        """
+        for stage_name,stage in self.stages.items():
+            if stage.done_check is None:
+                continue
+            with self.condition:
+                in_flight = list(self.in_flight[stage_name])
+            done = [sample_id for sample_id in in_flight if stage.done_check(sample_id)]
+            if len(done) > 0:
+                with self.condition:
+                    self.in_flight[stage_name] -= set(done)
+                self.samples_done(stage_name,done)
+
+
+    def jobs_ended(self,stage_name,sample_ids):
+        """
+        The jobs a stage submitted for these samples ended, as reported by a completion record or sacct.
+        Samples whose work is finished are passed downstream, the others are no longer tracked.
+        """
+        stage = self.stages.get(stage_name)
+        if stage is None or stage.done_check is None:
+            return
+        with self.condition:
+            ended = self.in_flight[stage_name] & set(sample_ids)
+        done = [sample_id for sample_id in ended if stage.done_check(sample_id)]
+        with self.condition:
+            self.in_flight[stage_name] -= ended
+        if len(done) > 0:
+            self.samples_done(stage_name,done)
+
+
+    def release(self,sample_ids):
+        """
+        Stop tracking the work in flight of samples in all stages, e.g. when they are restarted from scratch.
+        """
+        with self.condition:
+            for stage_name in self.in_flight:
+                self.in_flight[stage_name] -= set(sample_ids)
+
+
+    def print_log(self,*args):
+        print(datetime.datetime.now(),*args,file=self.log,flush=True)
+
+
+    def run_stage(self,stage_name,samples):
+        stage = self.stages[stage_name]
+        metrics = metrics_exporter.get_metrics()
+        start = self.clock()
+        try:
+            submitted = stage.action(samples)
+            submitted = set(submitted) if submitted is not None else set()
+            metrics.set('cistrome_stage_submitted',len(submitted),stage=stage_name)
+            if stage.done_check is None:
+                self.stage_finished(stage_name,submitted)
+            else:
+                with self.condition:
+                    self.in_flight[stage_name] |= submitted
+        except Exception:
+            self.print_log(f'stage {stage_name} failed')
+            traceback.print_exc(file=self.log)
+            metrics.inc('cistrome_stage_failures_total',stage=stage_name)
+        finally:
+            end = self.clock()
+            self.print_log(f'stage {stage_name} finished in {end-start:.1f}s')
+            metrics.inc('cistrome_stage_runs_total',stage=stage_name,full_pass=str(samples is None).lower())
+            metrics.set('cistrome_stage_duration_seconds',end-start,stage=stage_name)
+            metrics.inc('cistrome_stage_seconds_total',end-start,stage=stage_name)
+            metrics.set('cistrome_stage_last_run_timestamp_seconds',end,stage=stage_name)
+            with self.condition:
+                self.running.discard(stage_name)
+                self.condition.notify_all()
+
+
+    def due_stages(self,now):
+        """
+        Return (stage_name, samples) pairs that should be started now.
+        A full periodic pass also covers samples waiting on the ready queue.
+        """
+        due = []
+        for stage_name,stage in self.stages.items():
+            if stage_name in self.running:
+                continue
+            if now >= self.next_run[stage_name] or stage_name in self.full_pass_requested:
+                while self.next_run[stage_name] <= now:
+                    self.next_run[stage_name] += stage.interval
+                self.full_pass_requested.discard(stage_name)
+                self.ready[stage_name] = set()
+                due += [(stage_name,None)]
+            elif len(self.ready[stage_name]) > 0:
+                samples = self.ready[stage_name]
+                self.ready[stage_name] = set()
+                due += [(stage_name,samples)]
+        return due
+
+
+    def wait_time(self,now):
+        next_times = list(self.next_run.values()) + [self.next_poll]
+        return max(0, min(next_times) - now)
+
+
+    def run(self):
+        """
+        Scheduler loop, runs until stop() is called.
+        """
+        self.next_poll = self.clock() + self.poll_interval
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self.condition:
+                    if self.stopped:
+                        break
+                    now = self.clock()
+                    for stage_name,samples in self.due_stages(now):
+                        self.running.add(stage_name)
+                        executor.submit(self.run_stage,stage_name,samples)
+                    poll_due = now >= self.next_poll
+                    if poll_due:
+                        # set before the poll, so a poll requested meanwhile is not lost
+                        self.next_poll = now + self.poll_interval
+
+                if poll_due:
+                    self.poll_completions()
+
+                with self.condition:
+                    if self.stopped:
+                        break
+                    waiting = [stage_name for stage_name,samples in self.ready.items() if len(samples) > 0] + list(self.full_pass_requested)
+                    if not any( stage_name not in self.running for stage_name in waiting ):
+                        self.condition.wait(timeout=self.wait_time(self.clock()))
+
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
@@ -0,0 +1,146 @@
+"""
+Disk space admission control for scratch.
+Before a download or a CHIPS run is submitted, the space it will need is checked against
+the scratch quota (lfs quota, cached by the cluster snapshot) minus the space already
+promised to samples in flight, so jobs are held back instead of failing on a full quota.
+
+Footprint of a sample, from its fastq size F (actual, expected or a default, as uncompressed fastq):
+    download: SRA files (their size from the NCBI run info, EXPECTED_SRA_BYTES, otherwise sra_size_fraction*F)
+              + fastq files (F, or F/GZIP_RATIO when [sra_download] gzip = true);
+              the runs of a sample are joined in place, each run is removed as it is appended
+    CHIPS:    analysis output (chips_output_fraction*F)
+A download reserves both, since the sample goes on to CHIPS.
+CHIPS runs are only weighed against running CHIPS jobs, not against reservations of
+samples still waiting for CHIPS, so that finishing samples and freeing space is never held up by downloads.
+The estimate is conservative: lfs already counts what in-flight jobs have written so far.
+"""
+
+import sample_priority
+
+# stages in which a sample holds a reservation, and the footprints it holds
+DOWNLOAD_STAGES = ['SRA_SUBMITTED']
+CHIPS_STAGES    = ['SRA_SUBMITTED','FASTQ_READY','CHIPS_SUBMITTED']
+CHIPS_RUNNING_STAGES = ['CHIPS_SUBMITTED']
+
+SRA_SIZE_FRACTION     = 0.5
+CHIPS_OUTPUT_FRACTION = 1.0
+DEFAULT_FASTQ_BYTES   = 5*1024**3
+MIN_DISK_SPACE_AVAIL  = 10e9
+
+
+class ScratchAdmission():
+
+    def __init__(self,sys_config,cluster_status,fastq_names):
+        """
+        args:
+           - sys_config: pipeline config, settings are read from [process_server]
+           - cluster_status: ClusterSnapshot, provides the cached lfs quota
+           - fastq_names: function returning the names in the fastq directory
+        """
+        conf = sys_config['process_server']
+        self.cluster_status = cluster_status
+        self.fastq_path = sys_config['paths']['fastq']
+        self.fastq_names = fastq_names
+        self.min_avail = float(conf.get('min_disk_space_avail',MIN_DISK_SPACE_AVAIL))
+        self.sra_size_fraction = float(conf.get('sra_size_fraction',SRA_SIZE_FRACTION))
+        self.chips_output_fraction = float(conf.get('chips_output_fraction',CHIPS_OUTPUT_FRACTION))
+        self.default_fastq_bytes = float(conf.get('default_fastq_bytes',DEFAULT_FASTQ_BYTES))
+        sra_conf = sys_config['sra_download'] if sys_config.has_section('sra_download') else {}
+        compressed = str(sra_conf.get('gzip','false')).lower() == 'true'
+        self.fastq_fraction = 1/sample_priority.GZIP_RATIO if compressed else 1
+        self.names = set()
+        self.free = None       # bytes left for downloads
+        self.chips_free = None # bytes left for CHIPS runs
+
+
+    def expected_fastq_bytes(self,sample_id,sample):
+        size = sample_priority.fastq_bytes(self.fastq_path,self.names,sample_id)
+        if size == 0:
+            size = float(sample.get('EXPECTED_BYTES',0))
+        if size == 0:
+            size = self.default_fastq_bytes
+        return size
+
+
+    def download_footprint(self,sample_id,sample):
+        fastq_size = self.expected_fastq_bytes(sample_id,sample)
+        sra_size = float(sample.get('EXPECTED_SRA_BYTES',0) or 0)
+        if sra_size == 0:
+            sra_size = self.sra_size_fraction*fastq_size
+        return sra_size + self.fastq_fraction*fastq_size
+
+
+    def chips_footprint(self,sample_id,sample):
+        return self.chips_output_fraction*self.expected_fastq_bytes(sample_id,sample)
+
+
+    def quota_free_bytes(self):
+        """
+        Space left under the quota, or None if lfs quota is not available.
+        """
+        scratch = self.cluster_status.get_scratch_use()
+        limit = scratch.get('quota',0)
+        if not limit > 0:  # no soft quota, or nan
+            limit = scratch.get('limit',0)
+        used = scratch.get('used')
+        if not limit > 0 or used is None or used != used:
+            return None
+        return limit - used
+
+
+    def start_pass(self,sample_queue):
+        """
+        Compute the space available to a stage pass: free quota minus reservations of samples in flight.
+        """
+        self.names = self.fastq_names()
+        quota_free = self.quota_free_bytes()
+        if quota_free is None:
+            print('scratch quota unknown, disk admission is off')
+            self.free = None
+            self.chips_free = None
+            return
+        in_flight = sample_queue.get_samples_in_stages(sorted(set(DOWNLOAD_STAGES + CHIPS_STAGES)))
+        reserved = 0
+        chips_reserved = 0
+        for sample_id,sample in in_flight.items():
+            stage = sample.get('STAGE')
+            if stage in DOWNLOAD_STAGES:
+                reserved += self.download_footprint(sample_id,sample)
+            if stage in CHIPS_STAGES:
+                reserved += self.chips_footprint(sample_id,sample)
+            if stage in CHIPS_RUNNING_STAGES:
+                chips_reserved += self.chips_footprint(sample_id,sample)
+        self.free = quota_free - reserved - self.min_avail
+        self.chips_free = quota_free - chips_reserved - self.min_avail
+
+
+    def admit_download(self,sample_id,sample):
+        """
+        Reserve space for the download and CHIPS run of a sample, False if it does not fit.
+        """
+        if self.free is None:
+            return True
+        # a retried download is already reserved
+        if sample.get('STAGE') in DOWNLOAD_STAGES:
+            return self.free >= 0
+        footprint = self.download_footprint(sample_id,sample) + self.chips_footprint(sample_id,sample)
+        if footprint > self.free:
+            return False
+        self.free -= footprint
+        return True
+
+
+    def admit_chips(self,sample_id,sample):
+        """
+        Reserve space for the CHIPS output of a sample, False if it does not fit next to the running CHIPS jobs.
+        """
+        if self.chips_free is None:
+            return True
+        # a restarted run is already reserved
+        if sample.get('STAGE') in CHIPS_RUNNING_STAGES:
+            return self.chips_free >= 0
+        footprint = self.chips_footprint(sample_id,sample)
+        if footprint > self.chips_free:
+            return False
+        self.chips_free -= footprint
+        return True
@@ -6,17 +6,53 @@
 # ================================
 
 import argparse
+import concurrent.futures
 import configparser
+import contextlib
+import errno
+import fcntl
+import json
 import os
 from pathlib import Path
 import requests
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 from cistrome_logger import cistrome_logger
+import ncbi_metadata
 
 TIMEOUT = 10
+
+# runs (SRRs) of a sample are prefetched, validated and converted by a pool of workers, settings in [sra_download]:
+#    workers    = 4                       runs of a sample processed at the same time
+#    node_slots = 8                       SRA tool processes at the same time on a node, over all download jobs
+#    slot_dir   = /tmp/cistrome_sra_slots node-local directory of the slot lock files
+# runs are converted to fastq with
+#    converter  = fasterq-dump            or fastq-dump
+#    threads    = 4                       threads of a conversion and its compressor, by default SLURM_CPUS_PER_TASK
+#    temp_dir   = /tmp                    node-local directory for the temporary files of a conversion, by default $TMPDIR
+#    compressor = pigz                    or gzip, used with --gzip; gzip is used when pigz is not installed
+# conversions are also limited to the cores of the job, SLURM_CPUS_PER_TASK, divided by threads
+DEFAULT_WORKERS    = 4
+DEFAULT_NODE_SLOTS = 8
+DEFAULT_SLOT_DIR   = '/tmp/cistrome_sra_slots'
+SLOT_WAIT = 2 # seconds between tries for a free node slot
+COPY_CHUNK = 256*1024**2 # bytes appended per copy_file_range or sendfile call when joining runs
+DEFAULT_CONVERTER  = 'fasterq-dump'
+DEFAULT_COMPRESSOR = 'pigz'
+
+# read names of split spots end in their mate number, so a stream of split spots can be de-interleaved
+SPLIT_DEFLINE = '@$ac.$si/$ri'
+
+COMPRESSORS = {
+    'pigz': ['pigz','-p','{threads}','-c'],
+    'gzip': ['gzip','-c'],
+}
  
 #SRATOOL_DEFAULT = "/repository/user/main/public/root"
 class Log():
@@ -33,13 +69,13 @@ def read_config(config_filename):
 def gzip_files(filename_list):
     for elem in filename_list:
         cmd = ['gzip',elem]
-    subprocess.run(cmd)
+        subprocess.run(cmd)
 
 
 def gunzip_files(filename_list):
     for elem in filename_list:
         cmd = ['gunzip',elem]
-    subprocess.run(cmd)
+        subprocess.run(cmd)
 
 
 def rename_file(old_filename,new_filename):
@@ -47,10 +83,81 @@ def rename_file(old_filename,new_filename):
     subprocess.run(rename_command)
 
 
+def append_file(filename,out_fd):
+    """
+    Append a file to the file open as out_fd, copied within the kernel: by copy_file_range, 
+    which on Lustre and NFS may not leave the server, or by sendfile where copy_file_range is not supported.
+    """
+    use_copy_file_range = hasattr(os,'copy_file_range')
+    with open(filename,'rb') as infile:
+        in_fd = infile.fileno()
+        size = os.fstat(in_fd).st_size
+        offset = 0
+        while offset < size:
+            count = min(COPY_CHUNK,size - offset)
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(in_fd,out_fd,count,offset)
+                except OSError as error:
+                    if error.errno not in [errno.EXDEV,errno.ENOSYS,errno.EINVAL,errno.EOPNOTSUPP,errno.EBADF]:
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                copied = os.sendfile(out_fd,in_fd,offset,count)
+            if copied == 0:
+                raise OSError(errno.EIO,f'{filename} ended at {offset} of {size} bytes')
+            offset += copied
+
+
 def concatenate_files(filename_list,catfilename):
-    concat_command = ["cat"] + filename_list
-    with open(catfilename,'w') as outfile:
-        subprocess.run(concat_command,stdout=outfile)
+    # also for gzip files, a gzip file may consist of several members
+    out_fd = os.open(catfilename,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o644)
+    try:
+        for filename in filename_list:
+            append_file(filename,out_fd)
+    finally:
+        os.close(out_fd)
+
+
+def join_files(filename_list,joined_filename,joined=0,joined_size=None,on_progress=None):
+    """
+    Join files into joined_filename: the first file is renamed, the others are appended to it 
+    and deleted one by one, so only the files after the first are copied and their space is freed as the join goes.
+    args:
+       - joined, joined_size: files joined and the size of joined_filename after them, to resume an interrupted join
+       - on_progress: function(joined, joined_size) called when a file was joined, before it is deleted
+    """
+    if joined == 0:
+        # the first file may have been renamed before the join was interrupted
+        if os.path.exists(filename_list[0]) or not os.path.exists(joined_filename):
+            os.replace(filename_list[0],joined_filename)
+        joined,joined_size = 1,os.path.getsize(joined_filename)
+        if on_progress is not None:
+            on_progress(joined,joined_size)
+    out_fd = os.open(joined_filename,os.O_WRONLY)
+    try:
+        # drop the part of a file appended when the join was interrupted
+        os.ftruncate(out_fd,joined_size)
+        os.lseek(out_fd,0,os.SEEK_END)
+        for filename in filename_list[1:joined]:
+            if os.path.exists(filename):
+                os.remove(filename)
+        for i in range(joined,len(filename_list)):
+            append_file(filename_list[i],out_fd)
+            if on_progress is not None:
+                on_progress(i + 1,os.lseek(out_fd,0,os.SEEK_CUR))
+            os.remove(filename_list[i])
+    finally:
+        os.close(out_fd)
+
+
+def join_order(filename_list):
+    """
+    Indexes of the files, largest first, so that the largest file is the one renamed rather than copied.
+    """
+    sizes = [os.path.getsize(filename) for filename in filename_list]
+    return sorted(range(len(filename_list)),key=lambda i: -sizes[i])
 
 
 def delete_files(filename_list):
@@ -67,16 +174,186 @@ def check_files_exist(filename_list):
        if os.path.exists(filename) == False:
            return False
     return True
- 
+
+
+def parse_spot_counts(output):
+    """
+    Spot and read counts reported by fastq-dump ("Read 10 spots ..", "Written 10 spots ..")
+    or fasterq-dump ("spots read : 10", "reads read : 20", "reads written : 20").
+    returns:
+       - {'spots read':.., 'reads read':.., 'spots written':.., 'reads written':..}, missing counts are 0
+    """
+    counts = {'spots read':0, 'reads read':0, 'spots written':0, 'reads written':0}
+    match_read  = re.search(r'Read[\s+]([0-9]+)[\s+]spots',output)
+    match_write = re.search(r'Written[\s+]([0-9]+)[\s+]spots',output)
+    if match_read and match_write:
+        counts['spots read']    = int(match_read.group(1))
+        counts['spots written'] = int(match_write.group(1))
+    for key in ['spots read','reads read','reads written']:
+        match = re.search(r'%s\s*:\s*([0-9,]+)' % key,output)
+        if match:
+            counts[key] = int(match.group(1).replace(',',''))
+    return counts
+
+
+def spots_converted(output,whole_spots):
+    """
+    True if the converter wrote all the spots it read.
+    args:
+       - output: stdout and stderr of the converter
+       - whole_spots: each spot was written as one record, otherwise each read (fasterq-dump --split-files)
+    """
+    counts = parse_spot_counts(output)
+    if counts['spots written'] > 0:
+        # fastq-dump counts spots either way
+        return counts['spots read'] > 0 and counts['spots read'] == counts['spots written']
+    expected = counts['spots read'] if whole_spots else counts['reads read']
+    return counts['spots read'] > 0 and counts['reads written'] == expected
+
+
+class NodeSlots():
+    """
+    Limit on the SRA tool processes of all download jobs on a node.
+    A slot is an flock on one of n_slots files in a node-local directory; 
+    the lock is released when its holder exits, also when it is killed.
+    """
+
+    def __init__(self,slot_dir,n_slots):
+        self.slot_dir = slot_dir
+        self.n_slots = n_slots
+        os.makedirs(slot_dir,exist_ok=True)
+
+
+    @contextlib.contextmanager
+    def slot(self):
+        while True:
+            for i in range(self.n_slots):
+                fp = open(os.path.join(self.slot_dir,f'slot_{i}.lock'),'a')
+                try:
+                    fcntl.flock(fp,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fp.close()
+                    continue
+                try:
+                    yield i
+                finally:
+                    fcntl.flock(fp,fcntl.LOCK_UN)
+                    fp.close()
+                return
+            time.sleep(SLOT_WAIT)
+
+
+class DownloadState():
+    """
+    Progress of the download of a sample, kept in {fastq}/{GSM}.sra_state.json, so that a rerun, 
+    e.g. after a preemption, only redoes the work that was lost:
+        runs:  {run: {'validated': {'size':.., 'mtime':..} of the SRA file that passed vdb-validate,
+                      'converted': {'spots':.., 'reads':.., 'fastq': {fastq file: size}}}}
+        joins: {sample fastq file: {'parts': run fastq files in join order, 'joined': files joined, 'size': bytes after them}}
+    The file is replaced, never rewritten in place, on every change.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path,'r') as fp:
+                self.state = json.load(fp)
+        except (OSError,ValueError):
+            self.state = {}
+        if not isinstance(self.state,dict):
+            self.state = {}
+        self.state.setdefault('runs',{})
+        self.state.setdefault('joins',{})
+
+
+    def write(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path,'w') as fp:
+            json.dump(self.state,fp)
+        os.replace(tmp_path,self.path)
+
+
+    def get_run(self,run):
+        with self.lock:
+            return dict(self.state['runs'].get(run,{}))
+
+
+    def set_run(self,run,key,val):
+        """
+        Record a step of a run, val None to clear it.
+        """
+        with self.lock:
+            run_state = self.state['runs'].setdefault(run,{})
+            if val is None:
+                run_state.pop(key,None)
+            else:
+                run_state[key] = val
+            self.write()
+
+
+    def get_join(self,joined_filename):
+        with self.lock:
+            return self.state['joins'].get(joined_filename)
+
+
+    def set_join(self,joined_filename,join):
+        with self.lock:
+            self.state['joins'][joined_filename] = join
+            self.write()
+
+
+    def fastq_files(self):
+        """
+        Run fastq files recorded in the state, converted or waiting to be joined.
+        """
+        with self.lock:
+            filenames = set()
+            for run_state in self.state['runs'].values():
+                filenames |= set(run_state.get('converted',{}).get('fastq',{}))
+            for join in self.state['joins'].values():
+                filenames |= set(join['parts'])
+            return sorted(filenames)
+
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_state_path(fastq_path,gsm_id):
+    return os.path.join(fastq_path,f'{gsm_id}.sra_state.json')
+
 
 class SRA_Tools():
 
-    def __init__(self,config_filename):
+    def __init__(self,config_filename,compress=False):
+        """
+        args:
+           - config_filename: pipeline config
+           - compress: write gzip compressed fastq files, {ID}.fastq.gz
+        """
         self.MIN_FASTQ_SIZE = 100
         self.config_filename=config_filename
         self.config = read_config(self.config_filename)
         self.set_paths() 
         self.configure_sratools_path()
+        conf = self.config['sra_download'] if self.config.has_section('sra_download') else {}
+        self.workers = int(conf.get('workers',DEFAULT_WORKERS))
+        self.slots = NodeSlots(conf.get('slot_dir',DEFAULT_SLOT_DIR),int(conf.get('node_slots',DEFAULT_NODE_SLOTS)))
+        cpus = int(os.environ.get('SLURM_CPUS_PER_TASK',1))
+        self.threads = int(conf.get('threads',cpus))
+        self.convert_slots = threading.Semaphore(max(1,cpus//self.threads))
+        self.converter = conf.get('converter',DEFAULT_CONVERTER)
+        self.temp_dir = conf.get('temp_dir',os.environ.get('TMPDIR','/tmp'))
+        self.compress = compress
+        self.compressor = conf.get('compressor',DEFAULT_COMPRESSOR)
+        if shutil.which(self.compressor) is None:
+            self.compressor = 'gzip'
+        self.fastq_suffix = '.fastq.gz' if compress else '.fastq'
+        self.run_status = {} # run: status of the runs of the last sample, see process_runs
+        self.state = None    # DownloadState of the sample
+        self.spot_counts = {} # run: spot and read counts of its conversion
 
 
     def set_logger(self,sample_id):
@@ -104,10 +381,16 @@ class SRA_Tools():
     # note multiple runs (SRRs) can comprise a single SRA
     # in addition care needs to be taken of paired end data
     # see https://hbctraining.github.io/Accessing_public_genomic_data/lessons/downloading_from_SRA.html
+    def prefetch_run(self, srr):
+        cmd = ['prefetch', srr]
+        cmd_output = subprocess.run(cmd, stdout=subprocess.PIPE)
+        # a failed prefetch is found by check_prefetch
+        return True
+
+
     def download_fastq_srr_by_prefetch(self, srr_list):
         for i,srr in enumerate(srr_list):
-            cmd = ['prefetch', srr]
-            cmd_output = subprocess.run(cmd, stdout=subprocess.PIPE)
+            self.prefetch_run(srr)
 
 
     def check_sra(self,sra_file):
@@ -156,166 +439,348 @@ class SRA_Tools():
         return status
 
 
-    def single_end_fastq_from_sra(self,srr_id):
-        srr_filename = '%s.sra' % srr_id
-        srr_path = os.path.join(self.sra_path,srr_filename)
-        cmd = ['fastq-dump',srr_path,'-O',self.fastq_path]
-        cmd_output = subprocess.run(cmd,capture_output=True)
-        result_stdout = cmd_output.stdout.decode('utf-8')
-        match_read  = re.search(r'Read[\s+]([0-9]+)[\s+]spots',result_stdout)
-        match_write = re.search(r'Written[\s+]([0-9]+)[\s+]spots',result_stdout)
-
-        if match_read and match_write:
-            n_read  = int(match_read.group(1)) 
-            n_write = int(match_write.group(1))
-        else:
-            n_read = 0
-            n_write = 0
+    def convert_cmd(self,srr_path,split,temp_path):
+        """
+        Converter command for a run. Whole spots are written to stdout; split reads are written to files 
+        in the fastq directory, or, when compressing, to stdout as spots split into reads named .../1 and .../2.
+        Only the temporary files of fasterq-dump go to temp_path.
+        """
+        defline = ['--seq-defline',SPLIT_DEFLINE,'--qual-defline','+']
+        if self.converter == 'fastq-dump':
+            if split and self.compress:
+                return ['fastq-dump','--split-spot','--stdout','--defline-seq',SPLIT_DEFLINE,'--defline-qual','+',srr_path]
+            if split:
+                return ['fastq-dump','--split-files','--defline-seq',SPLIT_DEFLINE,'--defline-qual','+',srr_path,'-O',self.fastq_path]
+            return ['fastq-dump','--stdout',srr_path]
+        cmd = ['fasterq-dump','--threads',str(self.threads),'--temp',temp_path]
+        if split and self.compress:
+            return cmd + ['--split-spot'] + defline + ['--stdout',srr_path]
+        if split:
+            # files left by an interrupted conversion are overwritten
+            return cmd + ['--split-files'] + defline + ['--force','--outdir',self.fastq_path,srr_path]
+        return cmd + ['--concatenate-reads','--stdout',srr_path]
+
+
+    def compress_cmd(self):
+        return [arg.format(threads=self.threads) for arg in COMPRESSORS[self.compressor]]
+
+
+    def stream_fastq(self,cmd,fastq_filename):
+        """
+        Run the converter with its stdout going, through the compressor if compressing, to fastq_filename.
+        returns:
+           - (all processes succeeded, converter stderr)
+        """
+        with open(fastq_filename,'wb') as outfile:
+            if self.compress == False:
+                cmd_output = subprocess.run(cmd,stdout=outfile,stderr=subprocess.PIPE)
+                return cmd_output.returncode == 0, cmd_output.stderr.decode('utf-8')
+            converter = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            compressor = subprocess.Popen(self.compress_cmd(),stdin=converter.stdout,stdout=outfile)
+            converter.stdout.close()
+            result = converter.stderr.read().decode('utf-8')
+            compressor.wait()
+            converter.wait()
+            return converter.returncode == 0 and compressor.returncode == 0, result
+
+
+    def stream_split_fastq(self,cmd,fastq_filenames):
+        """
+        Run the converter with split spots on its stdout, and de-interleave the reads by their mate number 
+        into one compressor per mate writing fastq_filenames, so no uncompressed copy of the run is stored.
+        returns:
+           - (all processes succeeded and every read had mate 1 or 2, converter stderr)
+        """
+        with tempfile.TemporaryFile() as errfile:
+            converter = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=errfile)
+            outfiles = [open(fastq_filename,'wb') for fastq_filename in fastq_filenames]
+            compressors = [subprocess.Popen(self.compress_cmd(),stdin=subprocess.PIPE,stdout=outfile) for outfile in outfiles]
+            mates = {b'1':compressors[0].stdin, b'2':compressors[1].stdin}
+            paired = True
+            try:
+                while True:
+                    header = converter.stdout.readline()
+                    if len(header) == 0:
+                        break
+                    record = header + converter.stdout.readline() + converter.stdout.readline() + converter.stdout.readline()
+                    mate = mates.get(header.rstrip().rsplit(b'/',1)[-1])
+                    if mate is None:
+                        Log.logger.error(f'read without mate number: {header}')
+                        paired = False
+                        converter.kill()
+                        break
+                    mate.write(record)
+            finally:
+                converter.stdout.close()
+                for compressor in compressors:
+                    compressor.stdin.close()
+                status = [compressor.wait() for compressor in compressors] + [converter.wait()]
+                for outfile in outfiles:
+                    outfile.close()
+            errfile.seek(0)
+            result = errfile.read().decode('utf-8')
+        return paired and all(returncode == 0 for returncode in status), result
+
+
+    def fastq_from_sra(self,srr_id,split):
+        """
+        Convert a prefetched run to fastq files in the fastq directory, compressed with --gzip.
+        Whole spots are streamed from the converter (through the compressor) into {run}.fastq[.gz];
+        split reads are written by the converter into {run}_1.fastq and {run}_2.fastq, or, when compressing,
+        streamed through one compressor per mate into {run}_1.fastq.gz and {run}_2.fastq.gz.
+        Only the temporary files of the converter go to the node-local temp dir.
+        returns:
+           - True if all spots were converted
+        """
+        srr_path = os.path.join(self.sra_path,'%s.sra' % srr_id)
+        os.makedirs(self.temp_dir,exist_ok=True)
+        run_temp_path = tempfile.mkdtemp(prefix=f'{srr_id}_',dir=self.temp_dir)
+        try:
+            cmd = self.convert_cmd(srr_path,split,run_temp_path)
+            if split and self.compress:
+                fastq_filenames = [os.path.join(self.fastq_path,name) for name in self.sra_id_to_fastq_paired_end_filenames(srr_id)]
+                status,result = self.stream_split_fastq(cmd,fastq_filenames)
+                status = status and spots_converted(result,whole_spots=False)
+            elif split:
+                cmd_output = subprocess.run(cmd,capture_output=True)
+                result = cmd_output.stdout.decode('utf-8') + cmd_output.stderr.decode('utf-8')
+                status = cmd_output.returncode == 0 and spots_converted(result,whole_spots=False)
+            else:
+                fastq_filename = os.path.join(self.fastq_path,self.sra_id_to_fastq_single_end_filename(srr_id))
+                status,result = self.stream_fastq(cmd,fastq_filename)
+                status = status and spots_converted(result,whole_spots=True)
+        finally:
+            shutil.rmtree(run_temp_path,ignore_errors=True)
+        print('convert output:',result)
+        self.spot_counts[srr_id] = parse_spot_counts(result)
+        return status
 
-        if (n_read > 0) and (n_read == n_write):
-            status = True
-        else:
-            Log.logger.error(f'splitting sra to single-end fastq for {srr_id}')
-            status = False
 
+    def single_end_fastq_from_sra(self,srr_id):
+        status = self.fastq_from_sra(srr_id,split=False)
+        if status == False:
+            Log.logger.error(f'splitting sra to single-end fastq for {srr_id}')
         return status
 
  
     def sra_id_to_fastq_single_end_filename(self,srr_id):   
-        fastq_name = '%s.%s' % (srr_id,'fastq')
+        fastq_name = '%s%s' % (srr_id,self.fastq_suffix)
         return fastq_name
  
 
     def split_paired_end_sra(self,srr_id):
-        srr_filename = '%s.sra' % srr_id
-        srr_path = os.path.join(self.sra_path, srr_filename)
-        fastq_split_cmd = ['fastq-dump','--split-files',srr_path,'-O',self.fastq_path]
-        cmd_output = subprocess.run(fastq_split_cmd,capture_output=True)
-        result_stdout = cmd_output.stdout.decode('utf-8')
-        match_read  = re.search(r'Read[\s+]([0-9]+)[\s+]spots',result_stdout)
-        match_write = re.search(r'Written[\s+]([0-9]+)[\s+]spots',result_stdout)
-
-        if match_read and match_write:
-            n_read  = int(match_read.group(1)) 
-            n_write = int(match_write.group(1))
-        else:
-            n_read = 0
-            n_write = 0
-
-        if (n_read > 0) and (n_read == n_write):
-            status = True
-        else:
+        status = self.fastq_from_sra(srr_id,split=True)
+        if status == False:
             Log.logger.error(f'splitting sra to paired-end fastq for {srr_id}')
-            status = False
-     
         return status
 
 
     def sra_id_to_fastq_paired_end_filenames(self,srr_id):  
-        fastq_split_names = ['%s_%d.%s' % (srr_id,i,'fastq') for i in [1,2]]
+        fastq_split_names = ['%s_%d%s' % (srr_id,i,self.fastq_suffix) for i in [1,2]]
         return fastq_split_names
 
 
-    def extract_single_end_fastq_from_sra(self,gsm_id,srr_list):
-        status = True
-        fastq_filename_list = []        
-        self.download_fastq_srr_by_prefetch(srr_list)
+    def run_fastq_filenames(self,srr_id,paired):
+        if paired:
+            fastq_filenames = self.sra_id_to_fastq_paired_end_filenames(srr_id)
+        else:
+            fastq_filenames = [self.sra_id_to_fastq_single_end_filename(srr_id)]
+        return [os.path.join(self.fastq_path,name) for name in fastq_filenames]
 
-        for srr_id in srr_list:
-            srr_filename = '%s.sra' % srr_id
-            status = self.check_prefetch(srr_filename)
-            if status == True:
-                status = self.single_end_fastq_from_sra(srr_id)
-            else:
-                Log.logger.error(f'sra prefetch failed for {srr_id} in {gsm_id}')
-                break  # write error to log: gsm_id ssr time prefetch error
 
-            fastq_filename = self.sra_id_to_fastq_single_end_filename(srr_id)  
-            fastq_full_filename = os.path.join(self.fastq_path,fastq_filename)
-            if os.path.exists(fastq_full_filename):
-                fastq_filename_list += [fastq_full_filename]
- 
-            if status == False:
-                Log.logger.error(f'error in conversion to fastq for {srr_id} in {gsm_id}')
-                delete_files(fastq_filename_list) # something wrong in conversion to fastq
-                break
+    def sra_file_stat(self,srr_id):
+        try:
+            stat = os.stat(os.path.join(self.sra_path,'%s.sra' % srr_id))
+        except OSError:
+            return None
+        return {'size':stat.st_size, 'mtime':stat.st_mtime}
+
+
+    def is_validated(self,srr_id):
+        """
+        True if the SRA file of the run passed vdb-validate and did not change since.
+        """
+        validated = self.state.get_run(srr_id).get('validated')
+        return validated is not None and validated == self.sra_file_stat(srr_id)
+
+
+    def is_converted(self,srr_id,fastq_filenames):
+        """
+        True if the run was converted to fastq_filenames and they still have the size they were written with.
+        """
+        converted = self.state.get_run(srr_id).get('converted')
+        if converted is None or sorted(converted['fastq']) != sorted(fastq_filenames):
+            return False
+        return all(os.path.exists(name) and os.path.getsize(name) == size for name,size in converted['fastq'].items())
 
+
+    def validate_run(self,srr_id):
+        status = self.check_prefetch('%s.sra' % srr_id)
         if status == True:
-            fastq_concat_filename = '%s.fastq' % (gsm_id)
-            print('concatenating to fastq files %s' % fastq_concat_filename)
+            self.state.set_run(srr_id,'validated',self.sra_file_stat(srr_id))
+        return status
 
-            if len(fastq_filename_list) == 1:
-                rename_file( fastq_filename_list[0], os.path.join( self.fastq_path, fastq_concat_filename) )
-            elif len(fastq_filename_list) > 1:
-                concatenate_files(fastq_filename_list, os.path.join( self.fastq_path, fastq_concat_filename))
-                delete_files(fastq_filename_list)
 
+    def convert_run(self,srr_id,paired):
+        fastq_filenames = self.run_fastq_filenames(srr_id,paired)
+        self.state.set_run(srr_id,'converted',None)
+        status = self.split_paired_end_sra(srr_id) if paired else self.single_end_fastq_from_sra(srr_id)
+        if status == True and check_files_exist(fastq_filenames):
+            counts = self.spot_counts.get(srr_id,{})
+            self.state.set_run(srr_id,'converted',{'spots':counts.get('spots read'), 'reads':counts.get('reads written'),
+                'fastq':{name:os.path.getsize(name) for name in fastq_filenames}})
         return status
 
 
-    def extract_paired_end_fastq_from_sra(self,gsm_id,srr_list):
-        status = True
-        fastq_filename_1_list = []        
-        fastq_filename_2_list = []        
+    def process_run(self,srr_id,paired,stop):
+        """
+        Prefetch, validate and convert one run, each step in a node slot.
+        Steps recorded as done in the download state are skipped: a validated SRA file is neither 
+        prefetched nor validated again, a converted run not converted again. A partial prefetch is resumed by prefetch.
+        args:
+           - paired: split paired-end reads into two fastq files
+           - stop: event set when another run of the sample failed, the run then stops before its next step
+        returns:
+           - status {'run':.., 'stage': last step started, 'failed': step that failed or None,
+             'ok': all steps succeeded, 'fastq': fastq files written, 'skipped': steps done before}
+        """
+        status = {'run':srr_id, 'stage':None, 'failed':None, 'ok':False, 'fastq':[], 'skipped':[]}
+        fastq_filenames = self.run_fastq_filenames(srr_id,paired)
+        validated = self.is_validated(srr_id)
+        converted = self.is_converted(srr_id,fastq_filenames)
+        steps = [('prefetch', lambda: self.prefetch_run(srr_id), validated or converted),
+                 ('validate', lambda: self.validate_run(srr_id), validated or converted),
+                 ('convert',  lambda: self.convert_run(srr_id,paired), converted)]
+        for stage,step,done in steps:
+            if done:
+                status['skipped'] += [stage]
+                continue
+            if stop.is_set():
+                return status
+            status['stage'] = stage
+            with self.slots.slot():
+                if stage == 'convert':
+                    with self.convert_slots:
+                        ok = step()
+                else:
+                    ok = step()
+            if ok == False:
+                status['failed'] = stage
+                return status
+        status['fastq'] = fastq_filenames
+        status['ok'] = check_files_exist(status['fastq'])
+        if status['ok'] == False:
+            status['failed'] = 'convert'
+        return status
 
-        print('download by prefetch ...')
-        self.download_fastq_srr_by_prefetch(srr_list)
 
+    def process_runs(self,gsm_id,srr_list,paired):
+        """
+        Process the runs of a sample in a pool of workers; after the first failure no further steps are started.
+        returns:
+           - list of run status, as from process_run, in the order of srr_list
+        """
+        stop = threading.Event()
+        run_status = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,min(self.workers,len(srr_list)))) as pool:
+            futures = {pool.submit(self.process_run,srr_id,paired,stop):srr_id for srr_id in srr_list}
+            for future in concurrent.futures.as_completed(futures):
+                srr_id = futures[future]
+                try:
+                    run_status[srr_id] = future.result()
+                except Exception as error:
+                    run_status[srr_id] = {'run':srr_id, 'stage':'convert', 'failed':'error', 'ok':False, 'fastq':[], 'skipped':[]}
+                    Log.logger.error(f'{srr_id} in {gsm_id}: {error}')
+                if run_status[srr_id]['ok'] == False:
+                    stop.set()
+        self.run_status = run_status
         for srr_id in srr_list:
-            srr_filename = '%s.sra' % srr_id
-            print('check prefetch %s' % srr_filename)
-            status = self.check_prefetch(srr_filename)
+            print('run status', run_status[srr_id])
+        return [run_status[srr_id] for srr_id in srr_list]
 
-            if status == False:
-                Log.logger.error(f'sra prefetch failed for {srr_id} in {gsm_id}')
-                break
-            else:
-                print('convert to fastq %s' % srr_filename)
-                status = self.split_paired_end_sra(srr_id)
 
-            if status == False:
-                Log.logger.error(f'error in conversion to fastq for {srr_id} in {gsm_id}')
-                break
-            else:
-                fastq_filenames = self.sra_id_to_fastq_paired_end_filenames(srr_id)  
- 
-            if len(fastq_filenames) == 2:
-                fastq_filename_1,fastq_filename_2 = fastq_filenames[0],fastq_filenames[1]
-                fastq_filename_1_list += [os.path.join(self.fastq_path, fastq_filename_1)]        
-                fastq_filename_2_list += [os.path.join(self.fastq_path, fastq_filename_2)]        
-            else:
-                Log.logger.error(f'error in conversion to fastq for {srr_id} in {gsm_id}')
-                # something wrong in conversion to fastq
-                delete_files(fastq_filenames)
-                status = False
-                break
+    def failed_runs(self,gsm_id,run_status,paired):
+        """
+        Log the runs that failed, and delete the fastq files of the runs whose conversion did not finish.
+        Converted runs are kept for the next attempt.
+        returns:
+           - True if a run did not finish
+        """
+        failed = [status for status in run_status if status['ok'] == False]
+        for status in failed:
+            if status['failed'] is not None:
+                Log.logger.error(f"sra {status['failed']} failed for {status['run']} in {gsm_id}")
+        fastq_filenames = []
+        for status in failed:
+            if status['stage'] == 'convert':
+                fastq_filenames += self.run_fastq_filenames(status['run'],paired)
+        fastq_filenames = [name for name in fastq_filenames if os.path.exists(name)]
+        if len(fastq_filenames) > 0:
+            delete_files(fastq_filenames) # something wrong in conversion to fastq
+        return len(failed) > 0
+
+
+    def join_fastq(self,joined_filename):
+        """
+        Join the run fastq files of a join recorded in the download state, from where it stopped.
+        """
+        join = self.state.get_join(joined_filename)
+        def on_progress(joined,joined_size):
+            self.state.set_join(joined_filename,dict(join,joined=joined,size=joined_size))
+        join_files(join['parts'],joined_filename,joined=join['joined'],joined_size=join['size'],on_progress=on_progress)
 
-        if status == True and check_files_exist(fastq_filename_1_list) == False:
-            status = False
 
-        if status == True and check_files_exist(fastq_filename_2_list) == False:
-            status = False
+    def extract_fastq_from_sra(self,gsm_id,srr_list,paired):
+        """
+        Download and convert the runs of a sample and join them into {GSM}.fastq[.gz], or {GSM}_R1 and _R2 for paired ends.
+        Progress is kept in the download state of the sample, so that a rerun continues where an attempt stopped.
+        """
+        self.state = DownloadState(get_state_path(self.fastq_path,gsm_id))
+        if paired:
+            joined_filenames = [os.path.join(self.fastq_path,'%s_R%d%s' % (gsm_id,i,self.fastq_suffix)) for i in [1,2]]
+        else:
+            joined_filenames = [os.path.join(self.fastq_path,'%s%s' % (gsm_id,self.fastq_suffix))]
+
+        joins = [self.state.get_join(name) for name in joined_filenames]
+        if all(join is not None for join in joins):
+            # all runs were converted before the join started
+            print('resuming join of fastq files %s' % joined_filenames[0])
+            status = True
+        else:
+            run_status = self.process_runs(gsm_id,srr_list,paired=paired)
+            runs = [run for run in run_status if run['ok']]
+            status = not self.failed_runs(gsm_id,run_status,paired) and len(runs) > 0
+            if status == True:
+                # the largest run is renamed rather than copied, the mates of a read stay at the same position in both files
+                order = join_order([run['fastq'][0] for run in runs])
+                parts = [[runs[i]['fastq'][mate] for i in order] for mate in range(len(joined_filenames))]
+                # the joins of both mates are recorded before either starts, a rerun then never converts the runs again
+                for mate_parts,joined_filename in zip(parts,joined_filenames):
+                    self.state.set_join(joined_filename,{'parts':mate_parts, 'joined':0, 'size':None})
 
         if status == True:
-            fastq_concat_filename_1 = '%s_R1.fastq' % (gsm_id)
-            fastq_concat_filename_2 = '%s_R2.fastq' % (gsm_id)
-
-            print('concatenating to fastq files %s' % fastq_concat_filename_1)
-            if len(fastq_filename_1_list) == 1:
-                rename_file( fastq_filename_1_list[0], os.path.join( self.fastq_path, fastq_concat_filename_1) )
-                rename_file( fastq_filename_2_list[0], os.path.join( self.fastq_path, fastq_concat_filename_2) )
-            elif len(fastq_filename_1_list) > 1:
-                concatenate_files( fastq_filename_1_list, os.path.join( self.fastq_path, fastq_concat_filename_1) )
-                concatenate_files( fastq_filename_2_list, os.path.join( self.fastq_path, fastq_concat_filename_2) )
-                delete_files(fastq_filename_1_list)
-                delete_files(fastq_filename_2_list)
+            print('concatenating to fastq files %s' % joined_filenames[0])
+            for joined_filename in joined_filenames:
+                self.join_fastq(joined_filename)
 
         return status
 
 
+    def extract_single_end_fastq_from_sra(self,gsm_id,srr_list):
+        return self.extract_fastq_from_sra(gsm_id,srr_list,paired=False)
+
+
+    def extract_paired_end_fastq_from_sra(self,gsm_id,srr_list):
+        print('download by prefetch ...')
+        return self.extract_fastq_from_sra(gsm_id,srr_list,paired=True)
+
+
     def write_fastq_checkfile(self,gsm_id):
         checkfile = os.path.join( self.fastq_path, f'{gsm_id}.check' )
         Path(checkfile).touch()
+        # the download is complete, nothing is left to resume
+        if self.state is not None:
+            self.state.remove()
 
 
 def get_layout_type(srx_html,gsm):
@@ -383,29 +848,40 @@ def main():
     parser.add_argument('-g', '--gzip',   help='flag for fastq file gzip compression', action = "store_true", default=False)
     args = parser.parse_args()
 
-    sra_tool = SRA_Tools(args.config)
+    sra_tool = SRA_Tools(args.config,compress=args.gzip)
     sra_tool.set_logger(args.id)
     
     gsm_id = args.id
-    compress = args.gzip
 
-    gsm_html = get_gsm_html(gsm_id)
-    srx_html = get_srx_html(gsm_html)
-    experiment_accession_html = get_srx_html(gsm_html)
-    print('srx_html',srx_html)
-
-    if srx_html:
-        srr_list = get_run_accession(experiment_accession_html)
-        #get_srr(srx_html)
+    # runs and layout from the NCBI metadata cache, usually resolved by the scheduler already
+    try:
+        metadata = ncbi_metadata.get_ncbi_metadata(args.config).resolve([gsm_id]).get(gsm_id)
+    except Exception as error:
+        Log.logger.error(f'{gsm_id}: NCBI metadata not resolved: {error}')
+        metadata = None
+
+    if metadata is not None:
+        srr_list = [run['run'] for run in metadata['runs']]
+        layout_type = metadata['layout']
+        if layout_type == 'OTHER':
+            Log.logger.error(f'{gsm_id}: sequence file layout type neither single not paired-end')
     else:
-        srr_list = []
+        # GEO and SRA web pages
+        gsm_html = get_gsm_html(gsm_id)
+        srx_html = get_srx_html(gsm_html)
+        print('srx_html',srx_html)
 
-    print('srr_list',srr_list)
+        if srx_html:
+            srr_list = get_run_accession(srx_html)
+        else:
+            srr_list = []
 
-    if len(srr_list) > 0:
-        layout_type = get_layout_type(srx_html,gsm_id)
-    else:
-        layout_type = ''
+        if len(srr_list) > 0:
+            layout_type = get_layout_type(srx_html,gsm_id)
+        else:
+            layout_type = ''
+
+    print('srr_list',srr_list)
 
     if layout_type == "SINGLE":
         status = sra_tool.extract_single_end_fastq_from_sra(gsm_id,srr_list)
@@ -416,7 +892,9 @@ def main():
 
     if status == True:
        sra_tool.write_fastq_checkfile(gsm_id)
-
+    else:
+       # the exit code is the status of the job in its completion record and in sacct
+       sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+"""
+Report of the time samples spend in each part of the pipeline.
+The sample queue store records a stage event when a sample first reaches a stage
+(requests_from_cistromeDB.SampleQueue.set_sample_stage) and when its download or CHIPS
+job starts, taken from sacct. Events:
+    REQUESTED, SRA_SUBMITTED, SRA_STARTED, FASTQ_READY, CHIPS_SUBMITTED, CHIPS_STARTED,
+    CHIPS_COMPLETE, CHECK_SUBMITTED, CHECKED, TRANSFERRED, BACKED_UP, FINISHED
+A restarted sample goes back to REQUESTED; its intervals are measured on the last attempt,
+except the total time, which is measured from the first request.
+
+Print queue wait and run time percentiles per stage, and daily throughput:
+    python stage_timeline.py -c config/rc-fas-harvard.conf [--days 30] [--bin-hours 24]
+"""
+
+import argparse
+import configparser
+import math
+import time
+
+import sample_queue_store
+
+PERCENTILES = [50,90,99]
+
+# (interval name, start events, end event): time from the latest start event before the end event
+INTERVALS = [
+    ('download wait',   ['REQUESTED'],                 'SRA_SUBMITTED'),
+    ('download queue',  ['SRA_SUBMITTED'],             'SRA_STARTED'),
+    ('download run',    ['SRA_STARTED'],               'FASTQ_READY'),
+    ('chips wait',      ['FASTQ_READY'],               'CHIPS_SUBMITTED'),
+    ('chips queue',     ['CHIPS_SUBMITTED'],           'CHIPS_STARTED'),
+    ('chips run',       ['CHIPS_STARTED'],             'CHIPS_COMPLETE'),
+    ('check',           ['CHIPS_COMPLETE'],            'CHECKED'),
+    ('transfer',        ['CHECKED'],                   'TRANSFERRED'),
+    ('backup',          ['CHECKED'],                   'BACKED_UP'),
+    ('clean up',        ['TRANSFERRED','BACKED_UP'],   'FINISHED'),
+]
+
+# total time from the first request
+TOTAL_INTERVAL = ('total', ['REQUESTED'], 'FINISHED')
+
+THROUGHPUT_EVENTS = ['REQUESTED','FASTQ_READY','CHIPS_COMPLETE','FINISHED']
+
+
+def percentile(values,pct):
+    """
+    Nearest-rank percentile, None for no values.
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = max(1,int(math.ceil(pct/100*len(values))))
+    return values[rank-1]
+
+
+def group_by_sample(events):
+    """
+    [(sample_id, event, time)] ordered by sample and time -> {sample_id: [(event, time)]}
+    """
+    samples = {}
+    for sample_id,event,event_time in events:
+        samples.setdefault(sample_id,[])
+        samples[sample_id] += [(event,event_time)]
+    return samples
+
+
+def interval_durations(sample_events,start_events,end_event,first=False):
+    """
+    Durations of one interval in the events of a sample.
+    Each end event is measured from the latest start event before it, or with first from the earliest.
+    returns:
+       - list of (duration, end time)
+    """
+    durations = []
+    start = None
+    for event,event_time in sample_events:
+        if event in start_events and (start is None or not first):
+            start = event_time
+        elif event == end_event and start is not None:
+            durations += [(event_time - start, event_time)]
+            if not first:
+                start = None
+    return durations
+
+
+def stage_latencies(events,since=None):
+    """
+    Percentiles of the stage intervals, in hours.
+    args:
+       - events: list of (sample_id, event, time) ordered by sample and time
+       - since: only intervals ending at or after this time
+    returns:
+       - {interval name: {'n':.., 'p50':.., 'p90':.., 'p99':..}}
+    """
+    durations = {name:[] for name,start_events,end_event in INTERVALS + [TOTAL_INTERVAL]}
+    for sample_id,sample_events in group_by_sample(events).items():
+        for name,start_events,end_event in INTERVALS + [TOTAL_INTERVAL]:
+            for duration,end_time in interval_durations(sample_events,start_events,end_event,first=(name == TOTAL_INTERVAL[0])):
+                if since is None or end_time >= since:
+                    durations[name] += [duration]
+    latencies = {}
+    for name,values in durations.items():
+        hours = [value/3600 for value in values]
+        latencies[name] = {'n':len(hours)}
+        latencies[name].update({f'p{pct}':percentile(hours,pct) for pct in PERCENTILES})
+    return latencies
+
+
+def throughput(events,bin_seconds=86400,since=None):
+    """
+    Number of events per time bin.
+    returns:
+       - list of (bin start time, {event: count}), in time order
+    """
+    counts = {}
+    for sample_id,event,event_time in events:
+        if event not in THROUGHPUT_EVENTS or (since is not None and event_time < since):
+            continue
+        bin_start = event_time - event_time % bin_seconds
+        counts.setdefault(bin_start,{})
+        counts[bin_start][event] = counts[bin_start].get(event,0) + 1
+    return sorted(counts.items())
+
+
+def print_report(events,since=None,bin_seconds=86400):
+    print('\t'.join(['interval','n'] + [f'p{pct}_hours' for pct in PERCENTILES]))
+    for name,latency in stage_latencies(events,since).items():
+        row = [name, str(latency['n'])]
+        row += ['-' if latency[f'p{pct}'] is None else '%.2f' % latency[f'p{pct}'] for pct in PERCENTILES]
+        print('\t'.join(row))
+    print()
+    print('\t'.join(['bin_start'] + THROUGHPUT_EVENTS))
+    for bin_start,counts in throughput(events,bin_seconds,since):
+        print('\t'.join([time.strftime('%Y-%m-%d %H:%M',time.localtime(bin_start))] + [str(counts.get(event,0)) for event in THROUGHPUT_EVENTS]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Report stage latencies and throughput of the sample queue""")
+    parser.add_argument( '-c', dest='configpath', type=str, required=True, help='the path of config file')
+    parser.add_argument( '--days', dest='days', type=float, default=None, help='only the last days (default: all)')
+    parser.add_argument( '--bin-hours', dest='bin_hours', type=float, default=24, help='hours per throughput bin')
+    args = parser.parse_args()
+
+    sys_conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    sys_conf.optionxform=str
+    sys_conf.read(args.configpath)
+    store = sample_queue_store.get_store(sample_queue_store.get_db_path(sys_conf))
+    since = time.time() - args.days*86400 if args.days is not None else None
+    print_report(store.read_events(since), since=since, bin_seconds=args.bin_hours*3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Batch scanner for the sample marker files on scratch.
+Instead of every check function stat-ing a marker file for every sample on every pass,
+the fastq directory and the run directories of the samples the scheduler is working on
+are listed once per scan interval and all checks are answered from memory.
+A directory is only listed again when its mtime changed, so the steady-state cost of a
+scan is one stat per watched directory.
+"""
+
+import os
+import threading
+import time
+
+DEFAULT_SCAN_INTERVAL = 60 # seconds a scan is reused
+MTIME_RESOLUTION = 2       # seconds, Lustre mtimes have 1 second resolution
+WATCH_SCANS = 3            # samples not asked about for this many scans are no longer scanned
+
+MARKERS = ['fastq_check','chips_complete','chips_check_complete','transfer_complete','backup_complete','process_status_file']
+
+
+class StateScanner():
+
+    def __init__(self, fastq_path, runs_path, work_dir='analysis', result_dir='cistrome', scan_interval=DEFAULT_SCAN_INTERVAL):
+        """
+        args:
+           - fastq_path: directory with {ID}.check files written after download
+           - runs_path: directory with one CHIPS run directory per sample
+           - work_dir: CHIPS work directory in a run directory
+           - result_dir: cistrome result directory in a run directory
+           - scan_interval: seconds a scan is reused before the directories are checked again
+        """
+        self.fastq_path = fastq_path
+        self.runs_path = runs_path
+        self.work_dir = work_dir
+        self.result_dir = result_dir
+        self.scan_interval = scan_interval
+        self.lock = threading.RLock()
+        self.dir_cache = {}  # path: (mtime, listed_at, names)
+        self.markers = {}    # sample_id: set of marker names
+        self.watched = {}    # sample_id: number of the last scan it was asked about
+        self.scan_count = 0
+        self.scan_time = None
+
+
+    def list_dir(self,path):
+        """
+        Names in a directory, re-listed only when the directory mtime changed.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            self.dir_cache.pop(path,None)
+            return set()
+
+        cached = self.dir_cache.get(path)
+        # a listing taken in the same second as the last change may have missed a file
+        if cached is not None and cached[0] == mtime and cached[1] - mtime > MTIME_RESOLUTION:
+            return cached[2]
+
+        listed_at = time.time()
+        with os.scandir(path) as entries:
+            names = set([entry.name for entry in entries])
+        self.dir_cache[path] = (mtime,listed_at,names)
+        return names
+
+
+    def scan_sample(self,sample_id,fastq_names):
+        markers = set()
+        if f'{sample_id}.check' in fastq_names:
+            markers.add('fastq_check')
+
+        sample_path = os.path.join(self.runs_path,sample_id)
+        sample_names = self.list_dir(sample_path)
+        if f'{sample_id}_rsync_ok.txt' in sample_names:
+            markers.add('transfer_complete')
+        if f'{sample_id}_backup_ok.txt' in sample_names:
+            markers.add('backup_complete')
+
+        if self.work_dir in sample_names:
+            if 'empty_file_list.txt' in self.list_dir(os.path.join(sample_path,self.work_dir,'logs')):
+                markers.add('chips_complete')
+
+        if self.result_dir in sample_names:
+            result_path = os.path.join(sample_path,self.result_dir)
+            result_names = self.list_dir(result_path)
+            if f'{sample_id}.md5' in result_names:
+                markers.add('chips_check_complete')
+            if sample_id in result_names:
+                if f'{sample_id}_status.json' in self.list_dir(os.path.join(result_path,sample_id)):
+                    markers.add('process_status_file')
+
+        self.markers[sample_id] = markers
+
+
+    def scan(self):
+        """
+        Scan the fastq directory and the run directories of all watched samples.
+        """
+        with self.lock:
+            self.scan_count += 1
+            self.watched = {sample_id:last for sample_id,last in self.watched.items() if self.scan_count - last <= WATCH_SCANS}
+            self.markers = {sample_id:val for sample_id,val in self.markers.items() if sample_id in self.watched}
+            fastq_names = self.list_dir(self.fastq_path)
+            for sample_id in self.watched:
+                self.scan_sample(sample_id,fastq_names)
+            self.scan_time = time.time()
+
+
+    def refresh(self):
+        with self.lock:
+            if self.scan_time is None or time.time() - self.scan_time >= self.scan_interval:
+                self.scan()
+
+
+    def has_marker(self,sample_id,marker):
+        """
+        True if the marker file of a sample exists, as of the last scan.
+        A sample that was not scanned before is scanned straight away and watched from then on.
+        """
+        with self.lock:
+            self.refresh()
+            self.watched[sample_id] = self.scan_count
+            if sample_id not in self.markers:
+                self.scan_sample(sample_id,self.list_dir(self.fastq_path))
+            return marker in self.markers[sample_id]
+
+
+    def fastq_names(self):
+        with self.lock:
+            self.refresh()
+            return set(self.list_dir(self.fastq_path))
+
+
+    def invalidate(self,sample_id):
+        """
+        Forget what is known about a sample, e.g. after the scheduler wrote or deleted its files.
+        """
+        with self.lock:
+            self.markers.pop(sample_id,None)
+            sample_path = os.path.join(self.runs_path,sample_id)
+            for path in list(self.dir_cache):
+                if path == sample_path or path.startswith(sample_path + os.sep) or path == self.fastq_path:
+                    del self.dir_cache[path]